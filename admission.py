@@ -0,0 +1,200 @@
+"""Admission control and idle timeouts, bounding the sessions a server handles and how long they may stall"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import collections
+from object_socket import ObjectSocket
+import packets
+import socket
+import threading
+import time
+import utils
+
+# Default number of sessions handled at once
+MAX_SESSIONS = 512
+# Default number of connections waiting for a session to end, past them connections are shed right away
+MAX_WAITING = 128
+# Default seconds a connection waits for a session to end before it is shed
+WAIT_TIMEOUT = 10.0
+# Default seconds a session may go without receiving or sending anything before it is closed
+IDLE_TIMEOUT = 300.0
+# Default length of the queue of connections the kernel accepted but the server did not yet
+BACKLOG = 1024
+# Seconds between checks for idle sessions
+CHECK_INTERVAL = 1.0
+
+
+def shed(connection):
+    """
+    Tells a connection the server is busy, with a busy logout packet, and closes it.
+    Clients retry later, backing off a little more every time.
+    @param connection: The connection, nothing was read from it
+    @type connection: socket.socket
+    """
+    try:
+        object_socket = ObjectSocket(connection, read_buffer_size=0)
+        object_socket.send_object(packets.LogoutPacket(False, True))
+        object_socket.close()
+    except socket.error as _:
+        connection.close()
+
+
+class Admission(object):
+    """
+    Slots for the sessions a server handles at once. Connections arriving while every slot is taken wait for
+    one in the order they arrived, up to max_waiting of them and for up to timeout seconds, and the rest are
+    shed. Sessions waiting are told apart by tickets, [admitted, deadline, item] lists, item being whatever
+    the server needs to start their session once they are admitted.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_waiting=MAX_WAITING, timeout=WAIT_TIMEOUT):
+        """
+        Creates the slots of a server, all of them free.
+        @param max_sessions: The number of sessions handled at once
+        @type max_sessions: int
+        @param max_waiting: The number of connections waiting for a slot at once
+        @type max_waiting: int
+        @param timeout: The seconds a connection waits for a slot
+        @type timeout: float
+        """
+        super(Admission, self).__init__()
+        self.max_sessions = max(1, max_sessions)
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = collections.deque()
+        # Connections admitted right away, admitted after waiting, and shed, since the server started
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+
+    def reserve(self, item=None):
+        """
+        Takes a slot for a new connection, or a place in the queue of connections waiting for one.
+        @param item: What the server needs to start the session once it is admitted
+        @type item: object
+        @return: The ticket of the connection, admitted if a slot was free, None if it has to be shed
+        @rtype: list or None
+        """
+        with self.condition:
+            if self.active < self.max_sessions and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return [True, None, item]
+            if len(self.waiting) < self.max_waiting:
+                ticket = [False, time.time() + self.timeout, item]
+                self.waiting.append(ticket)
+                return ticket
+            self._shed()
+            return None
+
+    def wait(self, ticket):
+        """
+        Waits until a connection is admitted, or until it waited for too long.
+        @param ticket: The ticket of the connection
+        @type ticket: list
+        @return: Whether it was admitted, if not it has to be shed
+        @rtype: bool
+        """
+        with self.condition:
+            while not ticket[0] and time.time() < ticket[1]:
+                self.condition.wait(ticket[1] - time.time())
+            if ticket[0]:
+                return True
+            self.waiting.remove(ticket)
+            self._shed()
+            return False
+
+    def release(self):
+        """
+        Frees the slot of a session that ended, admitting the connection waiting the longest.
+        @return: The ticket of the connection admitted, None if none was waiting
+        @rtype: list or None
+        """
+        with self.condition:
+            self.active -= 1
+            if not self.waiting:
+                return None
+            ticket = self.waiting.popleft()
+            ticket[0] = True
+            self.active += 1
+            self.delayed += 1
+            self.condition.notify_all()
+            return ticket
+
+    def expire(self):
+        """
+        Removes the connections that waited for too long, for servers not waiting with wait.
+        @return: The tickets of the connections, which have to be shed
+        @rtype: list of list
+        """
+        now = time.time()
+        expired = []
+        with self.condition:
+            while self.waiting and self.waiting[0][1] <= now:
+                expired.append(self.waiting.popleft())
+                self._shed()
+        return expired
+
+    def _shed(self):
+        """Counts a connection shed, with the condition held"""
+        self.rejected += 1
+        utils.log_message("WARN", "Server busy, shedding a connection (" + str(self.active) + " sessions, " +
+                          str(len(self.waiting)) + " waiting, " + str(self.rejected) + " shed)")
+
+
+class IdleMonitor(object):
+    """
+    Thread shutting down the connections of sessions that neither received nor sent anything for too long,
+    so the threads blocked on them wake up and the session ends as if the connection was lost, unlocking its
+    directory. Data connections of striped sessions are left alone, their session closes them.
+    """
+
+    def __init__(self, timeout=IDLE_TIMEOUT):
+        """
+        Creates and starts the monitor.
+        @param timeout: The seconds a session may be idle
+        @type timeout: float
+        """
+        super(IdleMonitor, self).__init__()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Message handlers of the sessions monitored
+        self.handlers = set()
+        thread = threading.Thread(target=IdleMonitor._check, args=(self,))
+        thread.daemon = True
+        thread.start()
+
+    def add(self, handler):
+        """
+        Starts monitoring a session.
+        @param handler: The message handler of the session
+        @type handler: MessageHandler
+        """
+        with self.lock:
+            self.handlers.add(handler)
+
+    def remove(self, handler):
+        """
+        Stops monitoring a session, once it ended.
+        @param handler: The message handler of the session
+        @type handler: MessageHandler
+        """
+        with self.lock:
+            self.handlers.discard(handler)
+
+    def _check(self):
+        """Shuts down the idle sessions every CHECK_INTERVAL seconds"""
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            idle_since = time.time() - self.timeout
+            with self.lock:
+                idle = [handler for handler in self.handlers if handler.object_socket.stripes is None and
+                        handler.object_socket.last_activity < idle_since]
+                self.handlers.difference_update(idle)
+            for handler in idle:
+                utils.log_message("WARN", "Session idle for " + str(self.timeout) + " seconds, closing it")
+                handler.shutdown()
@@ -0,0 +1,449 @@
+'''Benchmarks for PyBox's hot paths'''
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import bundle
+import byte_utils
+import delta
+from files import Directory, File
+import manifest_codec
+import object_socket
+from object_socket import ObjectSocket
+import os
+import packets
+from packets import FileInfo
+import reconciliation
+import scanner
+import shutil
+from staging import StagingArea
+import socket
+import sys
+import tempfile
+import threading
+import time
+import utils
+
+
+def timed(function, *args):
+    '''Runs the function with the given arguments and returns the elapsed seconds'''
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def make_manifest(count, first=0, timestamp=1000000000):
+    '''Builds a synthetic manifest with 100 entries per directory'''
+    files = []
+    for i in range(first, first + count):
+        if i % 100 == 0:
+            files.append(FileInfo("dir%d" % (i // 100), True, timestamp))
+        else:
+            files.append(FileInfo("dir%d/file%d" % (i // 100, i), False, timestamp + i % 3, i))
+    return files
+
+
+def nested_reconcile(local_files, remote_files):
+    '''The nested loops MessageHandler used before the reconciliation module'''
+    request_files = []
+    send_files = []
+    for local in local_files:
+        found_match = False
+        for remote in remote_files:
+            if remote == local:
+                found_match = True
+                if local > remote:
+                    send_files.append(local)
+                break
+        if not found_match:
+            send_files.append(local)
+
+    for remote in remote_files:
+        found_match = False
+        for local in local_files:
+            if local == remote:
+                found_match = True
+                if remote > local:
+                    request_files.append(remote)
+                break
+        if not found_match:
+            request_files.append(remote)
+    return request_files, send_files
+
+
+def benchmark_reconcile(sizes=(10000, 100000, 1000000), nested_limit=2000):
+    '''Compares the indexed reconciliation with the nested loops.
+    The nested loops are only measured up to nested_limit entries and extrapolated quadratically'''
+    local = make_manifest(nested_limit)
+    remote = make_manifest(nested_limit, nested_limit // 2, 1000000001)
+    nested_base = timed(nested_reconcile, local, remote)
+
+    for size in sizes:
+        # Half of each manifest overlaps the other one
+        local = make_manifest(size)
+        remote = make_manifest(size, size // 2, 1000000001)
+        indexed = timed(reconciliation.reconcile, local, remote)
+        if size <= nested_limit:
+            nested = timed(nested_reconcile, local, remote)
+            label = "measured"
+        else:
+            nested = nested_base * (float(size) / nested_limit) ** 2
+            label = "extrapolated"
+        utils.log_message("BENCH", "reconcile %d entries: indexed %.3fs, nested %.1fs (%s), speedup %.0fx"
+                          % (size, indexed, nested, label, nested / max(indexed, 1e-9)))
+
+
+def make_tree(root, directories=200, files_per_directory=100):
+    '''Builds a synthetic tree of empty files'''
+    for i in range(directories):
+        path = os.path.join(root, "dir%d" % (i % 20), "sub%d" % i)
+        os.makedirs(path)
+        for j in range(files_per_directory):
+            open(os.path.join(path, "file%d" % j), "w").close()
+
+
+def wrapper_scan(root):
+    '''The Directory.list and FileInfo scan do_login used before the scanner module'''
+    directory = Directory(root)
+    return [FileInfo(path=obj.get_relpath(root), file_wrapper=obj)
+            for obj in directory.list(directories_after_files=True)]
+
+
+def benchmark_scan(workers=(0, 4, 16)):
+    '''Compares scanning a 20k files tree through the wrappers and through the scanner'''
+    root = tempfile.mkdtemp()
+    try:
+        make_tree(root)
+        utils.log_message("BENCH", "scan with wrappers: %.3fs" % timed(wrapper_scan, root))
+        for count in workers:
+            elapsed = timed(lambda: list(scanner.scan(root, count)))
+            utils.log_message("BENCH", "scan with scanner, %d workers: %.3fs" % (count, elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+def make_deep_manifest(count):
+    '''Builds a synthetic manifest of a deep source tree, sorted like a streamed manifest'''
+    files = []
+    for i in range(count):
+        directory = "src/project/module%d/package%d/subpackage%d" % (i // 5000, i // 500, i // 50)
+        files.append(FileInfo(directory + "/source_file_%d.py" % i, False, 1500000000 + i % 7 * 3600))
+    files.sort(key=lambda info: reconciliation.sort_key(info.path))
+    return files
+
+
+def benchmark_manifest(count=100000):
+    '''Compares the size and encoding time of a manifest in each encoding'''
+    files = make_deep_manifest(count)
+    for encoding in reversed(manifest_codec.ENCODINGS):
+        start = time.time()
+        payload = manifest_codec.encode(files, encoding)
+        encoded = time.time() - start
+        elapsed = timed(manifest_codec.decode, payload, encoding)
+        utils.log_message("BENCH", "manifest of %d entries, %s: %d bytes, encoded in %.3fs, decoded in %.3fs"
+                          % (count, encoding, len(payload), encoded, elapsed))
+
+
+def legacy_unsigned_int_to_bytes(integer):
+    '''byte_utils.unsigned_int_to_bytes before the struct based codec'''
+    result = bytearray(4)
+    mask = 0xff000000
+    for i in range(4):
+        result[i] = (integer & mask) >> (3 - i) * 8
+        mask >>= 8
+    return result
+
+
+def legacy_bytes_to_unsigned_int(byte_array, offset=0):
+    '''byte_utils.bytes_to_unsigned_int before the struct based codec'''
+    result = 0
+    for i in range(4):
+        result |= byte_array[offset + i] << (3 - i) * 8
+    return result
+
+
+def legacy_string_to_bytes(string):
+    '''byte_utils.string_to_bytes before the struct based codec'''
+    result = bytearray(len(string))
+    for i, c in enumerate(string):
+        result[i] = c
+    return result
+
+
+def legacy_bytes_to_string(byte_array, string_length, offset=0):
+    '''byte_utils.bytes_to_string before the struct based codec'''
+    result = ""
+    for i in range(string_length):
+        result += chr(byte_array[offset + i])
+    return result
+
+
+def legacy_pack_entries(files):
+    '''The per entry encoding LoginPacket.send used before the struct based codec'''
+    bodies = []
+    for file_info in files:
+        body = bytearray()
+        body.extend(byte_utils.char_to_bytes(len(file_info.path)))
+        body.extend(byte_utils.boolean_to_bytes(file_info.is_directory))
+        body.extend(legacy_unsigned_int_to_bytes(file_info.last_modified))
+        body.extend(legacy_string_to_bytes(file_info.path))
+        bodies.append(body)
+    return bodies
+
+
+def legacy_unpack_entries(payload):
+    '''The per entry decoding LoginPacket.decode used before the struct based codec'''
+    files = []
+    offset = 0
+    while offset < len(payload):
+        path_length = byte_utils.bytes_to_char(payload, offset)
+        is_directory = byte_utils.bytes_to_boolean(payload, offset + 1)
+        last_modified = legacy_bytes_to_unsigned_int(payload, offset + 2)
+        path = legacy_bytes_to_string(payload, path_length, offset + 6)
+        files.append((path, is_directory, last_modified))
+        offset += 6 + path_length
+    return files
+
+
+def benchmark_codec(iterations=100000, count=100000):
+    '''Compares the struct based codec with the per byte loops it replaced'''
+    path = "src/project/module/package/subpackage/source_file.py"
+    packed_int = byte_utils.unsigned_int_to_bytes(1500000000)
+    packed_path = byte_utils.string_to_bytes(path)
+    pairs = [
+        ("unsigned_int_to_bytes", legacy_unsigned_int_to_bytes, byte_utils.unsigned_int_to_bytes, (1500000000,)),
+        ("bytes_to_unsigned_int", legacy_bytes_to_unsigned_int, byte_utils.bytes_to_unsigned_int, (packed_int,)),
+        ("string_to_bytes", legacy_string_to_bytes, byte_utils.string_to_bytes, (path,)),
+        ("bytes_to_string", legacy_bytes_to_string, byte_utils.bytes_to_string, (packed_path, len(path))),
+    ]
+    for name, legacy, current, args in pairs:
+        legacy_elapsed = timed(lambda: [legacy(*args) for _ in range(iterations)])
+        current_elapsed = timed(lambda: [current(*args) for _ in range(iterations)])
+        utils.log_message("BENCH", "%s x%d: loops %.3fs, struct %.3fs" % (name, iterations, legacy_elapsed,
+                                                                           current_elapsed))
+
+    files = make_deep_manifest(count)
+    payload = manifest_codec.pack_entries(files)
+    utils.log_message("BENCH", "pack %d login entries: loops %.3fs, struct %.3fs"
+                      % (count, timed(legacy_pack_entries, files), timed(manifest_codec.pack_entries, files)))
+    utils.log_message("BENCH", "unpack %d login entries: loops %.3fs, struct %.3fs"
+                      % (count, timed(legacy_unpack_entries, payload), timed(manifest_codec.unpack_entries, payload)))
+
+
+def drain(server_socket, results):
+    '''Accepts a connection and reads everything sent over it, storing how many bytes were read'''
+    connection, _ = server_socket.accept()
+    buffer = bytearray(1048576)
+    total = 0
+    while True:
+        received = connection.recv_into(buffer)
+        if received == 0:
+            break
+        total += received
+    connection.close()
+    results.append(total)
+
+
+def timed_upload(path, size, send):
+    '''Sends a file over loopback with the given function and returns the elapsed seconds'''
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    results = []
+    thread = threading.Thread(target=drain, args=(server_socket, results))
+    thread.start()
+    client_socket = socket.create_connection(server_socket.getsockname())
+    start = time.time()
+    send(client_socket, path, size)
+    client_socket.close()
+    thread.join()
+    elapsed = time.time() - start
+    server_socket.close()
+    if results != [size]:
+        utils.log_message("ERROR", "Sent %d bytes but %s were received" % (size, results))
+    return elapsed
+
+
+def send_chunks(client_socket, path, size):
+    '''The 1 KB chunk loop SendFilePacket used before ObjectSocket.send_file'''
+    for chunk in File(path).chunks(1024):
+        client_socket.sendall(chunk)
+
+
+def send_buffered(client_socket, path, size):
+    '''ObjectSocket.send_file without sendfile'''
+    ObjectSocket(client_socket, use_sendfile=False).send_file(path, size)
+
+
+def send_sendfile(client_socket, path, size):
+    '''ObjectSocket.send_file with sendfile, when the platform has it'''
+    ObjectSocket(client_socket).send_file(path, size)
+
+
+def benchmark_upload(megabytes=256):
+    '''Compares the throughput of the file upload paths over loopback'''
+    descriptor, path = tempfile.mkstemp()
+    os.close(descriptor)
+    try:
+        block = os.urandom(1048576)
+        with open(path, 'wb') as target:
+            for _ in range(megabytes):
+                target.write(block)
+        size = megabytes * 1048576
+        methods = [("1 KB chunks", send_chunks), ("buffered", send_buffered)]
+        if object_socket.sendfile is not None:
+            methods.append(("sendfile", send_sendfile))
+        else:
+            utils.log_message("BENCH", "sendfile is not available, install pysendfile on Python 2")
+        for name, send in methods:
+            elapsed = timed_upload(path, size, send)
+            utils.log_message("BENCH", "upload %d MB with %s: %.3fs, %.1f MB/s" % (megabytes, name, elapsed,
+                                                                                  megabytes / elapsed))
+    finally:
+        os.remove(path)
+
+
+def delta_transfer(old_path, new_path):
+    '''Rebuilds new_path out of old_path with a delta, returning the bytes the signatures and the delta take'''
+    block_size, blocks = delta.signature(old_path)
+    signature_bytes = packets.SIGNATURE_HEADER.size + packets.SIGNATURE_BLOCK.size * len(blocks)
+    delta_bytes = packets.SEND_FILE_HEADER.size + packets.DELTA_HEADER.size + packets.DELTA_INSTRUCTION.size
+    rebuilt_path = new_path + ".rebuilt"
+    with open(old_path, 'rb') as base:
+        with open(rebuilt_path, 'wb') as target:
+            for instruction in delta.compute(new_path, block_size, blocks):
+                delta_bytes += packets.DELTA_INSTRUCTION.size
+                if instruction[0] == delta.COPY:
+                    delta_bytes += packets.DELTA_COPY.size
+                    delta.copy_blocks(base, target, block_size, instruction[1], instruction[2])
+                else:
+                    delta_bytes += packets.DELTA_LITERAL.size + len(instruction[1])
+                    target.write(instruction[1])
+    with open(rebuilt_path, 'rb') as rebuilt:
+        with open(new_path, 'rb') as new:
+            if rebuilt.read() != new.read():
+                utils.log_message("ERROR", "The rebuilt file differs from the new version")
+    os.remove(rebuilt_path)
+    return signature_bytes, delta_bytes
+
+
+def benchmark_delta(megabytes=64):
+    '''Compares delta transfers of large files with small edits against sending them whole'''
+    root = tempfile.mkdtemp()
+    try:
+        old_path = os.path.join(root, "old")
+        new_path = os.path.join(root, "new")
+        original = os.urandom(megabytes * 1048576)
+        with open(old_path, 'wb') as target:
+            target.write(original)
+        middle = len(original) // 2
+        edits = [
+            ("append 4 KB", original + os.urandom(4096)),
+            ("overwrite 100 bytes", original[:middle] + os.urandom(100) + original[middle + 100:]),
+            ("insert 10 bytes", original[:middle] + os.urandom(10) + original[middle:]),
+            ("delete 10 bytes", original[:middle] + original[middle + 10:]),
+        ]
+        for name, contents in edits:
+            with open(new_path, 'wb') as target:
+                target.write(contents)
+            start = time.time()
+            signature_bytes, delta_bytes = delta_transfer(old_path, new_path)
+            elapsed = time.time() - start
+            utils.log_message("BENCH", "%d MB file, %s: whole %d bytes, delta %d bytes (%d signatures + %d "
+                                       "instructions), %.3fs" % (megabytes, name, len(contents),
+                                                                 signature_bytes + delta_bytes, signature_bytes,
+                                                                 delta_bytes, elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+def send_small_files(object_socket, root, bundled):
+    '''Sends the files of a tree in send file packets, or in bundle packets, then shuts the socket down'''
+    bundle_entries = bundle.Bundle()
+    for wrapper in Directory(root).list(directories_after_files=True):
+        file_info = FileInfo(os.path.relpath(wrapper.get_path(), root), file_wrapper=wrapper)
+        if not bundled:
+            object_socket.send_object(packets.SendFilePacket(file_info))
+            continue
+        bundle_entries.add(file_info)
+        if bundle_entries.is_full():
+            object_socket.send_object(packets.BundlePacket(bundle_entries.take()))
+    if bundle_entries.entries:
+        object_socket.send_object(packets.BundlePacket(bundle_entries.take()))
+    object_socket.flush()
+    object_socket.socket.shutdown(socket.SHUT_WR)
+
+
+def receive_small_files(object_socket, root):
+    '''Places the files received in send file and bundle packets, like MessageHandler does'''
+    staging = object_socket.staging
+    while True:
+        packet = object_socket.receive_object()
+        if packet is None:
+            return
+        if isinstance(packet, packets.BundlePacket):
+            staging.place_bundle([(os.path.join(root, info.path), info, contents)
+                                  for info, contents in packet.entries])
+            continue
+        info = packet.file_info
+        destination = os.path.join(root, info.path)
+        if info.is_directory:
+            info.file_wrapper = staging.place_directory(destination)
+        else:
+            staging.place_file(info.file_wrapper, destination)
+        info.file_wrapper.set_timestamp(info.last_modified)
+
+
+def benchmark_bundle(directories=100, files_per_directory=100):
+    '''Compares receiving small files in their own send file packets with receiving them in bundles'''
+    root = tempfile.mkdtemp()
+    try:
+        source = os.path.join(root, "source")
+        for i in range(directories):
+            path = os.path.join(source, "dir%d" % i)
+            os.makedirs(path)
+            for j in range(files_per_directory):
+                with open(os.path.join(path, "file%d" % j), 'wb') as target:
+                    target.write(("small file %d of %d\n" % (j, i)).encode() * (j + 1))
+        for name, bundled in (("send file packets", False), ("bundle packets", True)):
+            target = Directory(os.path.join(root, name.replace(" ", "-")))
+            sender, receiver = socket.socketpair()
+            sending = ObjectSocket(sender, nodelay=False)
+            receiving = ObjectSocket(receiver, nodelay=False)
+            receiving.staging = StagingArea(target)
+            thread = threading.Thread(target=send_small_files, args=(sending, source, bundled))
+            start = time.time()
+            thread.start()
+            receive_small_files(receiving, target.get_path())
+            thread.join()
+            elapsed = time.time() - start
+            sending.close()
+            receiving.close()
+            utils.log_message("BENCH", "%d small files in %d directories, %s: %.3fs" %
+                              (directories * files_per_directory, directories, name, elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+BENCHMARKS = {
+    "reconcile": benchmark_reconcile,
+    "scan": benchmark_scan,
+    "manifest": benchmark_manifest,
+    "codec": benchmark_codec,
+    "upload": benchmark_upload,
+    "delta": benchmark_delta,
+    "bundle": benchmark_bundle,
+}
+
+
+def main():
+    '''Runs the benchmarks named in the arguments, or all of them'''
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            utils.log_message("ERROR", "Unknown benchmark " + name + ", choose from " + ", ".join(sorted(BENCHMARKS)))
+            continue
+        BENCHMARKS[name]()
+
+main()
@@ -4,31 +4,106 @@
 # 81936 - Liliana Oliveira
 # 82047 - Andre Mendes
 
-from object_socket import ObjectSocket
-from message_handler import MessageHandler
+from object_socket import ObjectSocket, add_transport_arguments, transport_options
+import bundle
+import content_store
+from message_handler import MessageHandler, LOGIN_MODES, LOGIN_FLAT
+import file_codec
+import negotiation
+import argparse
 import socket
-import sys
+import staging
+import striping
+import time
 import utils
 
-def main():
-    '''Starts execution once everything is loaded'''
-    hostname = sys.argv[1]
-    port = int(sys.argv[2])
-    username = sys.argv[3]
-    directory = sys.argv[4].rstrip('/')
+def parse_arguments():
+    '''Parses the command line arguments'''
+    parser = argparse.ArgumentParser(description="PyBox client")
+    parser.add_argument("hostname")
+    parser.add_argument("port", type=int)
+    parser.add_argument("user")
+    parser.add_argument("directory")
+    parser.add_argument("--scan-workers", type=int, default=0,
+                        help="threads listing subdirectories in parallel on the first scan (network filesystems)")
+    parser.add_argument("--login-mode", choices=LOGIN_MODES, default=LOGIN_FLAT,
+                        help="flat sends the whole manifest, tree only sends the directories that changed")
+    parser.add_argument("--file-compression", choices=file_codec.CODECS, default=file_codec.ZLIB,
+                        help="preferred compression of file contents, negotiated at login")
+    parser.add_argument("--content-hash", choices=content_store.HASHES, default=content_store.SHA256,
+                        help="hash the contents of files the server asks for, so it does not have to receive "
+                             "contents it already has, e.g. moved files")
+    parser.add_argument("--file-bundle", choices=bundle.MODES, default=bundle.BUNDLE,
+                        help="send small files and directories together, negotiated at login")
+    parser.add_argument("--file-resume", choices=staging.MODES, default=staging.RESUME,
+                        help="resume interrupted transfers of large files and allow files over 4 GB, "
+                             "negotiated at login")
+    parser.add_argument("--data-streams", type=int, default=0,
+                        help="data connections large files are striped across, next to the session's connection, "
+                             "negotiated at login")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="times to reconnect after the connection is lost, resuming the transfers it interrupted")
+    parser.add_argument("--retry-delay", type=float, default=1.0,
+                        help="seconds to wait before reconnecting the first time, doubled on every retry")
+    add_transport_arguments(parser)
+    # Cleared once the server turns out to be older than the negotiation
+    parser.set_defaults(negotiate=True)
+    return parser.parse_args()
+
+def synchronize(arguments):
+    '''Connects to the server and synchronizes the directory, returns whether it finished, or whether it can
+    never finish with this server'''
+    directory = arguments.directory.rstrip('/')
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     try:
-        client_socket.connect((hostname, port))
+        client_socket.connect((arguments.hostname, arguments.port))
     except Exception as _:
         utils.log_message("ERROR", "PyBox is currently unavailable due to socket error")
         client_socket.close()
-        return
+        return False
 
-    object_socket = ObjectSocket(client_socket)
+    def connect():
+        '''Opens a data connection to the server'''
+        data_socket = socket.create_connection((arguments.hostname, arguments.port))
+        return ObjectSocket(data_socket, **transport_options(arguments))
+
+    object_socket = ObjectSocket(client_socket, **transport_options(arguments))
     message_handler = MessageHandler(object_socket)
-    message_handler.do_login(username, directory)
-    message_handler.process()
+    preferences = {negotiation.FILE_COMPRESSION: arguments.file_compression,
+                   negotiation.CONTENT_HASH: arguments.content_hash,
+                   negotiation.FILE_BUNDLE: arguments.file_bundle,
+                   negotiation.FILE_RESUME: arguments.file_resume,
+                   negotiation.FILE_STRIPING: striping.STRIPED if arguments.data_streams > 0 else striping.NONE}
+    try:
+        if not message_handler.do_login(arguments.user, directory, arguments.scan_workers, arguments.login_mode,
+                                        preferences, arguments.data_streams, connect, arguments.negotiate):
+            # The server does not know the negotiate packet, and may have read garbage after it
+            client_socket.close()
+            if arguments.login_mode != LOGIN_FLAT:
+                utils.log_message("ERROR", "The server does not negotiate, the " + arguments.login_mode +
+                                  " login mode needs an up to date server")
+                # Reconnecting would not help
+                return True
+            utils.log_message("WARN", "The server does not negotiate, logging in again without negotiating")
+            arguments.negotiate = False
+            return synchronize(arguments)
+        return message_handler.process()
+    except socket.error as error:
+        utils.log_message("ERROR", "Connection lost: " + str(error))
+        client_socket.close()
+        return False
+
+def main():
+    '''Starts execution once everything is loaded'''
+    arguments = parse_arguments()
+    for attempt in range(arguments.retries + 1):
+        if attempt > 0:
+            delay = arguments.retry_delay * 2 ** (attempt - 1)
+            utils.log_message("INFO", "Reconnecting in %.1f seconds" % delay)
+            time.sleep(delay)
+        if synchronize(arguments):
+            return
 
 main()
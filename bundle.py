@@ -0,0 +1,86 @@
+"""Bundling of small files and directories, sent together in a single bundle packet"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import os
+
+# Small files and directories are sent together in bundle packets
+BUNDLE = "bundle"
+# Every file and directory is sent in its own send file packet
+NONE = "none"
+
+# Supported bundle modes, most preferred first
+MODES = [BUNDLE, NONE]
+
+# Files larger than this are sent in their own send file packet
+MAX_FILE_SIZE = 65536
+# A bundle is sent once its files add up to this size, or once it has this many entries
+MAX_SIZE = 1048576
+MAX_ENTRIES = 4096
+
+
+class Bundle(object):
+    """
+    Small files and directories waiting to be sent together. The contents of the files are read when they are
+    added, so a bundle holds at most MAX_SIZE bytes of them.
+    """
+
+    def __init__(self):
+        super(Bundle, self).__init__()
+        # (FileInfo, contents) pairs, the contents are None for directories
+        self.entries = []
+        self.size = 0
+
+    @staticmethod
+    def accepts(file_info):
+        """
+        Returns whether a file or directory can be bundled.
+        @param file_info: The file or directory, with its file wrapper
+        @type file_info: FileInfo
+        @rtype: bool
+        """
+        return file_info.is_directory or file_info.size <= MAX_FILE_SIZE
+
+    def add(self, file_info):
+        """
+        Adds a file or directory, reading the file's contents unless they are in memory already.
+        @param file_info: The file or directory, with its file wrapper
+        @type file_info: FileInfo
+        """
+        contents = None
+        if not file_info.is_directory:
+            contents = file_info.contents
+            if contents is None:
+                with open(file_info.file_wrapper.get_path(), 'rb') as source:
+                    contents = source.read(file_info.size)
+            # The size announced is the size read, the file may have changed since it was stat'ed
+            file_info.size = len(contents)
+            self.size += len(contents)
+        self.entries.append((file_info, contents))
+
+    def is_full(self):
+        """Returns whether the bundle should be sent before adding anything else"""
+        return self.size >= MAX_SIZE or len(self.entries) >= MAX_ENTRIES
+
+    def take(self):
+        """
+        Empties the bundle.
+        @return: The entries it had
+        @rtype: list of tuple
+        """
+        entries = self.entries
+        self.entries = []
+        self.size = 0
+        return entries
+
+
+def parent_directories(paths):
+    """
+    Returns the directories containing some paths, parents before their children, so each is created once.
+    @param paths: The absolute paths
+    @type paths: list of str
+    @rtype: list of str
+    """
+    return sorted(set(os.path.dirname(path) for path in paths))
@@ -4,6 +4,12 @@
 # 81936 - Liliana Oliveira
 # 82047 - Andre Mendes
 
+import struct
+
+# Precompiled format, big endian
+UNSIGNED_INT = struct.Struct(">I")
+
+
 def boolean_to_bytes(boolean):
     """
     Transforms a character into a byte array of 1 byte
@@ -61,12 +67,7 @@ def unsigned_int_to_bytes(integer):
     @return: A byte array with a length of 4
     @rtype: bytearray
     """
-    result = bytearray(4)
-    mask = 0xff000000
-    for i in range(4):
-        result[i] = (integer & mask) >> (3 - i) * 8
-        mask >>= 8
-    return result
+    return bytearray(UNSIGNED_INT.pack(integer))
 
 
 def bytes_to_unsigned_int(byte_array, offset=0):
@@ -79,10 +80,7 @@ def bytes_to_unsigned_int(byte_array, offset=0):
     @return: The integer read
     @rtype: integer
     """
-    result = 0
-    for i in range(4):
-        result |= byte_array[offset + i] << (3 - i) * 8
-    return result
+    return UNSIGNED_INT.unpack_from(byte_array, offset)[0]
 
 
 def string_to_bytes(string):
@@ -93,10 +91,7 @@ def string_to_bytes(string):
     @return: A byte array with the length of the string
     @rtype: bytearray
     """
-    result = bytearray(len(string))
-    for i, c in enumerate(string):
-        result[i] = c
-    return result
+    return bytearray(string)
 
 
 def bytes_to_string(byte_array, string_length, offset=0):
@@ -111,7 +106,43 @@ def bytes_to_string(byte_array, string_length, offset=0):
     @return: The string read
     @rtype: string
     """
-    result = ""
-    for i in range(string_length):
-        result += chr(byte_array[offset + i])
+    # Slicing a memoryview does not copy, so the string is the only copy made
+    return memoryview(byte_array)[offset:offset + string_length].tobytes()
+
+
+def varint_to_bytes(integer):
+    """
+    Transforms an unsigned integer into a byte array of 7 bits per byte, least significant first,
+    with the most significant bit set on every byte but the last (LEB128)
+    @param integer: The integer to be transformed
+    @type integer: int
+    @return: A byte array with a length of 1 byte per started 7 bits
+    @rtype: bytearray
+    """
+    result = bytearray()
+    while integer >= 0x80:
+        result.append((integer & 0x7f) | 0x80)
+        integer >>= 7
+    result.append(integer)
     return result
+
+
+def bytes_to_varint(byte_array, offset=0):
+    """
+    Reads a LEB128 unsigned integer from a byte array starting from the offset position.
+    @param byte_array: The byte array that contains the integer
+    @type byte_array: bytearray
+    @param offset: The start offset
+    @type offset: int
+    @return: The integer read and the offset right after it
+    @rtype: (int, int)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = byte_array[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
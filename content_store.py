@@ -0,0 +1,145 @@
+"""Content-addressed storage shared by the synchronized directories of every user on the server"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import binascii
+import errno
+import hashlib
+import os
+import utils
+
+# Hash of the contents of files, as negotiated
+SHA256 = "sha256"
+# Contents are never hashed
+NONE = "none"
+
+# Supported content hashes, most preferred first
+HASHES = [SHA256, NONE]
+# Length of the digests (SHA-256)
+DIGEST_LENGTH = 32
+# Size of the chunks files are read in to be hashed
+READ_SIZE = 1048576
+
+
+def file_digest(path):
+    """
+    Hashes the contents of a file.
+    @param path: The path of the file
+    @type path: str
+    @return: The SHA-256 digest
+    @rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        while True:
+            data = source.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+
+class ContentStore(object):
+    """
+    Directory holding one object per distinct file contents, named by their SHA-256 digest. The files of the
+    synchronized directories are hard links to these objects, so contents synchronized by many users take the
+    space of a single copy, and the Directory and File wrappers keep working on the synchronized directories.
+    Received files are always renamed into place instead of written over, so objects never change.
+    The store has to be on the same filesystem as the synchronized directories.
+
+    Linked files share their inode, and so their timestamps, so the manifest index is what holds the
+    timestamp of each user's version.
+    """
+
+    def __init__(self, path):
+        """
+        Opens a content store, creating it if needed.
+        @param path: The directory of the store
+        @type path: str
+        """
+        super(ContentStore, self).__init__()
+        self.path = os.path.realpath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def object_path(self, digest):
+        """
+        Returns the path of the object with the given contents.
+        @param digest: The SHA-256 digest of the contents
+        @type digest: str
+        @rtype: str
+        """
+        name = binascii.hexlify(digest).decode("ascii")
+        return os.path.join(self.path, name[:2], name[2:])
+
+    def contains(self, digest):
+        """
+        Returns whether the store has an object with the given contents.
+        @param digest: The SHA-256 digest of the contents
+        @type digest: str
+        @rtype: bool
+        """
+        return os.path.isfile(self.object_path(digest))
+
+    def ingest(self, path, staging):
+        """
+        Stores the contents of a file that was just placed in a synchronized directory. New contents become an
+        object, and files with contents already stored are replaced by a link to the existing object.
+        @param path: The absolute path of the file
+        @type path: str
+        @param staging: The staging area of the file's synchronized directory
+        @type staging: StagingArea
+        @return: The digest of the contents, and whether they were new
+        @rtype: (str, bool)
+        """
+        digest = file_digest(path)
+        object_path = self.object_path(digest)
+        parent = os.path.dirname(object_path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as _:
+                if not os.path.isdir(parent):
+                    raise
+        try:
+            os.link(path, object_path)
+            return digest, True
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        staging.place_file(staging.new_link(object_path), path)
+        return digest, False
+
+    def link(self, digest, path, staging):
+        """
+        Places a link to a stored object in a synchronized directory.
+        @param digest: The SHA-256 digest of the contents
+        @type digest: str
+        @param path: The absolute path of the file
+        @type path: str
+        @param staging: The staging area of the file's synchronized directory
+        @type staging: StagingArea
+        """
+        staging.place_file(staging.new_link(self.object_path(digest)), path)
+
+    def collect(self):
+        """
+        Removes the objects no synchronized directory links to anymore.
+        @return: The number of objects removed
+        @rtype: int
+        """
+        removed = 0
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                object_path = os.path.join(prefix_path, name)
+                if os.stat(object_path).st_nlink == 1:
+                    os.remove(object_path)
+                    removed += 1
+        if removed > 0:
+            utils.log_message("INFO", "Removed " + str(removed) + " unused objects from the content store")
+        return removed
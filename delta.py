@@ -0,0 +1,207 @@
+"""rsync-style delta transfer of files both sides already have a version of"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import hashlib
+import mmap
+import os
+import zlib
+
+# Transfer the changes between both versions instead of the whole file
+RSYNC = "rsync"
+# Always transfer whole files
+NONE = "none"
+
+# Supported delta modes, most preferred first
+MODES = [RSYNC, NONE]
+
+# Files smaller than this are sent whole, the round trip is not worth it
+MIN_SIZE = 65536
+# Bounds of the block size, which grows with the square root of the file size
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 131072
+# Length of the strong hashes (MD5)
+STRONG_LENGTH = 16
+# Longest literal sent in a single instruction
+MAX_LITERAL = 1048576
+# Bytes of a file searched one at a time for shifted blocks, past it only block aligned matches are found
+ROLL_BUDGET = 8388608
+
+# Instructions rebuilding the file
+COPY = 0
+LITERAL = 1
+
+# Modulus of the Adler-32 sums
+_ADLER_MODULUS = 65521
+
+
+def block_size_for(size):
+    """
+    Returns the block size to use for a file, a power of two close to the square root of its size.
+    @param size: The size of the file
+    @type size: int
+    @rtype: int
+    """
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def weak_checksum(data):
+    """Adler-32 of a block, the checksum that can be rolled one byte at a time"""
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_hash(data):
+    """MD5 of a block, confirming a match of the weak checksums"""
+    return hashlib.md5(data).digest()
+
+
+def signature(path):
+    """
+    Computes the block signatures of a file.
+    @param path: The path of the file
+    @type path: str
+    @return: The block size, and the (weak checksum, strong hash) of every block, the last one may be shorter
+    @rtype: (int, list of tuple)
+    """
+    block_size = block_size_for(os.path.getsize(path))
+    blocks = []
+    with open(path, 'rb') as source:
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            blocks.append((weak_checksum(block), strong_hash(block)))
+    return block_size, blocks
+
+
+def compute(path, block_size, blocks):
+    """
+    Generator of the instructions rebuilding a file out of the blocks of another version of it.
+    Block aligned matches are tried first, which is all appends and in-place edits need. After a block that does
+    not match, the offsets up to the next block are tried one byte at a time with a rolling checksum, which finds
+    the blocks that were shifted by insertions or deletions. Searching byte by byte is slow in Python, so it stops
+    after ROLL_BUDGET bytes, keeping the cost of a mostly new file close to the cost of hashing it.
+    @param path: The path of the new version
+    @type path: str
+    @param block_size: The block size of the signatures
+    @type block_size: int
+    @param blocks: The (weak checksum, strong hash) of every block of the other version
+    @type blocks: list of tuple
+    @return: (COPY, first block, block count) and (LITERAL, data) instructions
+    @rtype: generator of tuple
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, []).append((index, strong))
+
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as source:
+        data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Consecutive copied blocks are sent as a single instruction
+            run = None
+            literal_start = 0
+            offset = 0
+            roll_budget = ROLL_BUDGET
+            while offset < size:
+                block = data[offset:offset + block_size]
+                expected = run[0] + run[1] if run is not None else None
+                index = _match(table, weak_checksum(block), block, expected)
+                match_offset = offset
+                if index is None and roll_budget > 0:
+                    index, match_offset = _roll(table, data, offset, block_size, size, block)
+                    roll_budget -= block_size
+                if index is None:
+                    offset += block_size
+                    continue
+                if literal_start < match_offset or (run is not None and index != run[0] + run[1]):
+                    if run is not None:
+                        yield (COPY, run[0], run[1])
+                        run = None
+                    for literal in _literals(data, literal_start, match_offset):
+                        yield literal
+                if run is None:
+                    run = [index, 0]
+                run[1] += 1
+                offset = match_offset + block_size
+                literal_start = offset
+            if run is not None:
+                yield (COPY, run[0], run[1])
+            for literal in _literals(data, literal_start, size):
+                yield literal
+        finally:
+            data.close()
+
+
+def copy_blocks(base, target, block_size, first, count):
+    """
+    Copies blocks of the other version of a file, as told by a COPY instruction.
+    @param base: The other version, open for reading
+    @type base: file
+    @param target: The file being rebuilt, open for writing
+    @type target: file
+    @param block_size: The block size of the signatures
+    @type block_size: int
+    @param first: The index of the first block
+    @type first: int
+    @param count: The number of blocks
+    @type count: int
+    """
+    base.seek(first * block_size)
+    remaining = count * block_size
+    while remaining > 0:
+        data = base.read(min(remaining, MAX_LITERAL))
+        if not data:
+            break
+        target.write(data)
+        remaining -= len(data)
+
+
+def _match(table, weak, block, expected=None):
+    """Returns the index of a block of the other version equal to block, preferring the expected one, or None"""
+    candidates = table.get(weak)
+    if not candidates:
+        return None
+    strong = strong_hash(block)
+    found = None
+    for index, candidate_strong in candidates:
+        if candidate_strong == strong:
+            if index == expected:
+                return index
+            if found is None:
+                found = index
+    return found
+
+
+def _roll(table, data, offset, block_size, size, block):
+    """Tries the offsets after offset, up to a block away, returning the (index, offset) of a match or (None, None)"""
+    if offset + block_size >= size:
+        return None, None
+    window = bytearray(data[offset:min(offset + 2 * block_size, size)])
+    weak = weak_checksum(block)
+    a = weak & 0xffff
+    b = weak >> 16
+    for start in range(1, len(window) - block_size + 1):
+        removed = window[start - 1]
+        a = (a - removed + window[start + block_size - 1]) % _ADLER_MODULUS
+        b = (b - block_size * removed + a - 1) % _ADLER_MODULUS
+        if (b << 16 | a) in table:
+            candidate = data[offset + start:offset + start + block_size]
+            index = _match(table, b << 16 | a, candidate)
+            if index is not None:
+                return index, offset + start
+    return None, None
+
+
+def _literals(data, start, end):
+    """Generator of the LITERAL instructions sending data[start:end]"""
+    while start < end:
+        yield (LITERAL, data[start:min(end, start + MAX_LITERAL)])
+        start += MAX_LITERAL
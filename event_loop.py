@@ -0,0 +1,527 @@
+"""Event loop serving every session from a single thread, with a bounded pool of workers handling their packets"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import admission
+import collections
+import errno
+from message_handler import MessageHandler
+import negotiation
+from object_socket import ObjectSocket
+import os
+import Queue
+import select
+import socket
+import threading
+import time
+import utils
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Default number of workers handling packets, and doing the disk I/O they need
+WORKERS = 16
+# Default number of sessions handled at once, idle ones take little more than their connection
+MAX_SESSIONS = 16384
+# Bytes received at once from a connection
+RECEIVE_SIZE = 65536
+# A connection is not read from while this many bytes received from it were not handled yet
+MAX_PENDING = 262144
+# Workers sending to a connection wait while this many bytes were not sent yet
+MAX_UNSENT = 262144
+# Input buffer and file buffer of each session, kept small since there may be many thousands of them
+SESSION_BUFFER_SIZE = 4096
+FILE_BUFFER_SIZE = 65536
+
+# Events the poller reports, epoll and poll share their values
+EVENT_READ = select.POLLIN
+EVENT_WRITE = select.POLLOUT
+EVENT_CLOSED = select.POLLERR | select.POLLHUP
+
+
+def raise_file_limit():
+    """Raises the number of open files allowed to its hard limit, each session takes one"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, resource.error) as _:
+            pass
+
+
+class Channel(object):
+    """
+    Non-blocking connection seen by an ObjectSocket as a blocking socket. The event loop receives into its
+    input queue and sends out of its output queue, so the packet codecs run unchanged in a worker, blocking on
+    the channel only while a packet is incomplete or while the other side is not reading.
+    """
+
+    def __init__(self, event_loop, connection):
+        """
+        Creates the channel of an accepted connection.
+        @param event_loop: The event loop polling the connection
+        @type event_loop: EventLoop
+        @param connection: The connection, non-blocking
+        @type connection: socket.socket
+        """
+        super(Channel, self).__init__()
+        self.event_loop = event_loop
+        self.connection = connection
+        self.descriptor = connection.fileno()
+        self.condition = threading.Condition()
+        # Received chunks not read yet, the first one from input_offset on
+        self.input = collections.deque()
+        self.input_offset = 0
+        self.pending = 0
+        # Chunks waiting to be sent, the first one from output_offset on
+        self.output = collections.deque()
+        self.output_offset = 0
+        self.unsent = 0
+        # Whether the other side shut its end down, whether the connection failed, and whether it is being closed
+        self.eof = False
+        self.broken = False
+        self.closing = False
+        # Whether a worker is handling the session, or is about to
+        self.scheduled = False
+        # When bytes were last received or sent
+        self.last_activity = time.time()
+        # Events the connection is registered for, 0 while it is not registered, since hang ups are always polled
+        self.events = 0
+        self.handler = None
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        """
+        Reads received bytes into a buffer, waiting for some to arrive if there are none.
+        @param buffer: The buffer to read into
+        @type buffer: bytearray or memoryview
+        @param nbytes: The most bytes to read, 0 for the buffer's length
+        @type nbytes: int
+        @param flags: Ignored
+        @type flags: int
+        @return: The number of bytes read, 0 once the other side shut its end down
+        @rtype: int
+        """
+        nbytes = nbytes or len(buffer)
+        with self.condition:
+            while not self.input and not self.eof:
+                self.condition.wait()
+            if not self.input:
+                return 0
+            chunk = self.input[0]
+            read = min(nbytes, len(chunk) - self.input_offset)
+            memoryview(buffer)[:read] = chunk[self.input_offset:self.input_offset + read]
+            self.input_offset += read
+            if self.input_offset == len(chunk):
+                self.input.popleft()
+                self.input_offset = 0
+            paused = self.pending >= MAX_PENDING
+            self.pending -= read
+        if paused and self.pending < MAX_PENDING:
+            self.event_loop.update(self)
+        return read
+
+    def has_input(self):
+        """Returns whether reading will not wait, because bytes arrived or the other side shut its end down"""
+        return bool(self.input) or self.eof
+
+    def sendall(self, data):
+        """
+        Queues bytes to be sent, waiting while too many were not sent yet.
+        @param data: The bytes
+        @type data: bytearray or str or memoryview
+        @raise socket.error: If the connection failed or was closed.
+        """
+        data = data.tobytes() if isinstance(data, memoryview) else bytes(data)
+        with self.condition:
+            if self.broken or self.closing:
+                raise socket.error(errno.EPIPE, "Connection closed")
+            if not data:
+                return
+            self.output.append(data)
+            self.unsent += len(data)
+            started = self.unsent == len(data)
+        if started:
+            self.event_loop.update(self)
+        with self.condition:
+            while self.unsent > MAX_UNSENT and not self.broken:
+                self.condition.wait()
+            if self.broken:
+                raise socket.error(errno.EPIPE, "Connection closed")
+
+    def setsockopt(self, *arguments):
+        """Sets an option of the connection"""
+        self.connection.setsockopt(*arguments)
+
+    def fileno(self):
+        """Returns the descriptor of the connection"""
+        return self.descriptor
+
+    def shutdown(self, how):
+        """Fails the channel, waking up the workers waiting on it, like shutting a socket down would"""
+        self.fail()
+
+    def close(self):
+        """Closes the connection once everything queued was sent"""
+        with self.condition:
+            self.closing = True
+        self.event_loop.update(self)
+
+    def fail(self):
+        """Drops whatever was not sent, and wakes up the workers waiting on the channel"""
+        with self.condition:
+            self.broken = True
+            self.eof = True
+            self.closing = True
+            self.output.clear()
+            self.unsent = 0
+            self.condition.notify_all()
+        self.event_loop.update(self)
+
+    def wanted_events(self):
+        """Returns the events the connection should be polled for, with the condition held"""
+        events = 0
+        if not self.eof and self.pending < MAX_PENDING:
+            events |= EVENT_READ
+        if self.output:
+            events |= EVENT_WRITE
+        return events
+
+    def on_readable(self):
+        """Receives what arrived, called by the event loop.
+        Returns whether a worker should be scheduled to handle it"""
+        try:
+            data = self.connection.recv(RECEIVE_SIZE)
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            self.fail()
+            return self.schedule()
+        self.last_activity = time.time()
+        with self.condition:
+            if data:
+                if self.closing:
+                    # Nothing reads it anymore
+                    return False
+                self.input.append(data)
+                self.pending += len(data)
+            else:
+                self.eof = True
+            self.condition.notify_all()
+        return self.schedule()
+
+    def on_writable(self):
+        """Sends what is queued, called by the event loop"""
+        with self.condition:
+            while self.output:
+                chunk = self.output[0]
+                try:
+                    sent = self.connection.send(buffer(chunk, self.output_offset))
+                except socket.error as error:
+                    if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        break
+                    utils.log_message("ERROR", "Could not send: " + str(error))
+                    self.broken = True
+                    self.eof = True
+                    self.closing = True
+                    self.output.clear()
+                    self.unsent = 0
+                    break
+                self.last_activity = time.time()
+                self.output_offset += sent
+                self.unsent -= sent
+                if self.output_offset == len(chunk):
+                    self.output.popleft()
+                    self.output_offset = 0
+            self.condition.notify_all()
+
+    def is_done(self):
+        """Returns whether the connection can be closed, with nothing left to send and no worker on it"""
+        with self.condition:
+            return self.closing and not self.output and not self.scheduled
+
+    def schedule(self):
+        """Marks the session as scheduled, returns whether it was not scheduled already"""
+        with self.condition:
+            if self.scheduled or self.handler is None:
+                return False
+            self.scheduled = True
+            return True
+
+
+class EventLoop(object):
+    """
+    Server accepting and polling every connection from a single thread, with epoll when available and poll
+    otherwise. Sessions are handled by a bounded pool of workers, one packet at a time, and only while there
+    is something to handle, so idle sessions take no thread. Disk I/O happens in the workers, within the
+    handlers of the packets, so at most as many sessions as there are workers read or write files at once.
+
+    Sessions are handled by the same MessageHandler as the threaded server, and serve the same protocol, but
+    do not offer file striping, whose data connections need a thread of their own each.
+
+    The packet codecs block, so a worker is held for the whole of a packet, from its first byte to its last,
+    including the file it carries. As many slow uploads or downloads of large files as there are workers
+    stall every other session until one of them ends.
+
+    Connections past the sessions the admission control allows wait for a slot without being polled, and
+    sessions idle for too long fail as if their connection was lost. Logins waiting for the lease of their
+    directory block their worker, so another worker is started for as long as they wait, up to as many more
+    workers as the pool has. Past them waiting logins hold their worker.
+    """
+
+    def __init__(self, server_socket, options, store=None, workers=WORKERS, slots=None, idle_timeout=0):
+        """
+        Creates the event loop of a listening socket.
+        @param server_socket: The listening socket
+        @type server_socket: socket.socket
+        @param options: The ObjectSocket keyword arguments of every session
+        @type options: dict
+        @param store: The content store received files are deduplicated in, None to keep plain copies
+        @type store: ContentStore or None
+        @param workers: The number of workers handling packets
+        @type workers: int
+        @param slots: The admission control of the sessions, MAX_SESSIONS of them at once if None
+        @type slots: Admission or None
+        @param idle_timeout: The seconds a session may neither receive nor send anything, 0 for no limit
+        @type idle_timeout: float
+        """
+        super(EventLoop, self).__init__()
+        self.server_socket = server_socket
+        self.server_socket.setblocking(False)
+        self.options = dict(options)
+        # Sessions are written to from the workers, sendfile would skip ahead of what is queued
+        self.options["use_sendfile"] = False
+        self.options["read_buffer_size"] = SESSION_BUFFER_SIZE
+        self.store = store
+        self.supported = negotiation.without(negotiation.FILE_STRIPING)
+        self.slots = slots if slots is not None else admission.Admission(MAX_SESSIONS)
+        self.idle_timeout = idle_timeout
+        self.last_check = time.time()
+        self.poller = select.epoll() if hasattr(select, "epoll") else select.poll()
+        # Channels by descriptor
+        self.channels = {}
+        # Channels whose events changed, updated by the event loop once it is woken up
+        self.updated = set()
+        self.updated_lock = threading.Lock()
+        # Whether the listening socket is polled, it is not while there are too many open files
+        self.accepting = True
+        self.wake_read, self.wake_write = os.pipe()
+        self.tasks = Queue.Queue()
+        # Workers that waited for a lease, and were replaced by another worker while they did, up to max_replaced
+        self.replaced = set()
+        self.replaced_lock = threading.Lock()
+        self.max_replaced = max(1, workers)
+        for _ in range(max(1, workers)):
+            self._start_worker()
+
+    def serve_forever(self):
+        """Accepts and polls connections, never returns"""
+        self.poller.register(self.server_socket.fileno(), EVENT_READ)
+        self.poller.register(self.wake_read, EVENT_READ)
+        while True:
+            try:
+                events = self.poller.poll(admission.CHECK_INTERVAL)
+            except (select.error, IOError, OSError) as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            for descriptor, event in events:
+                if descriptor == self.server_socket.fileno():
+                    self._accept()
+                elif descriptor == self.wake_read:
+                    os.read(self.wake_read, 4096)
+                elif descriptor in self.channels:
+                    channel = self.channels[descriptor]
+                    if event & EVENT_WRITE:
+                        channel.on_writable()
+                    if event & (EVENT_READ | EVENT_CLOSED) and channel.on_readable():
+                        self.tasks.put(channel)
+                    self._refresh(channel)
+            with self.updated_lock:
+                updated = self.updated
+                self.updated = set()
+            for channel in updated:
+                if self.channels.get(channel.descriptor) is channel:
+                    self._refresh(channel)
+            if time.time() - self.last_check >= admission.CHECK_INTERVAL:
+                self._check()
+
+    def update(self, channel):
+        """
+        Has the event loop poll a channel for what it now needs, called from the workers.
+        @param channel: The channel
+        @type channel: Channel
+        """
+        with self.updated_lock:
+            wake = not self.updated
+            self.updated.add(channel)
+        if wake:
+            try:
+                os.write(self.wake_write, b"\0")
+            except OSError as _:
+                pass
+
+    def _accept(self):
+        """Accepts every pending connection, creating their sessions"""
+        while True:
+            try:
+                connection, _ = self.server_socket.accept()
+            except socket.error as error:
+                if error.errno in (errno.EMFILE, errno.ENFILE):
+                    utils.log_message("ERROR", "Too many open files, not accepting until a session ends")
+                    self.accepting = False
+                    self.poller.unregister(self.server_socket.fileno())
+                elif error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    utils.log_message("ERROR", "Could not accept: " + str(error))
+                return
+            ticket = self.slots.reserve(connection)
+            if ticket is None:
+                admission.shed(connection)
+            elif ticket[0]:
+                self._start(connection)
+
+    def _start(self, connection):
+        """Starts the session of an admitted connection"""
+        connection.setblocking(False)
+        channel = Channel(self, connection)
+        object_socket = ObjectSocket(channel, **self.options)
+        object_socket.FILE_BUFFER_SIZE = FILE_BUFFER_SIZE
+        handler = MessageHandler(object_socket, store=self.store, supported=self.supported)
+        handler.wait_hook = self._replace_worker
+        handler.bind_handlers()
+        channel.handler = handler
+        self.channels[channel.descriptor] = channel
+        self._refresh(channel)
+        if utils.DEBUG_LEVEL >= 1:
+            utils.log_message("DEBUG", "Started session " + str(len(self.channels)))
+
+    def _refresh(self, channel):
+        """Polls a channel for the events it needs, closing its connection once it is done.
+        Failed channels are handled by a worker, which ends their session"""
+        if channel.broken and channel.schedule():
+            self.tasks.put(channel)
+        if channel.is_done():
+            self._close(channel)
+            return
+        with channel.condition:
+            events = channel.wanted_events()
+        if events == channel.events:
+            return
+        if channel.events == 0:
+            self.poller.register(channel.descriptor, events)
+        elif events == 0:
+            self.poller.unregister(channel.descriptor)
+        else:
+            self.poller.modify(channel.descriptor, events)
+        channel.events = events
+
+    def _close(self, channel):
+        """Stops polling a channel and closes its connection"""
+        del self.channels[channel.descriptor]
+        if channel.events != 0:
+            self.poller.unregister(channel.descriptor)
+        try:
+            channel.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error as _:
+            pass
+        channel.connection.close()
+        if not self.accepting:
+            self.accepting = True
+            self.poller.register(self.server_socket.fileno(), EVENT_READ)
+        ticket = self.slots.release()
+        if ticket is not None:
+            self._start(ticket[2])
+
+    def _check(self):
+        """Sheds the connections that waited too long for a slot, and fails the sessions idle for too long"""
+        self.last_check = time.time()
+        for ticket in self.slots.expire():
+            admission.shed(ticket[2])
+        if self.idle_timeout <= 0:
+            return
+        idle_since = self.last_check - self.idle_timeout
+        for channel in list(self.channels.values()):
+            if channel.last_activity < idle_since and not channel.input and not channel.broken:
+                utils.log_message("WARN", "Session idle for " + str(self.idle_timeout) + " seconds, closing it")
+                channel.fail()
+                self._refresh(channel)
+
+    def _start_worker(self):
+        """Starts a worker"""
+        worker = threading.Thread(target=EventLoop._work, args=(self,))
+        worker.daemon = True
+        worker.start()
+
+    def _replace_worker(self):
+        """Starts a worker in place of the current one, about to wait for a lease, so the other sessions are
+        not held up. The current one stops once it handled its session. Past max_replaced workers waiting, the
+        current one is not replaced"""
+        with self.replaced_lock:
+            if len(self.replaced) >= self.max_replaced:
+                utils.log_message("WARN", "Too many workers waiting for leases, not replacing another")
+                return
+            self.replaced.add(threading.current_thread())
+        self._start_worker()
+
+    def _work(self):
+        """Handles the sessions scheduled by the event loop, until the server stops, or until the worker was
+        replaced"""
+        while True:
+            channel = self.tasks.get()
+            handler = channel.handler
+            try:
+                self._handle(channel)
+            except socket.error as error:
+                # The other side went away while sending to it, the directory is unlocked for its next session
+                utils.log_message("ERROR", "Connection lost (" + str(error) + "), logging out")
+                handler.disconnect()
+                channel.fail()
+                self._release(channel)
+            except Exception as error:
+                utils.log_message("ERROR", "Session failed: " + repr(error))
+                handler.disconnect()
+                channel.fail()
+                self._release(channel)
+            with self.replaced_lock:
+                if threading.current_thread() in self.replaced:
+                    self.replaced.remove(threading.current_thread())
+                    return
+
+    def _handle(self, channel):
+        """Handles the packets of a session while they are arriving, then leaves it until more arrive.
+        Errors end the session, they are handled by _work"""
+        handler = channel.handler
+        object_socket = handler.object_socket
+        while True:
+            if not channel.has_input() and not object_socket.has_input():
+                # Nothing else to do until more packets arrive
+                handler.idle()
+                object_socket.flush()
+                with channel.condition:
+                    if not channel.has_input():
+                        channel.scheduled = False
+                        return
+            packet_object = object_socket.receive_object()
+            if packet_object is None:
+                utils.log_message("ERROR", "Connection lost, logging out")
+                handler.disconnect()
+                channel.fail()
+                self._release(channel)
+                return
+            if handler.handle(packet_object) == -1:
+                utils.log_message("INFO", "Logging out")
+                object_socket.close()
+                self._release(channel)
+                return
+
+    def _release(self, channel):
+        """Leaves a session that ended, for the event loop to close its connection"""
+        with channel.condition:
+            channel.handler = None
+            channel.scheduled = False
+        self.update(channel)
@@ -0,0 +1,146 @@
+"""Server-side cache of the contents of the files sessions send, shared by every session"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import collections
+from files import File, Directory
+import os
+import packets
+import stat
+import threading
+import time
+
+# Default bytes the cache takes, 0 to not cache anything
+MAX_SIZE = 64 * 1048576
+# Files larger than this are never cached, they are sent with sendfile anyway
+MAX_FILE_SIZE = 1048576
+# Bytes each cached entry is accounted for on top of its contents
+ENTRY_OVERHEAD = 256
+# Files modified this recently may still be being written, their contents are not cached
+RACY_SECONDS = 2
+
+
+class FileCache(object):
+    """
+    Least recently used cache of the contents of the files sent by the server, so the popular ones many
+    sessions ask for are read from disk once, and stat'ed once per request. Entries are keyed by path and
+    validated against the mtime, size and inode of that stat, so files replaced by a rename or changed by
+    someone else are read again. Files written by a session are invalidated right away, the other workers of
+    a prefork server only see it through the stat.
+
+    Only files up to max_file_size are cached, and the entries take up to max_size bytes. Hits and misses
+    are counted, to size the cache.
+    """
+
+    def __init__(self, max_size=MAX_SIZE, max_file_size=MAX_FILE_SIZE):
+        """
+        Creates an empty cache.
+        @param max_size: The bytes the entries take at most
+        @type max_size: int
+        @param max_file_size: The size of the largest file whose contents are cached
+        @type max_file_size: int
+        """
+        super(FileCache, self).__init__()
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.lock = threading.Lock()
+        # path -> ((mtime, size, inode), contents), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # Lookups whose entry was cached and valid, and lookups that had to read the file
+        self.hits = 0
+        self.misses = 0
+
+    def file_info(self, path, abs_path):
+        """
+        Returns the info of a file or directory to be sent, stat'ing it once, with the file's contents
+        when they are cached or small enough to be.
+        @param path: The path relative to the synchronized directory
+        @type path: str
+        @param abs_path: The absolute path
+        @type abs_path: str
+        @return: The info, with its file wrapper, None if there is no such file or directory
+        @rtype: FileInfo or None
+        """
+        try:
+            stat_result = os.stat(abs_path)
+        except OSError as _:
+            return None
+        is_directory = stat.S_ISDIR(stat_result.st_mode)
+        last_modified = int(stat_result.st_mtime)
+        if is_directory:
+            return packets.FileInfo(path, True, last_modified, file_wrapper=Directory(abs_path, create=False))
+        size = int(stat_result.st_size)
+        return packets.FileInfo(path, False, last_modified, size, File(abs_path),
+                                contents=self.contents(abs_path, stat_result))
+
+    def contents(self, abs_path, stat_result):
+        """
+        Returns the contents of a file, from the cache if they did not change, reading and caching them if not.
+        @param abs_path: The absolute path of the file
+        @type abs_path: str
+        @param stat_result: A fresh stat of the file
+        @type stat_result: os.stat_result
+        @return: The contents, None if the file is too large to be cached, or changed while being read
+        @rtype: str or None
+        """
+        if self.max_size <= 0 or stat_result.st_size > self.max_file_size:
+            return None
+        key = (stat_result.st_mtime, stat_result.st_size, stat_result.st_ino)
+        with self.lock:
+            entry = self.entries.get(abs_path)
+            if entry is not None and entry[0] == key:
+                self.entries[abs_path] = self.entries.pop(abs_path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry is not None:
+                self._remove(abs_path)
+        try:
+            with open(abs_path, 'rb') as source:
+                contents = source.read(stat_result.st_size + 1)
+        except (IOError, OSError) as _:
+            return None
+        if len(contents) != stat_result.st_size:
+            # Changed since it was stat'ed
+            return None
+        if stat_result.st_mtime < time.time() - RACY_SECONDS:
+            self._add(abs_path, (key, contents))
+        return contents
+
+    def invalidate(self, abs_path):
+        """
+        Forgets a file, called whenever a session writes it.
+        @param abs_path: The absolute path of the file
+        @type abs_path: str
+        """
+        with self.lock:
+            if abs_path in self.entries:
+                self._remove(abs_path)
+
+    def summary(self):
+        """Returns a line with the hits, misses and size of the cache, to be logged"""
+        with self.lock:
+            return ("File cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " +
+                    str(len(self.entries)) + " files, " + str(self.size) + " of " + str(self.max_size) + " bytes")
+
+    def _add(self, abs_path, entry):
+        """Caches an entry, evicting the least recently used ones past max_size"""
+        with self.lock:
+            if abs_path in self.entries:
+                self._remove(abs_path)
+            self.entries[abs_path] = entry
+            self.size += self._entry_size(entry)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, abs_path):
+        """Removes an entry, with the lock held"""
+        self.size -= self._entry_size(self.entries.pop(abs_path))
+
+    @staticmethod
+    def _entry_size(entry):
+        """Returns the bytes an entry is accounted for"""
+        return ENTRY_OVERHEAD + len(entry[1])
@@ -0,0 +1,165 @@
+"""Compression of the file contents carried by send file packets"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import io
+import itertools
+import multiprocessing
+import os
+import struct
+import threading
+import zlib
+
+# Contents sent as they are
+NONE = "none"
+# Contents split in chunks compressed with zlib independently, so they can be compressed in parallel
+ZLIB = "zlib"
+
+# Supported codecs, most preferred first
+CODECS = [ZLIB, NONE]
+# Identifiers of the codecs on the wire
+CODEC_IDS = {NONE: 0, ZLIB: 1}
+CODEC_NAMES = dict((codec_id, name) for name, codec_id in CODEC_IDS.items())
+
+# Is compressed, stored length, followed by the stored chunk
+CHUNK_HEADER = struct.Struct(">?I")
+# Uncompressed size of every chunk but the last
+CHUNK_SIZE = 1048576
+
+# zlib level, favouring speed since most contents are compressed as they are sent
+ZLIB_LEVEL = 1
+# Files smaller than this are not worth the chunk headers
+MIN_SIZE = 512
+# Size of the sample compressed to guess if the rest compresses
+SAMPLE_SIZE = 65536
+# Samples compressing to more than this fraction of their size are not worth compressing
+MAX_RATIO = 0.9
+# Extensions of formats that are already compressed
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".jar", ".jpeg", ".jpg", ".m4a", ".mkv",
+    ".mov", ".mp3", ".mp4", ".ogg", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip",
+    ".zst",
+])
+# Files at least this large are compressed in the process pool, when there is one
+POOL_THRESHOLD = 8 * CHUNK_SIZE
+
+# Shared by every connection, created on the first large file
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def choose_codec(path, size, codec, contents=None):
+    """
+    Chooses how to send a file, skipping compression for small files, known compressed formats, and files whose
+    first bytes do not compress.
+    @param path: The path of the file
+    @type path: str
+    @param size: The size of the file
+    @type size: int
+    @param codec: The codec negotiated for the connection, one of CODECS
+    @type codec: str
+    @param contents: The contents of the file, if already in memory, sampled instead of the file
+    @type contents: str or None
+    @return: The codec for this file, one of CODECS
+    @rtype: str
+    """
+    if codec == NONE or size < MIN_SIZE:
+        return NONE
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return NONE
+    if contents is not None:
+        sample = contents[:SAMPLE_SIZE]
+    else:
+        with open(path, 'rb') as source:
+            sample = source.read(SAMPLE_SIZE)
+    if len(zlib.compress(sample, ZLIB_LEVEL)) > len(sample) * MAX_RATIO:
+        return NONE
+    return codec
+
+
+def compress_chunk(data):
+    """
+    Compresses a chunk, keeping it as it is if it does not get smaller.
+    @param data: The chunk
+    @type data: str
+    @return: Whether it was compressed, and the stored chunk
+    @rtype: (bool, str)
+    """
+    compressed = zlib.compress(data, ZLIB_LEVEL)
+    if len(compressed) >= len(data):
+        return False, data
+    return True, compressed
+
+
+def decompress_chunk(is_compressed, data):
+    """
+    Restores a chunk stored by compress_chunk.
+    @param is_compressed: Whether it was compressed
+    @type is_compressed: bool
+    @param data: The stored chunk
+    @type data: memoryview
+    @rtype: str or memoryview
+    """
+    if not is_compressed:
+        return data
+    return zlib.decompress(data.tobytes())
+
+
+def compressed_chunks(path, size, workers=0, offset=0, contents=None):
+    """
+    Generator of the stored chunks of a file from an offset, compressed in a process pool for large files if
+    workers > 0. Exactly size - offset bytes are read, padded if the file shrank, so the packet stays framed.
+    @param path: The path of the file
+    @type path: str
+    @param size: The size of the file, where reading stops
+    @type size: int
+    @param workers: The number of processes compressing chunks in parallel
+    @type workers: int
+    @param offset: The offset reading starts at
+    @type offset: int
+    @param contents: The contents of the file, if already in memory, read instead of the file
+    @type contents: str or None
+    @return: Whether each chunk was compressed, and the stored chunk
+    @rtype: generator of (bool, str)
+    """
+    with (open(path, 'rb') if contents is None else io.BytesIO(contents)) as source:
+        source.seek(offset)
+        raw_chunks = _read_chunks(source, size - offset)
+        if workers > 0 and size - offset >= POOL_THRESHOLD:
+            pool = _get_pool(workers)
+            # Only a window of chunks is read ahead, so large files are not read into memory at once
+            while True:
+                window = list(itertools.islice(raw_chunks, workers * 2))
+                if not window:
+                    break
+                for stored in pool.map(compress_chunk, window):
+                    yield stored
+        else:
+            for chunk in raw_chunks:
+                yield compress_chunk(chunk)
+
+
+def _read_chunks(source, size):
+    """Generator of the raw chunks of the first size bytes of an open file"""
+    remaining = size
+    while remaining > 0:
+        chunk = source.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            # The file shrank since its size was sent
+            chunk = b"\0" * min(CHUNK_SIZE, remaining)
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _get_pool(workers):
+    """Returns the process pool, creating it with the given number of processes"""
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            _pool = multiprocessing.Pool(workers)
+        return _pool
+    finally:
+        _pool_lock.release()
@@ -6,20 +6,29 @@
 
 import os
 import shutil
+import stat
 import tempfile
 import utils
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 class File(object):
     """Wrapper for low-level OS calls regarding files"""
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, directory=None):
         super(File, self).__init__()
         self.file = None
         if path is not None:
             self.path = path
         else:
-            temp = tempfile.mkstemp()
+            temp = tempfile.mkstemp(dir=directory)
             os.close(temp[0])
             self.path = temp[1]
             self.file = open(self.get_path(), 'w+b')
@@ -150,11 +159,11 @@ class File(object):
 class Directory(object):
     """Wrapper for low-level OS calls regarding directories"""
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, create=True):
         super(Directory, self).__init__()
         if path is not None:
             self.path = os.path.normpath(path)
-            if not os.path.exists(self.path):
+            if create and not os.path.exists(self.path):
                 os.makedirs(self.path)
         else:
             self.path = tempfile.mkdtemp()
@@ -201,11 +210,11 @@ class Directory(object):
 
     def list(self, recursive=True, directories_after_files=False):
         """Generator for this directory, containing files and directories"""
-        paths = os.listdir(self.get_path())
-        for path in paths:
-            abs_path = os.path.join(self.get_path(), path)
-            if os.path.isdir(abs_path):
-                directory = Directory(abs_path)
+        directory_path = self.get_path()
+        for name, stat_result in list_directory(directory_path):
+            abs_path = os.path.join(directory_path, name)
+            if stat.S_ISDIR(stat_result.st_mode):
+                directory = Directory(abs_path, create=False)
                 if not directories_after_files:
                     yield directory
                 if recursive:
@@ -216,6 +225,25 @@ class Directory(object):
             else:
                 yield File(abs_path)
 
+def list_directory(path):
+    """
+    Generator of (name, stat result) pairs for the entries of a directory, stat'ing each entry once.
+    Uses scandir when available, which reuses the entry type the OS returns with the listing.
+    Entries that disappear while being listed are skipped.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                yield entry.name, entry.stat()
+            except OSError as _:
+                pass
+    else:
+        for name in os.listdir(path):
+            try:
+                yield name, os.stat(os.path.join(path, name))
+            except OSError as _:
+                pass
+
 def get_wrapper(path):
     """Returns the correct wrapper for the given path"""
     if os.path.exists(path):
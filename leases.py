@@ -0,0 +1,219 @@
+"""Leases of the synchronized directories, held by one session at a time while the others wait for them in turn"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import collections
+import os
+import threading
+import time
+import utils
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Clients waiting for a directory are told their place in line and the estimated wait, with wait packets
+WAIT = "wait"
+# Clients waiting for a directory are not told anything, they only see their login taking longer
+NONE = "none"
+
+# Supported login wait modes, most preferred first
+MODES = [WAIT, NONE]
+
+# Default seconds a login waits for a directory before it is told the directory is busy
+WAIT_TIMEOUT = 60.0
+# Default seconds a lease lasts while its holder neither receives nor sends anything
+LEASE_TTL = 300.0
+# Default number of logins waiting for the same directory, past them logins are told it is busy right away
+MAX_WAITING = 16
+# Seconds a session is assumed to hold a directory for, until some sessions of it ended
+DEFAULT_DURATION = 5.0
+# Weight of the last session in the average time sessions hold a directory for
+DURATION_WEIGHT = 0.3
+# Seconds between checks of the lease of a directory, held by another process or expired, while waiting for it
+POLL_INTERVAL = 0.25
+
+
+class Lease(object):
+    """Lease of a directory by a session, valid until it is released or it expires"""
+
+    def __init__(self, path, holder, descriptor):
+        """
+        Creates a lease.
+        @param path: The path of the directory
+        @type path: str
+        @param holder: The message handler of the session holding it
+        @type holder: MessageHandler
+        @param descriptor: The lock file of the directory, flocked, None without fcntl
+        @type descriptor: int or None
+        """
+        super(Lease, self).__init__()
+        self.path = path
+        self.holder = holder
+        self.descriptor = descriptor
+        self.granted = time.time()
+
+
+class LeaseTable(object):
+    """
+    Leases of the directories being synchronized, one per directory. Logins of a directory whose lease is held
+    wait for it in the order they arrived, up to max_waiting of them and for up to timeout seconds, and are
+    told their place in line and the estimated wait, from how long the directory's sessions took before.
+
+    A lease also holds an exclusive flock on a file next to the directory ("user-directory.lock"), so the
+    workers of a prefork server share them, and the kernel releases the leases of a process that dies. Leases
+    whose holder did not receive or send anything for ttl seconds expire, their connection is shut down and the
+    next login in line gets the lease. Where fcntl is not available the leases only hold within the process.
+    """
+
+    SUFFIX = ".lock"
+
+    def __init__(self, timeout=WAIT_TIMEOUT, ttl=LEASE_TTL, max_waiting=MAX_WAITING):
+        """
+        Creates an empty lease table.
+        @param timeout: The seconds a login waits for a lease
+        @type timeout: float
+        @param ttl: The seconds a lease lasts while its holder is idle
+        @type ttl: float
+        @param max_waiting: The number of logins waiting for the same lease
+        @type max_waiting: int
+        """
+        super(LeaseTable, self).__init__()
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_waiting = max_waiting
+        self.condition = threading.Condition()
+        # Current lease of each directory being synchronized or waited for
+        self.leases = {}
+        # Logins waiting for each directory, [holder, deadline] lists
+        self.waiting = {}
+        # Average seconds the sessions of each directory held it for
+        self.durations = {}
+
+    def acquire(self, path, holder, on_wait=None):
+        """
+        Leases a directory, waiting for it in line if another session holds it.
+        @param path: The path of the directory
+        @type path: str
+        @param holder: The message handler of the session
+        @type holder: MessageHandler
+        @param on_wait: Called before waiting, with the place in line and the estimated seconds to wait
+        @type on_wait: (int, float) -> None
+        @return: The lease, None if the directory is still busy, or too many logins wait for it
+        @rtype: Lease or None
+        """
+        with self.condition:
+            waiting = self.waiting.setdefault(path, collections.deque())
+            if not waiting:
+                lease = self._grant(path, holder)
+                if lease is not None:
+                    self._forget_waiting(path)
+                    return lease
+            if len(waiting) >= self.max_waiting:
+                self._forget_waiting(path)
+                return None
+            waiter = [holder, time.time() + self.timeout]
+            waiting.append(waiter)
+            position = len(waiting)
+            estimate = self.estimate(path, position)
+        utils.log_message("INFO", "Directory busy, login waiting in place " + str(position) + ", about " +
+                          str(int(estimate)) + " seconds")
+        if on_wait is not None:
+            on_wait(position, estimate)
+        with self.condition:
+            try:
+                while True:
+                    if waiting[0] is waiter:
+                        lease = self._grant(path, holder)
+                        if lease is not None:
+                            return lease
+                    remaining = waiter[1] - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(min(remaining, POLL_INTERVAL))
+            finally:
+                waiting.remove(waiter)
+                self._forget_waiting(path)
+                self.condition.notify_all()
+
+    def release(self, lease):
+        """
+        Releases a lease, letting the next login in line have it. Leases that expired are left alone.
+        @param lease: The lease
+        @type lease: Lease
+        """
+        with self.condition:
+            if self.leases.get(lease.path) is not lease:
+                return
+            del self.leases[lease.path]
+            duration = time.time() - lease.granted
+            average = self.durations.get(lease.path)
+            self.durations[lease.path] = duration if average is None else \
+                average + DURATION_WEIGHT * (duration - average)
+            self._unlock(lease)
+            self.condition.notify_all()
+
+    def holds(self, lease):
+        """
+        Returns whether a lease is still valid, it did not expire.
+        @param lease: The lease
+        @type lease: Lease
+        @rtype: bool
+        """
+        with self.condition:
+            return self.leases.get(lease.path) is lease
+
+    def estimate(self, path, position):
+        """
+        Returns the estimated seconds a login waits for a directory, with the condition held.
+        @param path: The path of the directory
+        @type path: str
+        @param position: The place of the login in line
+        @type position: int
+        @rtype: float
+        """
+        duration = self.durations.get(path, DEFAULT_DURATION)
+        lease = self.leases.get(path)
+        held = time.time() - lease.granted if lease is not None else 0
+        return max(0.0, duration - held) + duration * (position - 1)
+
+    def _grant(self, path, holder):
+        """Leases a directory if it is free, or if its lease expired, with the condition held.
+        Returns None if it is not"""
+        lease = self.leases.get(path)
+        if lease is not None:
+            if lease.holder.object_socket.last_activity > time.time() - self.ttl:
+                return None
+            utils.log_message("WARN", "Lease of " + path + " expired, its session was idle for " +
+                              str(self.ttl) + " seconds")
+            lease.holder.shutdown()
+            # The flock is handed to the new holder
+            lease = Lease(path, holder, lease.descriptor)
+        else:
+            descriptor = None
+            if fcntl is not None:
+                descriptor = os.open(path + self.SUFFIX, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as _:
+                    # Held by another process
+                    os.close(descriptor)
+                    return None
+            lease = Lease(path, holder, descriptor)
+        self.leases[path] = lease
+        return lease
+
+    @staticmethod
+    def _unlock(lease):
+        """Releases the flock of a lease"""
+        if lease.descriptor is not None:
+            fcntl.flock(lease.descriptor, fcntl.LOCK_UN)
+            os.close(lease.descriptor)
+
+    def _forget_waiting(self, path):
+        """Removes the line of a directory once nobody waits in it, with the condition held"""
+        if not self.waiting.get(path, True):
+            del self.waiting[path]
@@ -0,0 +1,152 @@
+"""Encodings of the manifest entries sent at login, in login, tree listing and manifest block packets"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import byte_utils
+import os
+import struct
+import zlib
+
+# Every entry as in the login packet
+PLAIN = "plain"
+# Paths front-coded against the previous entry's, and timestamps as differences to the previous entry's
+FRONT_CODED = "front-coded"
+# FRONT_CODED, with the whole block compressed with zlib
+FRONT_CODED_ZLIB = "front-coded-zlib"
+
+# Supported encodings, most preferred first
+ENCODINGS = [FRONT_CODED_ZLIB, FRONT_CODED, PLAIN]
+# Identifiers of the encodings on the wire
+ENCODING_IDS = {PLAIN: 0, FRONT_CODED: 1, FRONT_CODED_ZLIB: 2}
+ENCODING_NAMES = dict((encoding_id, name) for name, encoding_id in ENCODING_IDS.items())
+
+# Path length, is directory, last modified, followed by the path, as in the login packet
+FILE_ENTRY = struct.Struct(">B?I")
+
+# Shared prefix length, suffix length, followed by the timestamp varint and the suffix
+FRONT_CODED_ENTRY = struct.Struct(">BB")
+
+# zlib level, the fastest, since manifests are encoded at every login
+ZLIB_LEVEL = 1
+
+
+def encode(files, encoding):
+    """
+    Encodes manifest entries.
+    @param files: The entries, sorted so that consecutive paths share long prefixes
+    @type files: list of FileInfo
+    @param encoding: One of ENCODINGS
+    @type encoding: str
+    @rtype: bytearray
+    """
+    if encoding == PLAIN:
+        return pack_entries(files)
+    body = _encode_front_coded(files)
+    if encoding == FRONT_CODED_ZLIB:
+        return bytearray(zlib.compress(bytes(body), ZLIB_LEVEL))
+    return body
+
+
+def decode(payload, encoding):
+    """
+    Decodes manifest entries.
+    @param payload: The encoded entries
+    @type payload: bytearray
+    @param encoding: One of ENCODINGS
+    @type encoding: str
+    @return: The (path, is_directory, last_modified) of each entry
+    @rtype: list of tuple
+    """
+    if encoding == PLAIN:
+        return unpack_entries(payload)
+    if encoding == FRONT_CODED_ZLIB:
+        payload = bytearray(zlib.decompress(bytes(payload)))
+    return _decode_front_coded(payload)
+
+
+def pack_entries(files):
+    """
+    Packs entries with the login packet's format into a single preallocated buffer.
+    @param files: The entries
+    @type files: list of FileInfo
+    @rtype: bytearray
+    """
+    size = FILE_ENTRY.size * len(files)
+    for file_info in files:
+        size += len(file_info.path)
+    body = bytearray(size)
+    offset = 0
+    for file_info in files:
+        path = file_info.path
+        FILE_ENTRY.pack_into(body, offset, len(path), file_info.is_directory, file_info.last_modified)
+        offset += FILE_ENTRY.size
+        body[offset:offset + len(path)] = path
+        offset += len(path)
+    return body
+
+
+def unpack_entries(payload):
+    """
+    Unpacks entries with the login packet's format, slicing the paths out of the payload.
+    @param payload: The packed entries
+    @type payload: bytearray
+    @return: The (path, is_directory, last_modified) of each entry
+    @rtype: list of tuple
+    """
+    files = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(payload):
+        path_length, is_directory, last_modified = FILE_ENTRY.unpack_from(payload, offset)
+        offset += FILE_ENTRY.size
+        files.append((view[offset:offset + path_length].tobytes(), is_directory, last_modified))
+        offset += path_length
+    return files
+
+
+def _encode_front_coded(files):
+    """
+    Encodes every entry as:
+        -> 1 byte for the length of the prefix shared with the previous path
+        -> 1 byte for the length of the rest of the path
+        -> varint of the zigzag encoded timestamp difference to the previous entry, shifted left by one bit,
+           with the lowest bit telling if it is a directory
+        -> The rest of the path
+    """
+    body = bytearray()
+    previous_path = ""
+    previous_modified = 0
+    for file_info in files:
+        path = file_info.path
+        shared = len(os.path.commonprefix([previous_path, path]))
+        delta = file_info.last_modified - previous_modified
+        zigzag = delta * 2 if delta >= 0 else -delta * 2 - 1
+        body.extend(FRONT_CODED_ENTRY.pack(shared, len(path) - shared))
+        body.extend(byte_utils.varint_to_bytes(zigzag << 1 | int(bool(file_info.is_directory))))
+        body.extend(path[shared:])
+        previous_path = path
+        previous_modified = file_info.last_modified
+    return body
+
+
+def _decode_front_coded(payload):
+    """Decodes entries encoded by _encode_front_coded"""
+    files = []
+    view = memoryview(payload)
+    offset = 0
+    previous_path = ""
+    previous_modified = 0
+    while offset < len(payload):
+        shared, suffix_length = FRONT_CODED_ENTRY.unpack_from(payload, offset)
+        value, offset = byte_utils.bytes_to_varint(payload, offset + FRONT_CODED_ENTRY.size)
+        zigzag = value >> 1
+        delta = zigzag // 2 if zigzag % 2 == 0 else -(zigzag + 1) // 2
+        path = previous_path[:shared] + view[offset:offset + suffix_length].tobytes()
+        offset += suffix_length
+        last_modified = previous_modified + delta
+        files.append((path, bool(value & 1), last_modified))
+        previous_path = path
+        previous_modified = last_modified
+    return files
@@ -0,0 +1,150 @@
+"""Persistent manifest of a synchronized directory, so logins do not have to walk the tree"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+from packets import FileInfo
+from reconciliation import sort_key
+import scanner
+import sqlite3
+import utils
+
+
+class ManifestIndex(object):
+    """
+    SQLite table holding the manifest of a directory. It lives next to the directory it describes
+    (never inside it, or it would be synchronized too) and is kept up to date as objects are received.
+    """
+
+    SUFFIX = ".index"
+    # Bump whenever the schema changes, forcing the index to be rebuilt from the directory
+    VERSION = 4
+    # Number of entries read at a time when iterating the index in order
+    BATCH_SIZE = 1024
+    # Number of pending updates after which they are committed
+    COMMIT_INTERVAL = 256
+
+    def __init__(self, directory, rebuild=False):
+        """
+        Opens the index of a directory, building it from the directory's contents if needed.
+        @param directory: The directory the index describes
+        @type directory: Directory
+        @param rebuild: Whether to discard an existing index, e.g. because the directory was just created
+        @type rebuild: bool
+        """
+        super(ManifestIndex, self).__init__()
+        self.directory = directory
+        self.path = directory.get_path() + self.SUFFIX
+        self.pending = 0
+        # The event server hands a session from worker to worker, though never to two of them at once
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.text_factory = str
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if rebuild or version != self.VERSION:
+            self.rebuild()
+
+    def rebuild(self):
+        """Drops the index and builds it again by walking the directory"""
+        utils.log_message("INFO", "Building manifest index for " + self.directory.get_path())
+        self.connection.execute("DROP TABLE IF EXISTS manifest")
+        self.connection.execute("CREATE TABLE manifest (path TEXT PRIMARY KEY, is_directory INTEGER NOT NULL, "
+                                "last_modified INTEGER NOT NULL, size INTEGER, sort_key BLOB NOT NULL, "
+                                "digest BLOB)")
+        self.connection.execute("CREATE INDEX manifest_order ON manifest (sort_key)")
+        self.connection.execute("CREATE INDEX manifest_digest ON manifest (digest)")
+        for file_info in scanner.scan(self.directory.get_path()):
+            self.update(file_info)
+        self.connection.execute("PRAGMA user_version = %d" % self.VERSION)
+        self.commit()
+
+    def files(self):
+        """
+        Returns the indexed manifest. Directories come after their contents, like in Directory.list.
+        @return: The manifest entries, without file wrappers
+        @rtype: list of FileInfo
+        """
+        # A path sorts before everything inside it, so descending order lists the contents first
+        cursor = self.connection.execute("SELECT path, is_directory, last_modified, size FROM manifest "
+                                         "ORDER BY path DESC")
+        return [FileInfo(path, bool(is_directory), last_modified, size)
+                for path, is_directory, last_modified, size in cursor]
+
+    def iterate_sorted(self):
+        """
+        Generator of the indexed manifest in the canonical order of reconciliation.sort_key.
+        Only a batch of entries is held at a time, and updates made meanwhile behind the iteration are not seen.
+        """
+        key = b""
+        while True:
+            rows = self.connection.execute("SELECT path, is_directory, last_modified, size FROM manifest "
+                                           "WHERE sort_key > ? ORDER BY sort_key LIMIT ?",
+                                           (sqlite3.Binary(key), self.BATCH_SIZE)).fetchall()
+            for path, is_directory, last_modified, size in rows:
+                yield FileInfo(path, bool(is_directory), last_modified, size)
+            if len(rows) < self.BATCH_SIZE:
+                return
+            key = sort_key(rows[-1][0])
+
+    def digest(self, path):
+        """
+        Returns the digest of the contents of an entry.
+        @param path: The entry's path relative to the directory
+        @type path: str
+        @return: The SHA-256 digest, None if it is not known
+        @rtype: str or None
+        """
+        row = self.connection.execute("SELECT digest FROM manifest WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return bytes(row[0])
+
+    def find(self, digest):
+        """
+        Returns the entries whose contents have a digest.
+        @param digest: The SHA-256 digest of the contents
+        @type digest: str
+        @return: The entries, without file wrappers
+        @rtype: list of FileInfo
+        """
+        cursor = self.connection.execute("SELECT path, last_modified, size FROM manifest WHERE digest = ?",
+                                         (sqlite3.Binary(digest),))
+        return [FileInfo(path, False, last_modified, size, digest=digest) for path, last_modified, size in cursor]
+
+    def update(self, file_info):
+        """
+        Adds or replaces an entry.
+        @param file_info: The entry, with its path relative to the directory, and its digest if known
+        @type file_info: FileInfo
+        """
+        digest = sqlite3.Binary(file_info.digest) if file_info.digest is not None else None
+        self.connection.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)",
+                                (file_info.path, int(file_info.is_directory), file_info.last_modified,
+                                 file_info.size, sqlite3.Binary(sort_key(file_info.path)), digest))
+        self._changed()
+
+    def remove(self, path):
+        """
+        Removes an entry.
+        @param path: The entry's path relative to the directory
+        @type path: str
+        """
+        self.connection.execute("DELETE FROM manifest WHERE path = ?", (path,))
+        self._changed()
+
+    def _changed(self):
+        """Commits the pending changes once there are enough of them"""
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """Commits the pending changes"""
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        """Commits the pending changes and closes the index"""
+        self.commit()
+        self.connection.close()
+
@@ -0,0 +1,180 @@
+"""Hash trees over directory metadata, letting logins skip the subtrees that did not change"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import hashlib
+import os
+import struct
+
+
+class HashTree(object):
+    """
+    Hash tree built from a manifest. Each entry is hashed over its name, type, timestamp and size,
+    and each directory's hash also covers the hashes of its contents, so two trees with the same
+    root hash hold the same metadata.
+    """
+
+    ROOT = ""
+
+    def __init__(self, files):
+        """
+        Builds the tree of a manifest.
+        @param files: The manifest entries, with paths relative to the directory
+        @type files: list of FileInfo
+        """
+        super(HashTree, self).__init__()
+        self.entries = {}
+        self.children = {self.ROOT: []}
+        for file_info in files:
+            self.entries[file_info.path] = file_info
+        for path in self.entries:
+            self.children.setdefault(os.path.dirname(path), []).append(path)
+
+        # Deeper paths first, so every directory is hashed after its contents
+        self.hashes = {}
+        for path in sorted(self.entries, key=lambda path: path.count(os.sep), reverse=True):
+            self.hashes[path] = self._hash_entry(self.entries[path])
+        self.hashes[self.ROOT] = self._hash_children(hashlib.sha1(), self.ROOT).digest()
+
+    def _hash_entry(self, file_info):
+        """Hashes an entry whose contents, if any, were already hashed"""
+        digest = hashlib.sha1()
+        digest.update(b"D" if file_info.is_directory else b"F")
+        digest.update(struct.pack(">IQ", file_info.last_modified, file_info.size or 0))
+        digest.update(os.path.basename(file_info.path))
+        if file_info.is_directory:
+            self._hash_children(digest, file_info.path)
+        return digest.digest()
+
+    def _hash_children(self, digest, path):
+        """Feeds the hashes of a directory's contents to the digest, in a canonical order"""
+        for child in sorted(self.children.get(path, [])):
+            digest.update(self.hashes[child])
+        return digest
+
+    def root_hash(self):
+        """Returns the hash of the whole tree"""
+        return self.hashes[self.ROOT]
+
+    def listing(self, path):
+        """
+        Returns the contents of a directory.
+        @param path: The directory's path, ROOT for the tree's root
+        @type path: str
+        @return: (entry, hash) pairs, empty if the directory is not in the tree
+        @rtype: list of tuple
+        """
+        if path != self.ROOT and not (path in self.entries and self.entries[path].is_directory):
+            return []
+        return [(self.entries[child], self.hashes[child]) for child in self.children.get(path, [])]
+
+    def subtree(self, path):
+        """
+        Generator of an entry and everything inside it, directories after their contents.
+        @param path: The entry's path
+        @type path: str
+        """
+        if self.entries[path].is_directory:
+            for child in self.children.get(path, []):
+                for file_info in self.subtree(child):
+                    yield file_info
+        yield self.entries[path]
+
+
+class TreeReconciler(object):
+    """
+    Compares the local hash tree with a remote one, a directory listing at a time, only descending
+    into directories whose hashes differ. Transfers are decided like in reconciliation.reconcile,
+    and directories are transferred after their contents.
+    """
+
+    def __init__(self, tree, request_object, send_object, query, done):
+        """
+        Creates a reconciler for the local tree.
+        @param tree: The local tree
+        @type tree: HashTree
+        @param request_object: Called with each remote FileInfo to be requested
+        @type request_object: function
+        @param send_object: Called with each local FileInfo to be sent
+        @type send_object: function
+        @param query: Called with the path of each remote directory whose listing is needed
+        @type query: function
+        @param done: Called once all the transfers were decided
+        @type done: function
+        """
+        super(TreeReconciler, self).__init__()
+        self.tree = tree
+        self.request_object = request_object
+        self.send_object = send_object
+        self.query = query
+        self.done = done
+        # Directory path -> number of its subdirectories still being compared
+        self.pending = {}
+        # Directory path -> transfer of the directory itself, run once its contents were compared
+        self.deferred = {}
+
+    def start(self, remote_root_hash):
+        """
+        Starts comparing from the root.
+        @param remote_root_hash: The root hash of the remote tree
+        @type remote_root_hash: str
+        """
+        if remote_root_hash == self.tree.root_hash():
+            self.done()
+        else:
+            self.query(HashTree.ROOT)
+
+    def receive_listing(self, path, remote_entries):
+        """
+        Compares the remote listing of a directory with the local one.
+        @param path: The directory's path
+        @type path: str
+        @param remote_entries: The remote (entry, hash) pairs of the directory
+        @type remote_entries: list of tuple
+        """
+        local_entries = {}
+        for file_info, digest in self.tree.listing(path):
+            local_entries[(file_info.path, file_info.is_directory)] = (file_info, digest)
+
+        descended = 0
+        for remote, remote_digest in remote_entries:
+            local, local_digest = local_entries.pop((remote.path, remote.is_directory), (None, None))
+            if local_digest == remote_digest:
+                continue
+            if local is None or remote > local:
+                action = (self.request_object, remote)
+            elif local > remote:
+                action = (self.send_object, local)
+            else:
+                action = None
+            if remote.is_directory:
+                self.deferred[remote.path] = action
+                self.query(remote.path)
+                descended += 1
+            elif action is not None:
+                action[0](action[1])
+
+        # Whatever is only on this side is sent as a whole
+        for local, _ in local_entries.values():
+            for file_info in self.tree.subtree(local.path):
+                self.send_object(file_info)
+
+        self.pending[path] = descended
+        if descended == 0:
+            self._finish(path)
+
+    def _finish(self, path):
+        """Transfers a directory whose contents were compared, then checks whether its parent is done"""
+        del self.pending[path]
+        if path == HashTree.ROOT:
+            self.done()
+            return
+        action = self.deferred.pop(path)
+        if action is not None:
+            action[0](action[1])
+        parent = os.path.dirname(path)
+        self.pending[parent] -= 1
+        if self.pending[parent] == 0:
+            self._finish(parent)
@@ -5,104 +5,444 @@
 # 82047 - Andre Mendes
 
 import os
-from files import Directory, get_wrapper
+import Queue
+import bundle
+import content_store
+import hashlib
+import delta
+from file_cache import FileCache
+from files import File, Directory, get_wrapper
+import leases
+from leases import LeaseTable
+from manifest_index import ManifestIndex
+from merkle import HashTree, TreeReconciler
+import negotiation
 import packets
+from reconciliation import reconcile, sort_key, ManifestMerger
+import socket
+import staging
+from staging import StagingArea
+from stat_cache import StatCache
+import striping
 import threading
 import utils
 
+# Login modes, see MessageHandler.do_login
+LOGIN_FLAT = "flat"
+LOGIN_TREE = "tree"
+LOGIN_STREAM = "stream"
+LOGIN_MODES = [LOGIN_FLAT, LOGIN_TREE, LOGIN_STREAM]
+
+# Packets waiting for the sender thread, handling incoming packets waits while there are this many
+OUTBOUND_QUEUE_SIZE = 64
+# Client files, client digests and deferred sends a session remembers to find the contents the client already
+# has, so huge manifests take bounded memory. Past them, files are sent whole
+MAX_CLIENT_FILES = 65536
+
 class MessageHandler(object):
     """Handles all the core functions for PyBox"""
-    # Do not allow simultaneous access to locked directories
-    locked_directories = []
-    locked_directories_lock = threading.Lock()
+    # Server side leases of the directories being synchronized, one session at a time
+    lease_table = LeaseTable()
+    # Server side cache of the contents of the files sent, shared by every session, disabled until the server sets it
+    file_cache = FileCache(0)
+    # Server side striped sessions, by token, for their data connections to attach to
+    sessions = {}
+    sessions_lock = threading.Lock()
 
-    def __init__(self, object_socket, thread=False):
+    def __init__(self, object_socket, thread=False, store=None, supported=None):
         super(MessageHandler, self).__init__()
         self.object_socket = object_socket
+        # Server side content store the received files are deduplicated in, None to keep plain copies
+        self.store = store
         self.directory = None
+        # Server side lease keeping other sessions, of this process or another, out of the directory
+        self.lease = None
+        # Server side function called before waiting for a lease, the event server starts another worker with it
+        self.wait_hook = None
+        self.index = None
+        self.options = negotiation.options({})
+        # Client side hash tree and server side comparison state, for tree logins
+        self.tree = None
+        self.tree_reconciler = None
+        # Server side merge state, for stream logins
+        self.manifest_merger = None
+        # Server side files whose signatures or hashes were requested but did not arrive yet, by path,
+        # the logout waits for them
+        self.pending_replies = {}
+        self.logout_deferred = False
+        # Server side files with a known digest, sent at the logout, once it is known which contents the client has
+        self.deferred_sends = []
+        # Server side last modified of the files the client listed, and paths of contents it hashed, by digest,
+        # up to MAX_CLIENT_FILES of each
+        self.client_files = {}
+        self.client_digests = {}
+        # Server side paths of the subtrees that are in sync with the client, for tree logins
+        self.client_subtrees = set()
+        # Small files and directories waiting to be sent together
+        self.bundle = bundle.Bundle()
+        # Client side stat cache, also caching the digests of file contents
+        self.stat_cache = None
+        # Server side (last modified, size, bytes received) of the files the client partially received before
+        self.client_partials = {}
+        # Data connections large files are striped across, when striping was negotiated
+        self.session = None
+        # Packets decoded by the receiver thread and packets waiting for the sender thread, while processing
+        self.inbound = None
+        self.outbound = None
+        # Features the server may choose, the event and prefork servers do not stripe files
+        self.supported = supported if supported is not None else negotiation.SUPPORTED
+        # Functions handling each packet, by packet class, created by bind_handlers
+        self.packet_actions = None
         if thread:
             thread = threading.Thread(target=MessageHandler.process, args=(self,))
             thread.daemon = True
             thread.start()
 
-    def do_login(self, user, directory):
-        """Creates a login packet and sends it to the ObjectSocket"""
+    def do_login(self, user, directory, scan_workers=0, login_mode=LOGIN_FLAT, preferences=None, data_streams=0,
+                 connect=None, negotiate=True):
+        """Creates a login packet and sends it to the ObjectSocket.
+        In the tree login mode only the root hash is sent, and directory listings are sent as the server asks.
+        In the stream login mode the manifest is sent in sorted blocks from another thread, so the
+        server's requests can be processed while it is still being sent.
+        Unless negotiate is False, features are negotiated first, preferring the values in preferences, and then
+        the server is told which files were partially received in a previous session. If striping was negotiated,
+        data_streams data connections are opened with connect, a function returning a new ObjectSocket connected
+        to the server. Returns False without logging in if the server did not reply to the negotiation, servers
+        older than it only take a flat login without negotiating, on a new connection"""
         utils.log_message("INFO", "Sending login")
+        if negotiate and not self.negotiate(preferences):
+            return False
+        if self.session is not None:
+            self.open_data_streams(data_streams, connect)
         self.directory = Directory(directory)
-        obj_list = []
-        for file_iterator in self.directory.list(directories_after_files=True):
-            obj_list.append(packets.FileInfo(\
-                path=file_iterator.get_relpath(self.directory.get_path()),\
-                file_wrapper=file_iterator))
-        login_packet = packets.LoginPacket(user, os.path.split(directory)[1], obj_list)
+        self.object_socket.staging = StagingArea(self.directory)
+        if self.options[negotiation.FILE_RESUME] == staging.RESUME:
+            for path, last_modified, size, offset in self.object_socket.staging.partials():
+                self.object_socket.send_object(packets.ResumePacket(path, (last_modified, size, offset)))
+        self.stat_cache = StatCache(self.directory, scan_workers)
+        obj_list = self.stat_cache.scan()
+        directory_name = os.path.split(directory)[1]
+        if login_mode == LOGIN_TREE:
+            self.tree = HashTree(obj_list)
+            login_packet = packets.TreeLoginPacket(user, directory_name, self.tree.root_hash())
+        elif login_mode == LOGIN_STREAM:
+            self.object_socket.send_object(packets.StreamLoginPacket(user, directory_name))
+            obj_list.sort(key=lambda info: sort_key(info.path))
+            thread = threading.Thread(target=MessageHandler.send_manifest, args=(self, obj_list))
+            thread.daemon = True
+            thread.start()
+            return True
+        else:
+            # Consecutive paths share long prefixes, for the manifest encoding
+            obj_list.sort(key=lambda info: info.path)
+            login_packet = packets.LoginPacket(user, directory_name, obj_list)
         self.object_socket.send_object(login_packet)
+        return True
 
-    def process(self):
-        """Processes the next message in queue. If no message is in queue,
-        it awaits until one is and then processes it"""
+    def negotiate(self, preferences=None):
+        """Offers the supported features to the server and waits for the ones it chose.
+        Returns False if the server closed the connection or did not reply within negotiation.REPLY_TIMEOUT"""
+        self.object_socket.send_object(packets.NegotiatePacket(negotiation.offer(preferences)))
+        self.object_socket.socket.settimeout(negotiation.REPLY_TIMEOUT)
+        try:
+            reply = self.object_socket.receive_object()
+        except socket.timeout as _:
+            reply = None
+        finally:
+            self.object_socket.socket.settimeout(None)
+        if reply is None:
+            utils.log_message("WARN", "The server did not reply to the negotiation")
+            return False
+        if isinstance(reply, packets.NegotiatePacket):
+            self.options = negotiation.options(reply.features)
+        elif isinstance(reply, packets.LogoutPacket) and reply.is_busy:
+            # Shed by a server handling too many sessions
+            raise socket.error("The server is busy")
+        else:
+            utils.log_message("ERROR", "The server replied to the negotiation with another packet, assuming defaults")
+        self.object_socket.manifest_encoding = self.options[negotiation.MANIFEST_ENCODING]
+        self.object_socket.file_compression = self.options[negotiation.FILE_COMPRESSION]
+        self.object_socket.file_resume = self.options[negotiation.FILE_RESUME]
+        if self.options[negotiation.FILE_STRIPING] == striping.STRIPED:
+            # The server follows with the token of the session
+            attach_packet = self.object_socket.receive_object()
+            if isinstance(attach_packet, packets.AttachPacket):
+                self.session = striping.StripedSession(attach_packet.token,
+                                                       self.options[negotiation.FILE_COMPRESSION])
+        if utils.DEBUG_LEVEL >= 1:
+            utils.log_message("DEBUG", "Negotiated options: " + str(self.options))
+        return True
 
-        def receive_login(login_packet):
-            """Receives a login packet and processes it, creating send_object
-            and request_object packets as needed to synchronize"""
+    def open_data_streams(self, count, connect):
+        """Opens data connections, attaching them to the session on both sides"""
+        for _ in range(min(count, striping.MAX_STREAMS)):
+            try:
+                data_socket = connect()
+            except Exception as error:
+                utils.log_message("WARN", "Could not open a data connection: " + str(error))
+                break
+            data_socket.send_object(packets.AttachPacket(self.session.token))
+            data_socket.flush()
+            self.session.attach(data_socket)
+            thread = threading.Thread(target=MessageHandler.serve_data_stream, args=(self.session, data_socket))
+            thread.daemon = True
+            thread.start()
+            self.session.threads.append(thread)
+        utils.log_message("INFO", "Opened " + str(len(self.session.streams)) + " data connections")
+
+    @staticmethod
+    def serve_data_stream(session, data_socket):
+        """Receives ranges from a data connection until it is closed"""
+        session.serve(data_socket)
+
+    def send_manifest(self, obj_list):
+        """Sends a sorted manifest in manifest block packets"""
+        block_size = packets.ManifestBlockPacket.BLOCK_SIZE
+        encoding = self.options[negotiation.MANIFEST_ENCODING]
+        for start in range(0, max(len(obj_list), 1), block_size):
+            is_last = start + block_size >= len(obj_list)
+            manifest_block_packet = packets.ManifestBlockPacket(obj_list[start:start + block_size], is_last, encoding)
+            self.object_socket.send_object(manifest_block_packet)
+        # The main thread may be blocked reading, so nobody else would send what is left in the buffer
+        self.object_socket.flush()
+
+    def bind_handlers(self):
+        """Creates the functions handling each packet, used by handle, idle and disconnect.
+        Called once, by process or by the event server, before the first packet is handled"""
 
-            def request_object(info):
-                """Creates a request file packet and sends it to the ObjectSocket"""
+        def use_delta(path):
+            """Whether a file that both sides have should be transferred as a delta, judging by the local version"""
+            if self.options[negotiation.FILE_DELTA] != delta.RSYNC:
+                return False
+            abs_path = os.path.join(self.directory.get_path(), path)
+            return os.path.isfile(abs_path) and os.path.getsize(abs_path) >= delta.MIN_SIZE
+
+        def use_content_hash():
+            """Whether the contents of files are identified by their digests, to avoid transferring contents
+            the other side already has"""
+            return self.options[negotiation.CONTENT_HASH] == content_store.SHA256
+
+        def remember_client_files(files):
+            """Remembers the files the client listed, which may be copied by the client instead of being sent,
+            up to MAX_CLIENT_FILES of them"""
+            if not use_content_hash():
+                return
+            for info in files:
+                if len(self.client_files) >= MAX_CLIENT_FILES:
+                    return
+                if not info.is_directory:
+                    self.client_files[info.path] = info.last_modified
+
+        def request_object(info):
+            """Creates a request file packet and sends it to the ObjectSocket.
+            Files with a large enough local version are requested as a delta, sending their signatures instead.
+            When content hashes were negotiated, the hash of other files is requested first, they are only
+            requested if their contents are neither stored nor in another file, e.g. because they were moved"""
+            if not info.is_directory and use_delta(info.path):
+                utils.log_message("INFO", "Requesting changes to file: " + info.path)
+                block_size, blocks = delta.signature(os.path.join(self.directory.get_path(), info.path))
+                self.pending_replies[info.path] = info
+                self.send_object(packets.SignaturePacket(info.path, block_size, blocks))
+                return
+            if not info.is_directory and use_content_hash():
+                utils.log_message("INFO", "Requesting hash of file: " + info.path)
+                self.pending_replies[info.path] = info
+                self.send_object(packets.RequestHashPacket(info.path))
+                return
+            request_file(info)
+
+        def request_file(info):
+            """Creates a request file packet and sends it to the ObjectSocket.
+            Files partially received before are requested from where they stopped"""
+            resume_point = None
+            if not info.is_directory and self.object_socket.file_resume == staging.RESUME:
+                received = self.object_socket.staging.resume_point(info.path, info.last_modified)
+                if received is not None:
+                    resume_point = (info.last_modified,) + received
+            if resume_point is not None:
+                utils.log_message("INFO", "Requesting file from byte " + str(resume_point[2]) + ": " + info.path)
+            else:
                 utils.log_message("INFO", "Requesting file/directory: " + info.path)
-                request_file_packet = packets.RequestFilePacket(info)
-                self.object_socket.send_object(request_file_packet)
+            self.send_object(packets.RequestFilePacket(info, resume_point))
 
-            def send_object(info):
-                """Creates a send object packet and sends it to the ObjectSocket"""
-                utils.log_message("INFO", "Sending file/directory: " + info.path)
-                send_file_packet = packets.SendFilePacket(info)
-                self.object_socket.send_object(send_file_packet)
+        def send_object(info):
+            """Creates a send object packet and sends it to the ObjectSocket.
+            Large enough files are sent as a delta, once the client sends the signatures of its version.
+            Files whose digest is known wait for the logout, by then the client may be known to have their contents"""
+            if not info.is_directory and use_delta(info.path):
+                utils.log_message("INFO", "Requesting signatures of file: " + info.path)
+                self.pending_replies[info.path] = info
+                self.send_object(packets.RequestSignaturePacket(info.path))
+                return
+            if not info.is_directory and use_content_hash():
+                info.digest = self.index.digest(info.path)
+                if info.digest is not None and len(self.deferred_sends) < MAX_CLIENT_FILES:
+                    self.deferred_sends.append(info)
+                    return
+            send_whole_object(info)
 
-            utils.log_message("INFO", "Receiving login")
-            self.directory = Directory(login_packet.username + "-" + login_packet.directory_name)
+        def client_source(digest):
+            """Returns the path of a file the client has with some contents, None if it is not known to have them"""
+            if digest in self.client_digests:
+                return self.client_digests[digest]
+            # Files with the same timestamp on both sides are in sync, like in reconcile
+            for candidate in self.index.find(digest):
+                if self.client_files.get(candidate.path) == candidate.last_modified:
+                    return candidate.path
+                path = candidate.path
+                while path:
+                    if path in self.client_subtrees:
+                        return candidate.path
+                    path = os.path.dirname(path)
+            return None
+
+        def send_deferred():
+            """Sends the files deferred by send_object, telling the client to copy the contents it already has"""
+            for info in self.deferred_sends:
+                source = client_source(info.digest)
+                if source is None:
+                    send_whole_object(info)
+                else:
+                    utils.log_message("INFO", "Sending copy of " + source + " as file: " + info.path)
+                    self.send_object(packets.CopyFilePacket(info, source))
+            self.deferred_sends = []
+
+        def send_whole_object(info):
+            """Creates a send file packet with the whole file/directory and sends it to the ObjectSocket.
+            The timestamp is the indexed one, files linked to the content store share their inode's"""
+            utils.log_message("INFO", "Sending file/directory: " + info.path)
+            abs_path = os.path.join(self.directory.get_path(), info.path)
+            cached = MessageHandler.file_cache.file_info(info.path, abs_path)
+            if cached is None:
+                utils.log_message("WARN", "Indexed file/directory is gone: " + info.path)
+                if self.index is not None:
+                    self.index.remove(info.path)
+                return
+            if info.last_modified is not None:
+                # The indexed mtime, without an index entry the local file's is sent
+                cached.last_modified = info.last_modified
+            send_file_info(cached, self.client_partials.get(info.path))
+
+        def send_file_info(info, resume_point=None):
+            """Sends a file/directory with its file wrapper, in the next bundle if it is small enough.
+            Files the other side partially received are sent from where it stopped, if they did not change since"""
+            if self.object_socket.file_resume == staging.NONE and not info.is_directory \
+                    and info.size > packets.MAX_LEGACY_SIZE:
+                utils.log_message("ERROR", "Files over 4 GB need file-resume to be negotiated, skipping: " +
+                                  info.path)
+                return
+            if self.options[negotiation.FILE_BUNDLE] == bundle.BUNDLE and bundle.Bundle.accepts(info):
+                self.bundle.add(info)
+                if self.bundle.is_full():
+                    flush_bundle()
+                return
+            offset = 0
+            if resume_point is not None and resume_point[:2] == (info.last_modified, info.size):
+                offset = min(resume_point[2], info.size)
+                utils.log_message("INFO", "Resuming file from byte " + str(offset) + ": " + info.path)
+            if offset == 0 and not info.is_directory and info.size >= striping.MIN_SIZE \
+                    and self.session is not None and self.session.can_send():
+                # Announced here, the ranges follow over the data connections
+                if utils.DEBUG_LEVEL >= 1:
+                    utils.log_message("DEBUG", "Striping file across data connections: " + info.path)
+                self.send_object(packets.StripePacket(self.session.send(info), info))
+                return
+            self.send_object(packets.SendFilePacket(info, offset))
+
+        def flush_bundle():
+            """Sends the files and directories waiting in the bundle, if any"""
+            if self.bundle.entries:
+                self.send_object(packets.BundlePacket(self.bundle.take()))
+
+        def send_logout():
+            """Tells the client that everything it needs was sent or requested.
+            Waits for the signatures and hashes requested first"""
+            if self.pending_replies:
+                self.logout_deferred = True
+                return
+            send_deferred()
+            flush_bundle()
+            logout_packet = packets.LogoutPacket(False, False)
+            self.send_object(logout_packet)
 
-            # If directory is already being synchronized, disconnect
-            directory_path = self.directory.get_path()
-            MessageHandler.locked_directories_lock.acquire()
-            if directory_path in MessageHandler.locked_directories:
-                MessageHandler.locked_directories_lock.release()
+        def resolve_reply(path):
+            """Forgets the reply awaited for a file, sending the deferred logout after the last one.
+            Returns the info of the file it was awaited for, None if it was not awaited"""
+            info = self.pending_replies.pop(path, None)
+            if not self.pending_replies and self.logout_deferred:
+                self.logout_deferred = False
+                send_logout()
+            return info
+
+        def open_directory(username, directory_name):
+            """Locks and indexes the directory being synchronized.
+            Returns False, after telling the client, if it is already being synchronized"""
+            directory_name = username + "-" + directory_name
+            new_directory = not os.path.isdir(directory_name)
+            self.directory = Directory(directory_name)
+
+            def on_wait(position, estimate):
+                """Tells the client its place in line, if it understands it"""
+                if self.options[negotiation.LOGIN_WAIT] == leases.WAIT:
+                    self.send_object(packets.WaitPacket(position, int(estimate)))
+                    if self.outbound is None:
+                        self.object_socket.flush()
+                if self.wait_hook is not None:
+                    self.wait_hook()
+
+            # If directory is still being synchronized after waiting for it in line, disconnect
+            self.lease = MessageHandler.lease_table.acquire(self.directory.get_path(), self, on_wait)
+            if self.lease is None:
                 logout_packet = packets.LogoutPacket(False, True)
-                self.object_socket.send_object(logout_packet)
+                self.send_object(logout_packet)
+                return False
+
+            self.index = ManifestIndex(self.directory, rebuild=new_directory)
+            self.object_socket.staging = StagingArea(self.directory)
+            return True
+
+        def close_directory():
+            """Closes the striped session, the staging area and the stat cache, and the index and lock of the
+            directory opened by open_directory, if any"""
+            close_session()
+            if self.object_socket.staging is not None:
+                if self.lease is None or MessageHandler.lease_table.holds(self.lease):
+                    # Unless the lease expired, and another session stages files there
+                    self.object_socket.staging.discard()
+                self.object_socket.staging.close()
+                self.object_socket.staging = None
+            if self.stat_cache is not None:
+                self.stat_cache.close()
+                self.stat_cache = None
+            if self.index is None:
+                return
+            self.index.close()
+            self.index = None
+            MessageHandler.lease_table.release(self.lease)
+            self.lease = None
+            if MessageHandler.file_cache.max_size > 0:
+                utils.log_message("INFO", MessageHandler.file_cache.summary())
+
+        def close_session():
+            """Closes the data connections of the striped session, if any, and forgets its token"""
+            if self.session is None:
+                return
+            MessageHandler.sessions_lock.acquire()
+            MessageHandler.sessions.pop(self.session.token, None)
+            MessageHandler.sessions_lock.release()
+            self.session.close()
+            self.session = None
+
+        def receive_login(login_packet):
+            """Receives a login packet and processes it, creating send_object
+            and request_object packets as needed to synchronize"""
+            utils.log_message("INFO", "Receiving login")
+            if not open_directory(login_packet.username, login_packet.directory_name):
                 return 0
-            else:
-                MessageHandler.locked_directories.append(directory_path)
-            MessageHandler.locked_directories_lock.release()
-
-            local_files = []
-            for file_iterator in self.directory.list(directories_after_files=True):
-                local_files.append(packets.FileInfo(\
-                    path=file_iterator.get_relpath(self.directory.get_path()),\
-                    file_wrapper=file_iterator))
-
-            request_files = []
-            send_files = []
-            for local in local_files:
-                found_match = False
-                for remote in login_packet.files:
-                    if remote == local:
-                        found_match = True
-                        if local > remote:
-                            send_files.append(local)
-                        break
-
-                if not found_match:
-                    send_files.append(local)
-
-            for remote in login_packet.files:
-                found_match = False
-                for local in local_files:
-                    if local == remote:
-                        found_match = True
-                        if remote > local:
-                            request_files.append(remote)
-                        break
-
-                if not found_match:
-                    request_files.append(remote)
+
+            local_files = self.index.files()
+            request_files, send_files = reconcile(local_files, login_packet.files)
+            remember_client_files(login_packet.files)
 
             for request in request_files:
                 request_object(request)
@@ -110,47 +450,302 @@ class MessageHandler(object):
             for send in send_files:
                 send_object(send)
 
-            logout_packet = packets.LogoutPacket(False, False)
-            self.object_socket.send_object(logout_packet)
+            send_logout()
+            return 0
+
+        def receive_tree_login(tree_login_packet):
+            """Receives a tree login packet and starts comparing hash trees from the root"""
+            utils.log_message("INFO", "Receiving tree login")
+            if not open_directory(tree_login_packet.username, tree_login_packet.directory_name):
+                return 0
+
+            def query(path):
+                """Creates a tree query packet and sends it to the ObjectSocket"""
+                if utils.DEBUG_LEVEL >= 1:
+                    utils.log_message("DEBUG", "Comparing directory: " + (path or "/"))
+                self.send_object(packets.TreeQueryPacket(path))
+
+            tree = HashTree(self.index.files())
+            self.tree_reconciler = TreeReconciler(tree, request_object, send_object, query, send_logout)
+            self.tree_reconciler.start(tree_login_packet.root_hash)
+            return 0
+
+        def receive_negotiate(negotiate_packet):
+            """Chooses the features to use from the ones the client offered, and replies with them"""
+            chosen = negotiation.choose(negotiate_packet.features, self.supported)
+            self.options = negotiation.options(chosen)
+            # Set before replying, the client only sends what depends on them once it has the reply
+            self.object_socket.manifest_encoding = self.options[negotiation.MANIFEST_ENCODING]
+            self.object_socket.file_compression = self.options[negotiation.FILE_COMPRESSION]
+            self.object_socket.file_resume = self.options[negotiation.FILE_RESUME]
+            self.send_object(packets.NegotiatePacket(chosen))
+            if self.options[negotiation.FILE_STRIPING] == striping.STRIPED:
+                self.session = striping.StripedSession(striping.new_token(),
+                                                       self.options[negotiation.FILE_COMPRESSION])
+                MessageHandler.sessions_lock.acquire()
+                MessageHandler.sessions[self.session.token] = self.session
+                MessageHandler.sessions_lock.release()
+                self.send_object(packets.AttachPacket(self.session.token))
+            return 0
+
+        def receive_wait(wait_packet):
+            """Tells the user the directory is being synchronized by another session, and the login waits for it"""
+            utils.log_message("INFO", "Directory being synchronized by another session, waiting in place " +
+                              str(wait_packet.position) + ", about " + str(wait_packet.estimate) + " seconds")
+            return 0
+
+        def receive_attach(attach_packet):
+            """Attaches this connection to the striped session it names, receiving ranges until it is closed"""
+            MessageHandler.sessions_lock.acquire()
+            session = MessageHandler.sessions.get(attach_packet.token)
+            MessageHandler.sessions_lock.release()
+            if session is None or not session.attach(self.object_socket):
+                utils.log_message("ERROR", "Data connection for an unknown or full session, closing it")
+                self.object_socket.close()
+            else:
+                # The session closes the connection, its thread sending ranges may still be using it
+                session.serve(self.object_socket)
+            return -1
+
+        def receive_stream_login(stream_login_packet):
+            """Receives a stream login packet and starts merging the manifest blocks that follow it"""
+            utils.log_message("INFO", "Receiving stream login")
+            if not open_directory(stream_login_packet.username, stream_login_packet.directory_name):
+                return 0
+            self.manifest_merger = ManifestMerger(self.index.iterate_sorted(), request_object, send_object)
+            return 0
+
+        def receive_manifest_block(manifest_block_packet):
+            """Merges the next block of a streamed manifest, sending the logout after the last one"""
+            if self.manifest_merger is None:
+                # The directory was busy, the client is still sending the manifest it started sending
+                return 0
+            remember_client_files(manifest_block_packet.files)
+            self.manifest_merger.feed(manifest_block_packet.files)
+            if manifest_block_packet.is_last:
+                self.manifest_merger.finish()
+                self.manifest_merger = None
+                send_logout()
+            return 0
+
+        def receive_tree_query(tree_query_packet):
+            """Replies to a tree query with the listing of the directory"""
+            path = tree_query_packet.path
+            tree_listing_packet = packets.TreeListingPacket(path, self.tree.listing(path))
+            self.send_object(tree_listing_packet)
+            return 0
+
+        def receive_tree_listing(tree_listing_packet):
+            """Compares the listing of a directory with the local one"""
+            remember_client_files([entry for entry, _ in tree_listing_packet.entries])
+            if use_content_hash():
+                # Entries with the same hash on both sides are in sync, with everything inside them
+                remote_hashes = dict((entry.path, digest) for entry, digest in tree_listing_packet.entries)
+                for local, digest in self.tree_reconciler.tree.listing(tree_listing_packet.path):
+                    if remote_hashes.get(local.path) == digest and len(self.client_subtrees) < MAX_CLIENT_FILES:
+                        self.client_subtrees.add(local.path)
+            self.tree_reconciler.receive_listing(tree_listing_packet.path, tree_listing_packet.entries)
             return 0
 
         def receive_request(request_file_packet):
             """Creates a send object packet and sends it to the ObjectSocket"""
             path = request_file_packet.file_info.path
             utils.log_message("INFO", "Received request to send file: " + path)
+            info = MessageHandler.file_cache.file_info(path, os.path.join(self.directory.get_path(), path))
+            if info is None:
+                utils.log_message("WARN", "Requested file/directory is gone: " + path)
+                return 0
+            send_file_info(info, request_file_packet.resume_point)
+            return 0
+
+        def receive_resume(resume_packet):
+            """Remembers a file the client partially received before, to send only the rest of it"""
+            self.client_partials[resume_packet.path] = resume_packet.resume_point
+            return 0
+
+        def receive_request_signature(request_signature_packet):
+            """Replies with the signatures of the local version of a file, none if there is no such file"""
+            path = request_signature_packet.path
             abs_path = os.path.join(self.directory.get_path(), path)
-            obj = get_wrapper(abs_path)
-            info = packets.FileInfo(path=path, file_wrapper=obj)
-            send_file_packet = packets.SendFilePacket(info)
-            self.object_socket.send_object(send_file_packet)
+            block_size, blocks = 0, []
+            if os.path.isfile(abs_path):
+                block_size, blocks = delta.signature(abs_path)
+            self.send_object(packets.SignaturePacket(path, block_size, blocks))
+            return 0
+
+        def receive_signature(signature_packet):
+            """Sends a file as the delta to the version whose signatures were received,
+            or whole when the other side has no version of it"""
+            path = signature_packet.path
+            obj = get_wrapper(os.path.join(self.directory.get_path(), path))
+            indexed = self.pending_replies.get(path)
+            last_modified = indexed.last_modified if indexed is not None else None
+            if not signature_packet.blocks or not isinstance(obj, File):
+                send_whole_object(packets.FileInfo(path, isinstance(obj, Directory), last_modified))
+            else:
+                utils.log_message("INFO", "Sending changes to file: " + path)
+                info = packets.FileInfo(path=path, last_modified=last_modified, file_wrapper=obj)
+                self.send_object(packets.DeltaPacket(info, signature_packet.block_size,
+                                                                   signature_packet.blocks))
+            resolve_reply(path)
+            return 0
+
+        def receive_request_hash(request_hash_packet):
+            """Replies with the hash of the contents of a file, none if there is no such file"""
+            path = request_hash_packet.path
+            abs_path = os.path.join(self.directory.get_path(), path)
+            info = packets.FileInfo(path, False)
+            if os.path.isfile(abs_path):
+                info = packets.FileInfo(path=path, file_wrapper=File(abs_path))
+                info.digest = self.stat_cache.digest(path)
+            self.send_object(packets.HashPacket(info))
+            return 0
+
+        def local_copy(digest):
+            """Returns the absolute path of an indexed file with some contents, None if there is none"""
+            for candidate in self.index.find(digest):
+                abs_path = os.path.join(self.directory.get_path(), candidate.path)
+                if os.path.isfile(abs_path) and os.path.getsize(abs_path) == candidate.size:
+                    return abs_path
+            return None
+
+        def receive_hash(hash_packet):
+            """Copies another file of the directory with the same contents, linking it to the store if there is
+            one, requesting the file otherwise.
+            Only contents this directory already has are reused: the store is shared by every user, and a digest
+            alone does not prove the client has the contents, so anything else is uploaded"""
+            info = hash_packet.file_info
+            if info.digest is not None:
+                if len(self.client_digests) < MAX_CLIENT_FILES:
+                    self.client_digests.setdefault(info.digest, info.path)
+                destination = os.path.join(self.directory.get_path(), info.path)
+                MessageHandler.file_cache.invalidate(destination)
+                source = local_copy(info.digest)
+                if source is not None and self.store is not None and self.store.contains(info.digest):
+                    # Every file of the synchronized directories is linked to the store
+                    utils.log_message("INFO", "Linking stored contents of file: " + info.path)
+                    self.store.link(info.digest, destination, self.object_socket.staging)
+                    self.index.update(info)
+                elif source is not None:
+                    utils.log_message("INFO", "Copying " + source + " as file: " + info.path)
+                    copy = self.object_socket.staging.new_copy(source)
+                    self.object_socket.staging.place_file(copy, destination)
+                    copy.set_timestamp(info.last_modified)
+                    self.index.update(info)
+                else:
+                    request_file(info)
+            resolve_reply(info.path)
             return 0
 
         def receive_object(send_file_packet):
             """Receives a send file packet, and processes it"""
-            info = send_file_packet.file_info
-            utils.log_message("INFO", "Receiving object: " + info.path)
-            info.file_wrapper.move(os.path.join(self.directory.get_path(), info.path))
-            info.file_wrapper.set_timestamp(info.last_modified)
+            utils.log_message("INFO", "Receiving object: " + send_file_packet.file_info.path)
+            place_object(send_file_packet.file_info)
+            return 0
+
+        def receive_delta(delta_packet):
+            """Places a file received as a delta. If the local version it was rebuilt from was gone, the file is
+            requested again in full when the logout waits for it, and left for the next session otherwise"""
+            info = delta_packet.file_info
+            if info.file_wrapper is not None:
+                receive_object(delta_packet)
+            elif info.path in self.pending_replies:
+                request_file(self.pending_replies[info.path])
+            else:
+                utils.log_message("WARN", "File left for the next session: " + info.path)
+            resolve_reply(info.path)
+            return 0
+
+        def receive_stripe(stripe_packet):
+            """Stages a file whose ranges arrive over the data connections, it is placed once they all arrived"""
+            info = stripe_packet.file_info
+            utils.log_message("INFO", "Receiving striped file: " + info.path)
+            info.file_wrapper = self.object_socket.staging.new_file(info.size)
+            info.file_wrapper.close()
+            self.session.expect(stripe_packet.transfer_id, info)
+            return 0
+
+        def place_stripes(wait=False):
+            """Places the striped files whose ranges all arrived, or waits for all of them to arrive"""
+            if self.session is None:
+                return
+            for info in self.session.take_completed(wait):
+                place_object(info)
+
+        def place_object(info):
+            """Moves a received file/directory into place, and indexes it"""
+            destination = os.path.join(self.directory.get_path(), info.path)
+            MessageHandler.file_cache.invalidate(destination)
+            if info.is_directory:
+                info.file_wrapper = self.object_socket.staging.place_directory(destination)
+            else:
+                self.object_socket.staging.place_file(info.file_wrapper, destination)
+            if self.store is not None and not info.is_directory:
+                info.digest, is_new = self.store.ingest(destination, self.object_socket.staging)
+                if is_new:
+                    info.file_wrapper.set_timestamp(info.last_modified)
+            else:
+                info.file_wrapper.set_timestamp(info.last_modified)
+                if self.index is not None and not info.is_directory and use_content_hash():
+                    info.digest = content_store.file_digest(destination)
+            if self.index is not None:
+                self.index.update(info)
             if utils.DEBUG_LEVEL >= 3:
                 utils.log_message("DEBUG", "Object has been moved to: " + str(info.file_wrapper.get_path()))
                 utils.log_message("DEBUG", "Timestamp has been set to: " + str(utils.format_timestamp(info.file_wrapper.get_timestamp())))
+
+        def receive_bundle(bundle_packet):
+            """Places the small files and directories of a bundle packet in bulk"""
+            if utils.DEBUG_LEVEL >= 1:
+                utils.log_message("DEBUG", "Receiving bundle of " + str(len(bundle_packet.entries)) + " objects")
+            root = self.directory.get_path()
+            entries = [(os.path.join(root, info.path), info, contents) for info, contents in bundle_packet.entries]
+            for destination, _, _ in entries:
+                MessageHandler.file_cache.invalidate(destination)
+            self.object_socket.staging.place_bundle(entries)
+            if self.index is None:
+                return 0
+            for destination, info, contents in entries:
+                if info.is_directory:
+                    pass
+                elif self.store is not None:
+                    info.digest = self.store.ingest(destination, self.object_socket.staging)[0]
+                elif use_content_hash():
+                    info.digest = hashlib.sha256(contents).digest()
+                self.index.update(info)
+            return 0
+
+        def receive_copy(copy_file_packet):
+            """Copies a file the server knows is here with the contents of another one"""
+            info = copy_file_packet.file_info
+            source = os.path.join(self.directory.get_path(), copy_file_packet.source)
+            if not os.path.isfile(source) or self.stat_cache.digest(copy_file_packet.source) != info.digest:
+                utils.log_message("WARN", "Could not copy " + copy_file_packet.source + " as file: " + info.path)
+                return 0
+            utils.log_message("INFO", "Copying " + copy_file_packet.source + " as file: " + info.path)
+            destination = os.path.join(self.directory.get_path(), info.path)
+            MessageHandler.file_cache.invalidate(destination)
+            copy = self.object_socket.staging.new_copy(source)
+            self.object_socket.staging.place_file(copy, destination)
+            copy.set_timestamp(info.last_modified)
             return 0
 
         def logout(logout_packet):
             """Receives a logout packet and terminates"""
             utils.log_message("INFO", "Received logout")
 
+            flush_bundle()
+            if self.session is not None:
+                # Everything striped has to arrive on both sides before the session ends
+                self.session.drain()
+                place_stripes(wait=True)
             if not logout_packet.is_reply:
                 out_logout_packet = packets.LogoutPacket(True, logout_packet.is_busy)
-                self.object_socket.send_object(out_logout_packet)
+                self.send_object(out_logout_packet)
 
             if logout_packet.is_busy:
                 utils.log_message("ERROR", "Another user is already synchronizing this directory...")
-            elif logout_packet.is_reply:
-                directory_path = self.directory.get_path()
-                MessageHandler.locked_directories_lock.acquire()
-                MessageHandler.locked_directories.remove(directory_path)
-                MessageHandler.locked_directories_lock.release()
+            close_directory()
 
             return -1
 
@@ -158,14 +753,158 @@ class MessageHandler(object):
             packets.LoginPacket: receive_login,
             packets.RequestFilePacket: receive_request,
             packets.SendFilePacket: receive_object,
-            packets.LogoutPacket: logout
+            packets.LogoutPacket: logout,
+            packets.TreeLoginPacket: receive_tree_login,
+            packets.TreeQueryPacket: receive_tree_query,
+            packets.TreeListingPacket: receive_tree_listing,
+            packets.StreamLoginPacket: receive_stream_login,
+            packets.ManifestBlockPacket: receive_manifest_block,
+            packets.NegotiatePacket: receive_negotiate,
+            packets.RequestSignaturePacket: receive_request_signature,
+            packets.SignaturePacket: receive_signature,
+            packets.DeltaPacket: receive_delta,
+            packets.RequestHashPacket: receive_request_hash,
+            packets.HashPacket: receive_hash,
+            packets.CopyFilePacket: receive_copy,
+            packets.BundlePacket: receive_bundle,
+            packets.ResumePacket: receive_resume,
+            packets.AttachPacket: receive_attach,
+            packets.StripePacket: receive_stripe,
+            packets.WaitPacket: receive_wait
         }
+        self.packet_actions = packet_actions
+        self.place_stripes = place_stripes
+        self.flush_bundle = flush_bundle
+        self.close_directory = close_directory
 
+    def handle(self, packet_object):
+        """Processes a packet with its handler.
+        Returns -1 once logged out, 0 otherwise"""
+        for packet_type in self.packet_actions:
+            if isinstance(packet_object, packet_type):
+                return self.packet_actions[packet_type](packet_object)
+        return 0
+
+    def idle(self):
+        """Called when no packet is waiting to be handled, places the striped files that arrived and sends
+        the bundle, the other side may be waiting for it"""
+        self.place_stripes()
+        self.flush_bundle()
+
+    def disconnect(self):
+        """Called when the connection is lost, closes the directory and unlocks it for its next session"""
+        self.close_directory()
+
+    def process(self):
+        """Processes the next message in queue. If no message is in queue,
+        it awaits until one is and then processes it.
+        Returns True once logged out, False if the connection was lost, the session failed or the directory was
+        busy. Sessions that did not log out are always disconnected, with their threads stopped and their
+        connection closed"""
+        self.bind_handlers()
+
+        def stop_pipelines(abort=False):
+            """Waits for the sender thread to send every queued packet and stops it.
+            When aborting, the connection is shut down first, and the packets still queued are discarded"""
+            if abort:
+                self.shutdown()
+            self.outbound.put(None)
+            sender.join()
+            self.outbound = None
+
+        self.inbound = Queue.Queue()
+        self.outbound = Queue.Queue(OUTBOUND_QUEUE_SIZE)
+        receiver = threading.Thread(target=MessageHandler.receive_packets, args=(self,))
+        receiver.daemon = True
+        receiver.start()
+        sender = threading.Thread(target=MessageHandler.send_packets, args=(self,))
+        sender.daemon = True
+        sender.start()
+
+        try:
+            while True:
+                if self.inbound.empty():
+                    # Nothing else to do until more packets arrive
+                    self.idle()
+                else:
+                    self.place_stripes()
+                packet_object = self.inbound.get()
+                if isinstance(packet_object, Exception):
+                    # Raised by the receiver thread while decoding
+                    raise packet_object
+                if packet_object is None:
+                    utils.log_message("ERROR", "Connection lost, logging out")
+                    return False
+                if self.handle(packet_object) == -1:
+                    utils.log_message("INFO", "Logging out")
+                    stop_pipelines()
+                    self.object_socket.flush()
+                    return isinstance(packet_object, packets.LogoutPacket) and not packet_object.is_busy
+        except socket.error as error:
+            # The other side went away while sending to it
+            utils.log_message("ERROR", "Connection lost (" + str(error) + "), logging out")
+            return False
+        except Exception as error:
+            # e.g. the disk failed, or a packet could not be decoded
+            utils.log_message("ERROR", "Session failed (" + repr(error) + "), logging out")
+            return False
+        finally:
+            if self.outbound is not None:
+                # The session did not log out, the directory is unlocked for its next session
+                try:
+                    stop_pipelines(abort=True)
+                    self.disconnect()
+                finally:
+                    self.object_socket.close()
+
+    def send_object(self, packet):
+        """Queues a packet for the sender thread, waiting while the outbound queue is full.
+        Packets are sent right away before process starts the sender thread, e.g. while logging in"""
+        if self.outbound is None:
+            self.object_socket.send_object(packet)
+        else:
+            self.outbound.put(packet)
+
+    def send_packets(self):
+        """Sends the packets queued by send_object until it gets None, flushing whenever the queue runs empty,
+        so sending files overlaps with receiving them. Once sending fails the rest are discarded, and the
+        connection is shut down for the receiver thread to notice"""
+        failed = False
         while True:
-            packet_object = self.object_socket.receive_object()
-            for packet_type in packet_actions:
-                if isinstance(packet_object, packet_type):
-                    if packet_actions[packet_type](packet_object) == -1:
-                        utils.log_message("INFO", "Logging out")
-                        return
-                    break
+            packet = self.outbound.get()
+            try:
+                if packet is None:
+                    return
+                if not failed:
+                    self.object_socket.send_object(packet)
+                    if self.outbound.empty():
+                        self.object_socket.flush()
+            except Exception as error:
+                # Lost connections, and files that could not be read, fail the session alike
+                utils.log_message("ERROR", "Could not send: " + str(error))
+                failed = True
+                self.shutdown()
+            finally:
+                self.outbound.task_done()
+
+    def receive_packets(self):
+        """Decodes packets into the inbound queue, so the other side's packets are read while process waits to
+        queue packets, and both sides can not stall sending to each other. Files are received into the staging
+        area as they are decoded. Stops after a logout packet, after an attach packet, whose data connection is
+        then read by the striped session, and once the connection is lost, queueing None, or the error raised"""
+        while True:
+            try:
+                packet = self.object_socket.receive_object()
+            except Exception as error:
+                self.inbound.put(error)
+                return
+            self.inbound.put(packet)
+            if packet is None or isinstance(packet, (packets.LogoutPacket, packets.AttachPacket)):
+                return
+
+    def shutdown(self):
+        """Shuts the connection down, waking up the threads blocked on it"""
+        try:
+            self.object_socket.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error as _:
+            pass
@@ -0,0 +1,121 @@
+"""Features negotiated between the client and the server before logging in"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import bundle
+import content_store
+import delta
+import file_codec
+import leases
+import manifest_codec
+import staging
+import striping
+
+# Encoding of the entries of streamed manifests
+MANIFEST_ENCODING = "manifest-encoding"
+# Compression of the contents of sent files
+FILE_COMPRESSION = "file-compression"
+# Transfer of the changes to files both sides have
+FILE_DELTA = "file-delta"
+# Hash of file contents, so the server can skip uploads of contents it already stores
+CONTENT_HASH = "content-hash"
+# Sending small files and directories together
+FILE_BUNDLE = "file-bundle"
+# 64 bit sizes, and resuming files whose transfer was interrupted
+FILE_RESUME = "file-resume"
+# Striping large files across data connections tied to the session
+FILE_STRIPING = "file-striping"
+# Telling waiting logins their place in line and the estimated wait
+LOGIN_WAIT = "login-wait"
+
+# Supported values of each feature, most preferred first
+SUPPORTED = {
+    MANIFEST_ENCODING: manifest_codec.ENCODINGS,
+    FILE_COMPRESSION: file_codec.CODECS,
+    FILE_DELTA: delta.MODES,
+    CONTENT_HASH: content_store.HASHES,
+    FILE_BUNDLE: bundle.MODES,
+    FILE_RESUME: staging.MODES,
+    FILE_STRIPING: striping.MODES,
+    LOGIN_WAIT: leases.MODES,
+}
+
+# Values assumed for features that were not negotiated
+DEFAULTS = {
+    MANIFEST_ENCODING: manifest_codec.PLAIN,
+    FILE_COMPRESSION: file_codec.NONE,
+    FILE_DELTA: delta.NONE,
+    CONTENT_HASH: content_store.NONE,
+    FILE_BUNDLE: bundle.NONE,
+    FILE_RESUME: staging.NONE,
+    FILE_STRIPING: striping.NONE,
+    LOGIN_WAIT: leases.NONE,
+}
+
+# Seconds the client waits for the server's negotiate packet. Servers older than it never reply, up to date ones
+# reply at once, unless the connection waits for a session to end (10 seconds by default, see admission)
+REPLY_TIMEOUT = 30
+
+
+def offer(preferences=None):
+    """
+    Returns the features offered by the client.
+    @param preferences: The value to offer first for some features
+    @type preferences: dict of str to str or None
+    @rtype: dict of str to list of str
+    """
+    offered = dict((name, list(values)) for name, values in SUPPORTED.items())
+    for name, value in (preferences or {}).items():
+        offered[name].remove(value)
+        offered[name].insert(0, value)
+    return offered
+
+
+def without(name):
+    """
+    Returns the supported values of each feature, with a feature limited to its default value, for servers
+    that can not offer it.
+    @param name: The feature
+    @type name: str
+    @rtype: dict of str to list of str
+    """
+    supported = dict(SUPPORTED)
+    supported[name] = [DEFAULTS[name]]
+    return supported
+
+
+def choose(offered, supported=None):
+    """
+    Chooses, for each offered feature that is supported, the first offered value that is supported.
+    @param offered: The offered values of each feature, most preferred first
+    @type offered: dict of str to list of str
+    @param supported: The supported values of each feature, SUPPORTED if None
+    @type supported: dict of str to list of str or None
+    @return: The chosen value of each feature, in the negotiate packet's format
+    @rtype: dict of str to list of str
+    """
+    if supported is None:
+        supported = SUPPORTED
+    chosen = {}
+    for name, values in offered.items():
+        for value in values:
+            if value in supported.get(name, []):
+                chosen[name] = [value]
+                break
+    return chosen
+
+
+def options(chosen):
+    """
+    Returns the negotiated options, with defaults for the features that were not negotiated.
+    @param chosen: The chosen value of each feature, in the negotiate packet's format
+    @type chosen: dict of str to list of str
+    @rtype: dict of str to str
+    """
+    result = dict(DEFAULTS)
+    for name, values in chosen.items():
+        if values:
+            result[name] = values[0]
+    return result
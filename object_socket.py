@@ -5,9 +5,28 @@
 # 82047 - Andre Mendes
 
 from packets import LoginPacket, RequestFilePacket, SendFilePacket, LogoutPacket
-from byte_utils import char_to_bytes, bytes_to_char
+from packets import TreeLoginPacket, TreeQueryPacket, TreeListingPacket
+from packets import StreamLoginPacket, ManifestBlockPacket, NegotiatePacket
+from packets import RequestSignaturePacket, SignaturePacket, DeltaPacket
+from packets import RequestHashPacket, HashPacket, CopyFilePacket, BundlePacket, ResumePacket
+from packets import AttachPacket, StripePacket, RangePacket, WaitPacket
+from byte_utils import char_to_bytes
+import file_codec
+import manifest_codec
+import socket as sockets
+import staging
+import threading
+import time
 import utils
 
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
 
 class ObjectSocket:
     """
@@ -16,54 +35,385 @@ class ObjectSocket:
     """
 
     # All the classes that the object socket knows how to receive.
-    PACKET_CLASSES = [LoginPacket, RequestFilePacket, SendFilePacket, LogoutPacket]
+    PACKET_CLASSES = [LoginPacket, RequestFilePacket, SendFilePacket, LogoutPacket,
+                      TreeLoginPacket, TreeQueryPacket, TreeListingPacket,
+                      StreamLoginPacket, ManifestBlockPacket, NegotiatePacket,
+                      RequestSignaturePacket, SignaturePacket, DeltaPacket,
+                      RequestHashPacket, HashPacket, CopyFilePacket, BundlePacket, ResumePacket,
+                      AttachPacket, StripePacket, RangePacket, WaitPacket]
+
+    # Default size of the output buffer, frames are coalesced until it is full or flushed
+    WRITE_BUFFER_SIZE = 65536
+    # Default size of the input buffer, small frames are parsed out of it without more system calls
+    READ_BUFFER_SIZE = 65536
+    # Size of the buffer files are read into when they can not be handed to the kernel with sendfile
+    FILE_BUFFER_SIZE = 1048576
 
-    def __init__(self, socket):
+    def __init__(self, socket, write_buffer_size=WRITE_BUFFER_SIZE, nodelay=True, cork=False,
+                 send_buffer_size=None, receive_buffer_size=None, read_buffer_size=READ_BUFFER_SIZE,
+                 use_sendfile=True, compression_workers=0):
         """
         Creates a new ObjectSocket.
         @param socket: The socket that the ObjectSocket will wrap.
         @type socket: socket.socket
+        @param write_buffer_size: The size of the output buffer, 0 to send every frame right away.
+        @type write_buffer_size: int
+        @param nodelay: Whether to disable Nagle's algorithm, frames are already coalesced by the output buffer.
+        @type nodelay: bool
+        @param cork: Whether to cork the socket between flushes (Linux only).
+        @type cork: bool
+        @param send_buffer_size: The kernel's send buffer size (SO_SNDBUF), None for the system default.
+        @type send_buffer_size: int or None
+        @param receive_buffer_size: The kernel's receive buffer size (SO_RCVBUF), None for the system default.
+        @type receive_buffer_size: int or None
+        @param read_buffer_size: The size of the input buffer.
+        @type read_buffer_size: int
+        @param use_sendfile: Whether to send files with sendfile when it is available
+                             (os.sendfile, or the pysendfile package on Python 2).
+        @type use_sendfile: bool
+        @param compression_workers: The number of processes compressing large files, 0 to compress them in the
+                                    thread sending them.
+        @type compression_workers: int
         """
         self.socket = socket
+        # Packets may be sent from more than one thread, e.g. while a manifest is streamed
+        self.send_lock = threading.Lock()
+        self.write_buffer_size = write_buffer_size
+        self.output = bytearray()
+        self.cork = cork and hasattr(sockets, "TCP_CORK")
+        # Received bytes not parsed yet are input[input_start:input_end]
+        self.input = bytearray(read_buffer_size)
+        self.input_view = memoryview(self.input)
+        self.input_start = 0
+        self.input_end = 0
+        self.use_sendfile = use_sendfile and sendfile is not None
+        # Reused by send_file when sendfile is not used, allocated on the first file sent
+        self.file_buffer = None
+        # Reused by receive_file, allocated on the first file received
+        self.receive_file_buffer = None
+        # Where received files are written, set once the synchronized directory is known
+        self.staging = None
+        # Encoding of the manifests of login and tree listing packets, set once it is negotiated
+        self.manifest_encoding = manifest_codec.PLAIN
+        # Compression of file contents, set once it is negotiated
+        self.file_compression = file_codec.NONE
+        # Whether sizes take 64 bits and files are sent from offsets, set once it is negotiated
+        self.file_resume = staging.NONE
+        # Striped session whose ranges this data connection receives, None for control connections
+        self.stripes = None
+        self.compression_workers = compression_workers
+        # When bytes were last received or sent, for servers closing idle sessions
+        self.last_activity = time.time()
+        if nodelay:
+            self.socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, 1)
+        if self.cork:
+            self.socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_CORK, 1)
+        if send_buffer_size is not None:
+            self.socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_SNDBUF, send_buffer_size)
+        if receive_buffer_size is not None:
+            self.socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, receive_buffer_size)
 
     def receive_object(self):
         """
         Reds a packet object from the socket.
         @return: A packet object, you can distinct them using #instanceof.
-                 None of nothing was read, probably because the connection was shutdown.
+                 None of nothing was read, because the connection was shutdown or broken mid packet.
         @rtype: LoginPacket or FileChangedPacket or RequestFilePacket or SendFilePacket
         """
 
-        # Read the header
-        header = bytearray(1)
-        bytes_read = self.socket.recv_into(header)
-        if bytes_read == 0:
+        # Whatever is still buffered may be what the other side is waiting for
+        self.flush(wait=False)
+
+        # Read the header, the connection may only be shutdown between packets
+        if self.input_start == self.input_end and self._receive() == 0:
             return None
+        packet_id = self.input[self.input_start]
+        self.input_start += 1
 
-        # Parse the packet id and decode it
-        packet_id = bytes_to_char(header)
+        # Parse the packet id and decode it, the packets read their bodies from the input buffer
         if utils.DEBUG_LEVEL >= 2:
             utils.log_message("DEBUG", "Packet id: " + str(packet_id))
         for clazz in self.PACKET_CLASSES:
             if packet_id == clazz.ID:
-                return clazz.decode(self.socket)
+                try:
+                    return clazz.decode(self)
+                except EOFError:
+                    utils.log_message("ERROR", "Connection closed in the middle of a packet")
+                    self.input_start = self.input_end
+                    return None
+        utils.log_message("ERROR", "Unknown packet id: " + str(packet_id))
         return None
 
+    def has_input(self):
+        """Returns whether there are received bytes that were not read yet, so reading will not block"""
+        return self.input_end > self.input_start
+
+    def read(self, nbytes):
+        """
+        Reads bytes out of the input buffer, receiving more as needed.
+        Only to be called by packets, while receive_object decodes them.
+        @param nbytes: The number of bytes to read.
+        @type nbytes: int
+        @return: A view of the bytes, only valid until the next read.
+        @rtype: memoryview
+        @raise EOFError: If the connection is shutdown before all bytes are received.
+        """
+        if self.input_end - self.input_start < nbytes:
+            self._fill(nbytes)
+        start = self.input_start
+        self.input_start += nbytes
+        return self.input_view[start:start + nbytes]
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        """
+        Fills a buffer with the next bytes, like socket.recv_into with MSG_WAITALL.
+        Bytes past what is already buffered are received straight into the buffer when there are many of them.
+        Only to be called by packets, while receive_object decodes them.
+        @param buffer: The buffer to be filled.
+        @type buffer: bytearray
+        @param nbytes: The number of bytes to read, 0 for the buffer's length.
+        @type nbytes: int
+        @param flags: Ignored, the bytes are always waited for.
+        @type flags: int
+        @return: The number of bytes read.
+        @rtype: int
+        @raise EOFError: If the connection is shutdown before all bytes are received.
+        """
+        nbytes = nbytes or len(buffer)
+        view = memoryview(buffer)
+        buffered = min(nbytes, self.input_end - self.input_start)
+        view[:buffered] = self.input_view[self.input_start:self.input_start + buffered]
+        self.input_start += buffered
+        offset = buffered
+        if nbytes - offset >= len(self.input):
+            while offset < nbytes:
+                bytes_read = self.socket.recv_into(view[offset:nbytes], nbytes - offset)
+                self.last_activity = time.time()
+                if bytes_read == 0:
+                    raise EOFError()
+                offset += bytes_read
+        elif offset < nbytes:
+            view[offset:nbytes] = self.read(nbytes - offset)
+        return nbytes
+
+    def receive_file(self, target, size):
+        """
+        Writes the next bytes to a file, the buffered ones first and then the rest through a reused buffer.
+        Only to be called by packets, while receive_object decodes them.
+        @param target: The open file
+        @type target: file
+        @param size: The number of bytes to write.
+        @type size: int
+        @raise EOFError: If the connection is shutdown before all bytes are received.
+        """
+        buffered = min(size, self.input_end - self.input_start)
+        if buffered > 0:
+            target.write(self.input_view[self.input_start:self.input_start + buffered])
+            self.input_start += buffered
+        remaining = size - buffered
+        if remaining == 0:
+            return
+        if self.receive_file_buffer is None:
+            self.receive_file_buffer = bytearray(self.FILE_BUFFER_SIZE)
+        view = memoryview(self.receive_file_buffer)
+        while remaining > 0:
+            received = self.socket.recv_into(view, min(len(view), remaining))
+            self.last_activity = time.time()
+            if received == 0:
+                raise EOFError()
+            target.write(view[:received])
+            remaining -= received
+
+    def _fill(self, nbytes):
+        """Receives until at least nbytes are buffered, moving them to the start of the buffer if they would not fit"""
+        if self.input_start + nbytes > len(self.input):
+            buffered = self.input_end - self.input_start
+            if nbytes > len(self.input):
+                self.input = self.input[self.input_start:self.input_end] + bytearray(nbytes - buffered)
+                self.input_view = memoryview(self.input)
+            else:
+                self.input[:buffered] = self.input[self.input_start:self.input_end]
+            self.input_start = 0
+            self.input_end = buffered
+        while self.input_end - self.input_start < nbytes:
+            if self._receive() == 0:
+                raise EOFError()
+
+    def _receive(self):
+        """Receives whatever the socket has into the free end of the input buffer"""
+        if self.input_start == self.input_end:
+            self.input_start = self.input_end = 0
+        bytes_read = self.socket.recv_into(self.input_view[self.input_end:])
+        self.last_activity = time.time()
+        self.input_end += bytes_read
+        return bytes_read
+
     def send_object(self, packet):
         """
         Sends a packet object down the socket.
         @param packet: The packet to be sent.
         @type packet: LoginPacket or FileChangedPacket or RequestFilePacket or SendFilePacket
         """
-        # Send the header
-        header = bytearray()
-        header.extend(char_to_bytes(packet.ID))
-        self.socket.send(header)
-        # The packets will send the body at their own pace
-        packet.send(self.socket)
+        self.send_lock.acquire()
+        try:
+            # Send the header
+            header = bytearray()
+            header.extend(char_to_bytes(packet.ID))
+            self.sendall(header)
+            # The packets will send the body at their own pace, through the output buffer
+            packet.send(self)
+        finally:
+            self.send_lock.release()
+
+    def sendall(self, data):
+        """
+        Buffers data to be sent, sending the buffer once it is full.
+        Data that does not fit tops the buffer up, so small frames never go out on their own, e.g. a header
+        followed by a large payload: the full buffer is sent, then the rest of the data if it would fill the buffer
+        again, buffering it otherwise. At most write_buffer_size bytes of the data are copied.
+        Only to be called by packets, while send_object holds the send lock.
+        @param data: The data to be sent.
+        @type data: bytearray or str or memoryview
+        """
+        if len(self.output) + len(data) <= self.write_buffer_size:
+            self.output += data
+            return
+        view = memoryview(data)
+        if self.output:
+            head = self.write_buffer_size - len(self.output)
+            self.output += view[:head]
+            view = view[head:]
+            self.socket.sendall(self.output)
+            self.output = bytearray()
+        if len(view) >= self.write_buffer_size:
+            self.socket.sendall(view)
+        else:
+            self.output += view
+        self.last_activity = time.time()
+
+    def flush(self, wait=True):
+        """
+        Sends whatever is buffered. Must be called before waiting for the other side, receive_object does it.
+        @param wait: Whether to wait for another thread sending a packet. If not waiting, that thread's
+                     own flush or next buffer overflow takes care of what is buffered.
+        @type wait: bool
+        """
+        if not self.send_lock.acquire(wait):
+            return
+        try:
+            if self.output:
+                self.socket.sendall(self.output)
+                self.last_activity = time.time()
+                self.output = bytearray()
+            if self.cork:
+                # Uncorking pushes out the last partial segment
+                self.socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_CORK, 0)
+                self.socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_CORK, 1)
+        finally:
+            self.send_lock.release()
+
+    def send_file(self, path, size, offset=0):
+        """
+        Sends the contents of a file from an offset, after whatever is buffered.
+        The kernel copies them straight from the file to the socket with sendfile when possible, otherwise they
+        are read into a reused buffer. Exactly size - offset bytes are sent, so the packet stays framed even if
+        the file changed size since its header was sent.
+        Only to be called by packets, while send_object holds the send lock.
+        @param path: The path of the file.
+        @type path: str
+        @param size: The size of the file, where sending stops.
+        @type size: int
+        @param offset: The offset sending starts at.
+        @type offset: int
+        """
+        if self.output:
+            self.socket.sendall(self.output)
+            self.last_activity = time.time()
+            self.output = bytearray()
+        source = open(path, 'rb')
+        try:
+            if self.use_sendfile:
+                sent = self._sendfile(source, size, offset)
+            else:
+                sent = self._send_buffered(source, size, offset)
+        finally:
+            source.close()
+        if sent < size:
+            utils.log_message("WARN", "File shrank while being sent, padding it: " + path)
+            self.socket.sendall(bytearray(size - sent))
+
+    def _sendfile(self, source, size, offset=0):
+        """Sends an open file with sendfile from offset up to size, returns the offset it stopped at"""
+        while offset < size:
+            sent = sendfile(self.socket.fileno(), source.fileno(), offset, size - offset)
+            self.last_activity = time.time()
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+    def _send_buffered(self, source, size, offset=0):
+        """Sends an open file through the reused file buffer from offset up to size, returns the offset it stopped at"""
+        if self.file_buffer is None:
+            self.file_buffer = bytearray(self.FILE_BUFFER_SIZE)
+        view = memoryview(self.file_buffer)
+        source.seek(offset)
+        while offset < size:
+            read = source.readinto(view[:min(len(view), size - offset)])
+            if not read:
+                break
+            self.socket.sendall(view[:read])
+            self.last_activity = time.time()
+            offset += read
+        return offset
 
     def close(self):
         """
-        Closes the socket.
+        Flushes and closes the socket.
         """
+        try:
+            self.flush()
+        except sockets.error as _:
+            # The other side is gone, what was buffered for it is dropped
+            pass
         self.socket.close()
+
+
+def add_transport_arguments(parser):
+    """
+    Adds the ObjectSocket transport options to a command line parser.
+    @param parser: The parser
+    @type parser: argparse.ArgumentParser
+    """
+    parser.add_argument("--write-buffer-size", type=int, default=ObjectSocket.WRITE_BUFFER_SIZE,
+                        help="bytes of small frames coalesced before sending them, 0 to disable")
+    parser.add_argument("--read-buffer-size", type=int, default=ObjectSocket.READ_BUFFER_SIZE,
+                        help="bytes received at once, small frames are parsed out of them")
+    parser.add_argument("--no-tcp-nodelay", dest="tcp_nodelay", action="store_false",
+                        help="keep Nagle's algorithm enabled")
+    parser.add_argument("--tcp-cork", action="store_true", help="cork the socket between flushes (Linux only)")
+    parser.add_argument("--no-sendfile", dest="sendfile", action="store_false",
+                        help="read files into a buffer instead of having the kernel send them with sendfile")
+    parser.add_argument("--compression-workers", type=int, default=0,
+                        help="processes compressing large files, when compression was negotiated")
+    parser.add_argument("--send-buffer-size", type=int, help="kernel send buffer size (SO_SNDBUF)")
+    parser.add_argument("--receive-buffer-size", type=int, help="kernel receive buffer size (SO_RCVBUF)")
+
+
+def transport_options(arguments):
+    """
+    Returns the ObjectSocket keyword arguments for the parsed transport options.
+    @param arguments: The arguments parsed by a parser given to add_transport_arguments
+    @type arguments: argparse.Namespace
+    @rtype: dict
+    """
+    return {
+        "write_buffer_size": arguments.write_buffer_size,
+        "read_buffer_size": arguments.read_buffer_size,
+        "nodelay": arguments.tcp_nodelay,
+        "cork": arguments.tcp_cork,
+        "send_buffer_size": arguments.send_buffer_size,
+        "receive_buffer_size": arguments.receive_buffer_size,
+        "use_sendfile": arguments.sendfile,
+        "compression_workers": arguments.compression_workers,
+    }
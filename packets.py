@@ -5,13 +5,85 @@
 # 82047 - Andre Mendes
 
 import byte_utils
+import content_store
+import delta
+import file_codec
 from files import File, Directory
+import manifest_codec
+import os
+import staging
+import struct
 import utils
-from socket import MSG_WAITALL
+
+# Length of the hashes of the hash tree (SHA-1)
+HASH_LENGTH = 20
+
+# Precompiled fixed parts of the packets, see protocol.txt
+# Username length, directory name length, files count
+LOGIN_HEADER = struct.Struct(">BBI")
+# Length of the encoded entries of login and tree listing packets, when a manifest encoding was negotiated
+ENTRIES_LENGTH = struct.Struct(">I")
+# Path length
+PATH_HEADER = struct.Struct(">B")
+# Username length, directory name length
+NAMES_HEADER = struct.Struct(">BB")
+# Length of a name or value, or count of features or values, of the negotiate packet
+NEGOTIATE_LENGTH = struct.Struct(">B")
+# Path length, is directory, last modified
+SEND_FILE_HEADER = manifest_codec.FILE_ENTRY
+# File size
+FILE_SIZE = struct.Struct(">I")
+# Largest file size that fits it
+MAX_LEGACY_SIZE = 2 ** 32 - 1
+# File size, offset of the contents sent, when resuming was negotiated
+RESUMABLE_FILE_SIZE = struct.Struct(">QQ")
+# Last modified, size and bytes received of a partial file, when resuming was negotiated
+RESUME_POINT = struct.Struct(">IQQ")
+# Codec of the file's contents, only when compression was negotiated
+FILE_CODEC = struct.Struct(">B")
+# Is reply, is busy
+LOGOUT = struct.Struct(">??")
+# Path length, entries count
+TREE_LISTING_HEADER = struct.Struct(">BI")
+# Name length, is directory, last modified, hash
+TREE_ENTRY = struct.Struct(">B?I%ds" % HASH_LENGTH)
+# Is last, encoding, payload length
+MANIFEST_BLOCK_HEADER = struct.Struct(">?BI")
+# Path length, block size, blocks count
+SIGNATURE_HEADER = struct.Struct(">BII")
+# Weak checksum, strong hash
+SIGNATURE_BLOCK = struct.Struct(">I%ds" % delta.STRONG_LENGTH)
+# File size, block size
+DELTA_HEADER = struct.Struct(">QI")
+# Instruction, followed by its arguments
+DELTA_INSTRUCTION = struct.Struct(">B")
+# First block, blocks count
+DELTA_COPY = struct.Struct(">II")
+# Literal length, followed by the literal
+DELTA_LITERAL = struct.Struct(">I")
+# Instruction ending the delta
+DELTA_END = 2
+# Path length, exists, last modified, file size
+FILE_HASH_HEADER = struct.Struct(">B?IQ")
+# Path length, source path length, last modified, file size
+COPY_FILE_HEADER = struct.Struct(">BBIQ")
+# Number of entries, codec, stored length of the entries
+BUNDLE_HEADER = struct.Struct(">IBI")
+# Path length, is directory, last modified, file size
+BUNDLE_ENTRY = struct.Struct(">B?II")
+# Token length
+ATTACH_HEADER = struct.Struct(">B")
+# Transfer id, path length, last modified, file size
+STRIPE_HEADER = struct.Struct(">IBIQ")
+# Transfer id, offset, length
+RANGE_HEADER = struct.Struct(">IQQ")
+# Place in line, estimated seconds to wait
+WAIT_HEADER = struct.Struct(">II")
 
 
 class FileInfo:
-    def __init__(self, path, is_directory=None, last_modified=None, size=None, file_wrapper=None):
+    def __init__(self, path, is_directory=None, last_modified=None, size=None, file_wrapper=None, digest=None,
+                 contents=None):
         """
         Creates a file info which will hold all the info of the file when sending and receiving packets (objects).
         @param path: The path of the file
@@ -24,6 +96,10 @@ class FileInfo:
         @type size: int or None
         @param file_wrapper: The file wrapper for io operations
         @type file_wrapper: File or Directory or None
+        @param digest: The SHA-256 digest of the file's content, if known
+        @type digest: str or None
+        @param contents: The file's content, if already in memory, sent instead of reading the file
+        @type contents: str or None
 
 
         @note If is_directory, last_modified, size are None and file_wrapper is not, all of these fields
@@ -34,6 +110,8 @@ class FileInfo:
         self.last_modified = last_modified
         self.size = size
         self.file_wrapper = file_wrapper
+        self.digest = digest
+        self.contents = contents
         if file_wrapper is not None:
             if is_directory is None:
                 self.is_directory = isinstance(file_wrapper, Directory)
@@ -75,33 +153,24 @@ class LoginPacket:
         """
         Sends the packet encoded over the socket.
         @param socket: The socket to send the packet to.
-        @type socket: socket.socket
-        """
-        body = bytearray()
-        body.extend(byte_utils.char_to_bytes(len(self.username)))
-        body.extend(byte_utils.char_to_bytes(len(self.directory_name)))
-        body.extend(byte_utils.unsigned_int_to_bytes(len(self.files)))
-        body.extend(byte_utils.string_to_bytes(self.username))
-        body.extend(byte_utils.string_to_bytes(self.directory_name))
+        @type socket: ObjectSocket
+        """
+        body = bytearray(LOGIN_HEADER.pack(len(self.username), len(self.directory_name), len(self.files)))
+        body.extend(self.username)
+        body.extend(self.directory_name)
+        if socket.manifest_encoding != manifest_codec.PLAIN:
+            payload = manifest_codec.encode(self.files, socket.manifest_encoding)
+            body.extend(ENTRIES_LENGTH.pack(len(payload)))
+            body.extend(payload)
+        else:
+            # Append all file info, packed at once
+            body.extend(manifest_codec.pack_entries(self.files))
         socket.sendall(body)
-        # Append all file info
-        for file_info in self.files:
-            body = bytearray()
-            body.extend(byte_utils.char_to_bytes(len(file_info.path)))
-            body.extend(byte_utils.boolean_to_bytes(file_info.is_directory))
-            body.extend(byte_utils.unsigned_int_to_bytes(file_info.last_modified))
-            body.extend(byte_utils.string_to_bytes(file_info.path))
-            socket.sendall(body)
 
     @staticmethod
     def decode(socket):
-        fixed = bytearray(6)
-        socket.recv_into(fixed, flags=MSG_WAITALL)
-        username_length = byte_utils.bytes_to_char(fixed, 0)
-        directory_name_length = byte_utils.bytes_to_char(fixed, 1)
-        files_count = byte_utils.bytes_to_unsigned_int(fixed, 2)
-        dynamic = bytearray(username_length + directory_name_length)
-        socket.recv_into(dynamic, flags=MSG_WAITALL)
+        username_length, directory_name_length, files_count = LOGIN_HEADER.unpack_from(socket.read(LOGIN_HEADER.size))
+        dynamic = socket.read(username_length + directory_name_length)
         username = byte_utils.bytes_to_string(dynamic, username_length, 0)
         directory_name = byte_utils.bytes_to_string(dynamic, directory_name_length, username_length)
         if utils.DEBUG_LEVEL >= 3:
@@ -112,19 +181,18 @@ class LoginPacket:
             utils.log_message("DEBUG", "Username: " + str(username))
             utils.log_message("DEBUG", "Directory name: " + str(directory_name))
             utils.log_message("DEBUG", "Files: ")
+        if socket.manifest_encoding != manifest_codec.PLAIN:
+            payload_length = ENTRIES_LENGTH.unpack_from(socket.read(ENTRIES_LENGTH.size))[0]
+            files = ManifestBlockPacket.receive_entries(socket, payload_length, socket.manifest_encoding)
+            return LoginPacket(username, directory_name, files)
         # Parse all file info
         files = []
         for count in range(files_count):
             if utils.DEBUG_LEVEL >= 2:
                 utils.log_message("DEBUG", "Waiting for file info " + str(count) + "/" + str(files_count))
-            fixed = bytearray(6)
-            socket.recv_into(fixed, flags=MSG_WAITALL)
-            file_path_length = byte_utils.bytes_to_char(fixed, 0)
-            file_is_directory = byte_utils.bytes_to_boolean(fixed, 1)
-            file_last_modified = byte_utils.bytes_to_unsigned_int(fixed, 2)
-            strings = bytearray(file_path_length)
-            socket.recv_into(strings, flags=MSG_WAITALL)
-            file_path = byte_utils.bytes_to_string(strings, file_path_length, 0)
+            fixed = socket.read(manifest_codec.FILE_ENTRY.size)
+            file_path_length, file_is_directory, file_last_modified = manifest_codec.FILE_ENTRY.unpack_from(fixed)
+            file_path = socket.read(file_path_length).tobytes()
             if utils.DEBUG_LEVEL >= 3:
                 utils.log_message("DEBUG", "File path length: " + str(file_path_length))
                 utils.log_message("DEBUG", "Is directory: " + str(file_is_directory))
@@ -139,129 +207,162 @@ class LoginPacket:
 class RequestFilePacket:
     ID = 1
 
-    def __init__(self, file_info):
+    def __init__(self, file_info, resume_point=None):
         """
         Creates a request file packet.
         @param file_info: The file to request.
                             (I will need from it the relative path)
         @type file_info: FileInfo
+        @param resume_point: The last modified (epoch), size and number of bytes already received of the version
+                             received before, to resume it if it is still the current one
+        @type resume_point: (int, int, int) or None
         """
         self.file_info = file_info
+        self.resume_point = resume_point
 
     def send(self, socket):
         """
         Sends the packet encoded over the socket.
         @param socket: The socket to send the packet to.
-        @type socket: socket.socket
+        @type socket: ObjectSocket
         """
-        body = bytearray()
         file_path = self.file_info.path
-        body.extend(byte_utils.char_to_bytes(len(file_path)))
-        body.extend(byte_utils.string_to_bytes(file_path))
+        body = bytearray(PATH_HEADER.pack(len(file_path)))
+        body.extend(file_path)
+        if socket.file_resume != staging.NONE:
+            body.extend(RESUME_POINT.pack(*(self.resume_point or (0, 0, 0))))
         socket.sendall(body)
 
     @staticmethod
     def decode(socket):
-        fixed = bytearray(1)
-        socket.recv_into(fixed, flags=MSG_WAITALL)
-        file_path_length = byte_utils.bytes_to_char(fixed, 0)
-        strings = bytearray(file_path_length)
-        socket.recv_into(strings, flags=MSG_WAITALL)
-        file_path = byte_utils.bytes_to_string(strings, file_path_length, 0)
+        file_path_length = PATH_HEADER.unpack_from(socket.read(PATH_HEADER.size))[0]
+        file_path = socket.read(file_path_length).tobytes()
+        resume_point = None
+        if socket.file_resume != staging.NONE:
+            resume_point = RESUME_POINT.unpack_from(socket.read(RESUME_POINT.size))
+            if resume_point[2] == 0:
+                resume_point = None
         if utils.DEBUG_LEVEL >= 3:
             utils.log_message("DEBUG", "Decoded request file packet: ")
             utils.log_message("DEBUG", "File path length: " + str(file_path_length))
             utils.log_message("DEBUG", "File Path: " + str(file_path))
-        packet = RequestFilePacket(FileInfo(file_path))
+            utils.log_message("DEBUG", "Resume point: " + str(resume_point))
+        packet = RequestFilePacket(FileInfo(file_path), resume_point)
         return packet
 
 
 class SendFilePacket:
     ID = 2
-    CHUNK_SIZE = 1024
 
-    def __init__(self, file_info):
+    def __init__(self, file_info, offset=0):
         """
         Creates a send file packet.
         @param file_info: The file to send.
                              (I will need from it the path, file descriptor, last modified (epoch), size)
         @type file_info: FileInfo
+        @param offset: The number of bytes of the file the other side already has, only when resuming was negotiated
+        @type offset: int
         """
         self.file_info = file_info
+        self.offset = offset
 
     def send(self, socket):
         """
         Sends the packet encoded over the socket.
         @param socket: The socket to send the packet to.
-        @type socket: socket.socket
+        @type socket: ObjectSocket
         """
-        body = bytearray()
         file_path = self.file_info.path
-        file_size = self.file_info.size
-        last_modified = self.file_info.last_modified
-        body.extend(byte_utils.char_to_bytes(len(file_path)))
-        body.extend(byte_utils.boolean_to_bytes(self.file_info.is_directory))
-        body.extend(byte_utils.unsigned_int_to_bytes(last_modified))
-        if not self.file_info.is_directory:
-            body.extend(byte_utils.unsigned_int_to_bytes(file_size))
-        body.extend(byte_utils.string_to_bytes(file_path))
+        body = bytearray(SEND_FILE_HEADER.pack(len(file_path), self.file_info.is_directory,
+                                               self.file_info.last_modified))
+        if not self.file_info.is_directory and socket.file_resume != staging.NONE:
+            body.extend(RESUMABLE_FILE_SIZE.pack(self.file_info.size, self.offset))
+        elif not self.file_info.is_directory:
+            body.extend(FILE_SIZE.pack(self.file_info.size))
+        body.extend(file_path)
+        if self.file_info.is_directory:
+            socket.sendall(body)
+            return
+        # append file's content from the offset, copied by the kernel when possible, or in compressed chunks.
+        # Contents already in memory are sent from there
+        source_path = self.file_info.file_wrapper.get_path()
+        contents = self.file_info.contents
+        codec = file_codec.NONE
+        if socket.file_compression != file_codec.NONE:
+            codec = file_codec.choose_codec(source_path, self.file_info.size - self.offset, socket.file_compression,
+                                            contents)
+            body.extend(FILE_CODEC.pack(file_codec.CODEC_IDS[codec]))
         socket.sendall(body)
-        # append file's content from file_info.file_wrapper.chunks() if is not
-        # directory
-        if not self.file_info.is_directory:
-            for chunk in self.file_info.file_wrapper.chunks(self.CHUNK_SIZE):
-                if utils.DEBUG_LEVEL >= 3:
-                    utils.log_message("DEBUG", "Chunk size: " + str(len(chunk)))
-                socket.sendall(chunk)
+        if codec == file_codec.NONE and contents is not None:
+            socket.sendall(memoryview(contents)[self.offset:self.file_info.size])
+            return
+        if codec == file_codec.NONE:
+            socket.send_file(source_path, self.file_info.size, self.offset)
+            return
+        for is_compressed, data in file_codec.compressed_chunks(source_path, self.file_info.size,
+                                                                socket.compression_workers, self.offset,
+                                                                contents):
+            socket.sendall(file_codec.CHUNK_HEADER.pack(is_compressed, len(data)))
+            socket.sendall(data)
 
     @staticmethod
     def decode(socket):
-        fixed = bytearray(6)
-        socket.recv_into(fixed, flags=MSG_WAITALL)
-        file_path_length = byte_utils.bytes_to_char(fixed, 0)
-        file_is_directory = byte_utils.bytes_to_boolean(fixed, 1)
-        file_last_modified = byte_utils.bytes_to_unsigned_int(fixed, 2)
+        fixed = socket.read(SEND_FILE_HEADER.size)
+        file_path_length, file_is_directory, file_last_modified = SEND_FILE_HEADER.unpack_from(fixed)
         file_size = None
-        if not file_is_directory:
-            fixed = bytearray(4)
-            socket.recv_into(fixed, flags=MSG_WAITALL)
-            file_size = byte_utils.bytes_to_unsigned_int(fixed, 0)
-        strings = bytearray(file_path_length)
-        socket.recv_into(strings, flags=MSG_WAITALL)
-        file_path = byte_utils.bytes_to_string(strings, file_path_length, 0)
+        offset = 0
+        if not file_is_directory and socket.file_resume != staging.NONE:
+            file_size, offset = RESUMABLE_FILE_SIZE.unpack_from(socket.read(RESUMABLE_FILE_SIZE.size))
+        elif not file_is_directory:
+            file_size = FILE_SIZE.unpack_from(socket.read(FILE_SIZE.size))[0]
+        file_path = socket.read(file_path_length).tobytes()
+        codec = file_codec.NONE
+        if not file_is_directory and socket.file_compression != file_codec.NONE:
+            codec = file_codec.CODEC_NAMES[FILE_CODEC.unpack_from(socket.read(FILE_CODEC.size))[0]]
         if utils.DEBUG_LEVEL >= 3:
             utils.log_message("DEBUG", "Decoded send file packet: ")
             utils.log_message("DEBUG", "File path length: " + str(file_path_length))
             utils.log_message("DEBUG", "Is directory: " + str(file_is_directory))
             utils.log_message("DEBUG", "Last modified: " + str(utils.format_timestamp(file_last_modified)))
             utils.log_message("DEBUG", "File size: " + str(file_size))
+            utils.log_message("DEBUG", "Offset: " + str(offset))
             utils.log_message("DEBUG", "File Path: " + str(file_path))
-        # parse file's contents to File().write() 1024 chunks if is not directory
+            utils.log_message("DEBUG", "Codec: " + str(codec))
+        # receive file's contents into the staging area if is not directory, directories are just created
+        # large files are received into partial files that are kept if the connection drops
+        file_wrapper = None
         if not file_is_directory:
-            chunk_size = min(SendFilePacket.CHUNK_SIZE, file_size)
-            remaining = file_size
-            file_wrapper = File()
-            received_bytes_acc = 0
-            while remaining > 0:
-                if utils.DEBUG_LEVEL >= 3:
-                    utils.log_message("DEBUG", "Chunk size: " + str(chunk_size))
-                chunk = bytearray(chunk_size)
-                received_bytes = socket.recv_into(chunk, flags=MSG_WAITALL)
-                received_bytes_acc += received_bytes
-                file_wrapper.write(chunk)
-                remaining -= received_bytes
-                chunk_size = min(chunk_size, remaining)
-            file_wrapper.close()
+            if socket.staging is not None and socket.file_resume != staging.NONE \
+                    and file_size >= staging.RESUME_MIN_SIZE:
+                file_wrapper = socket.staging.partial_file(file_path, file_last_modified, file_size, offset)
+            elif socket.staging is not None:
+                file_wrapper = socket.staging.new_file(file_size)
+            else:
+                file_wrapper = File()
+            try:
+                if codec == file_codec.NONE:
+                    socket.receive_file(file_wrapper.file, file_size - offset)
+                else:
+                    SendFilePacket.receive_chunks(socket, file_wrapper.file, file_size - offset)
+            finally:
+                file_wrapper.close()
             if utils.DEBUG_LEVEL >= 1:
-                utils.log_message("DEBUG", "File size is " + str(file_size) + " and received bytes are " + str(
-                    received_bytes_acc))
                 utils.log_message("DEBUG", "File is located in " + str(file_wrapper.get_path()))
-        else:
-            file_wrapper = Directory()
 
         packet = SendFilePacket(FileInfo(file_path, file_is_directory, file_last_modified, file_size, file_wrapper))
         return packet
 
+    @staticmethod
+    def receive_chunks(socket, target, file_size):
+        """Writes the file's contents out of the compressed chunks that follow"""
+        remaining = file_size
+        while remaining > 0:
+            is_compressed, stored_length = file_codec.CHUNK_HEADER.unpack_from(
+                socket.read(file_codec.CHUNK_HEADER.size))
+            data = file_codec.decompress_chunk(is_compressed, socket.read(stored_length))
+            target.write(data)
+            remaining -= len(data)
+
 
 class LogoutPacket:
     ID = 4
@@ -278,24 +379,856 @@ class LogoutPacket:
         self.is_busy = is_busy
 
     def send(self, socket):
-        body = bytearray()
-        body.extend(byte_utils.boolean_to_bytes(self.is_reply))
-        body.extend(byte_utils.boolean_to_bytes(self.is_busy))
-        socket.sendall(body)
+        socket.sendall(LOGOUT.pack(self.is_reply, self.is_busy))
 
     @staticmethod
     def decode(socket):
         if utils.DEBUG_LEVEL >= 3:
             utils.log_message("DEBUG", "Decode logout packet")
-        fixed = bytearray(2)
-        socket.recv_into(fixed, flags=MSG_WAITALL)
-        is_reply = byte_utils.bytes_to_boolean(fixed, 0)
-        is_busy = byte_utils.bytes_to_boolean(fixed, 1)
+        is_reply, is_busy = LOGOUT.unpack_from(socket.read(LOGOUT.size))
         if utils.DEBUG_LEVEL >= 3:
             utils.log_message("DEBUG", "Is reply: " + str(is_reply))
             utils.log_message("DEBUG", "Is busy: " + str(is_busy))
         return LogoutPacket(is_reply, is_busy)
 
+
+class TreeLoginPacket:
+    ID = 5
+
+    def __init__(self, username, directory_name, root_hash):
+        """
+        Creates a tree login packet, which starts a login comparing hash trees instead of full manifests.
+        @param username: The username of the user that is logging in.
+        @type username: str
+        @param directory_name: The name of the local directory that the user is syncing.
+        @type directory_name: str
+        @param root_hash: The root hash of the client's tree.
+        @type root_hash: str
+        """
+        self.username = username
+        self.directory_name = directory_name
+        self.root_hash = root_hash
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(NAMES_HEADER.pack(len(self.username), len(self.directory_name)))
+        body.extend(self.username)
+        body.extend(self.directory_name)
+        body.extend(self.root_hash)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        username_length, directory_name_length = NAMES_HEADER.unpack_from(socket.read(NAMES_HEADER.size))
+        dynamic = socket.read(username_length + directory_name_length + HASH_LENGTH)
+        username = byte_utils.bytes_to_string(dynamic, username_length, 0)
+        directory_name = byte_utils.bytes_to_string(dynamic, directory_name_length, username_length)
+        root_hash = byte_utils.bytes_to_string(dynamic, HASH_LENGTH, username_length + directory_name_length)
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded tree login packet: ")
+            utils.log_message("DEBUG", "Username: " + str(username))
+            utils.log_message("DEBUG", "Directory name: " + str(directory_name))
+        return TreeLoginPacket(username, directory_name, root_hash)
+
+
+class TreeQueryPacket:
+    ID = 6
+
+    def __init__(self, path):
+        """
+        Creates a tree query packet, asking for the listing of a directory of the hash tree.
+        @param path: The relative path of the directory, empty for the root.
+        @type path: str
+        """
+        self.path = path
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(PATH_HEADER.pack(len(self.path)))
+        body.extend(self.path)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        path_length = PATH_HEADER.unpack_from(socket.read(PATH_HEADER.size))[0]
+        path = socket.read(path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded tree query packet: ")
+            utils.log_message("DEBUG", "Path: " + str(path))
+        return TreeQueryPacket(path)
+
+
+class TreeListingPacket:
+    ID = 7
+
+    def __init__(self, path, entries):
+        """
+        Creates a tree listing packet, the reply to a tree query.
+        @param path: The relative path of the listed directory, empty for the root.
+        @type path: str
+        @param entries: The (entry, hash) pairs of the directory's contents.
+                        (From the entries I need the path, last modified (epoch), and if it's a directory)
+        @type entries: list of tuple
+        """
+        self.path = path
+        self.entries = entries
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(TREE_LISTING_HEADER.pack(len(self.path), len(self.entries)))
+        body.extend(self.path)
+        # Entries only carry their names, their paths are rebuilt from the listed directory
+        if socket.manifest_encoding != manifest_codec.PLAIN:
+            names = [FileInfo(os.path.basename(file_info.path), file_info.is_directory, file_info.last_modified)
+                     for file_info, _ in self.entries]
+            payload = manifest_codec.encode(names, socket.manifest_encoding)
+            body.extend(ENTRIES_LENGTH.pack(len(payload)))
+            body.extend(payload)
+            # The hashes follow the entries, they would not compress
+            for _, digest in self.entries:
+                body.extend(digest)
+            socket.sendall(body)
+            return
+        for file_info, digest in self.entries:
+            name = os.path.basename(file_info.path)
+            body.extend(TREE_ENTRY.pack(len(name), file_info.is_directory, file_info.last_modified, digest))
+            body.extend(name)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        path_length, entries_count = TREE_LISTING_HEADER.unpack_from(socket.read(TREE_LISTING_HEADER.size))
+        path = socket.read(path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded tree listing packet: ")
+            utils.log_message("DEBUG", "Path: " + str(path))
+            utils.log_message("DEBUG", "Entries count: " + str(entries_count))
+        if socket.manifest_encoding != manifest_codec.PLAIN:
+            payload_length = ENTRIES_LENGTH.unpack_from(socket.read(ENTRIES_LENGTH.size))[0]
+            names = ManifestBlockPacket.receive_entries(socket, payload_length, socket.manifest_encoding)
+            digests = bytearray(HASH_LENGTH * entries_count)
+            socket.recv_into(digests)
+            digests = bytes(digests)
+            entries = [(FileInfo(os.path.join(path, name.path), name.is_directory, name.last_modified),
+                        digests[index * HASH_LENGTH:(index + 1) * HASH_LENGTH])
+                       for index, name in enumerate(names)]
+            return TreeListingPacket(path, entries)
+        entries = []
+        for _ in range(entries_count):
+            name_length, is_directory, last_modified, digest = TREE_ENTRY.unpack_from(socket.read(TREE_ENTRY.size))
+            name = socket.read(name_length).tobytes()
+            entries.append((FileInfo(os.path.join(path, name), is_directory, last_modified), digest))
+        return TreeListingPacket(path, entries)
+
+
+class StreamLoginPacket:
+    ID = 8
+
+    def __init__(self, username, directory_name):
+        """
+        Creates a stream login packet, which starts a login whose manifest follows in manifest block packets.
+        @param username: The username of the user that is logging in.
+        @type username: str
+        @param directory_name: The name of the local directory that the user is syncing.
+        @type directory_name: str
+        """
+        self.username = username
+        self.directory_name = directory_name
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(NAMES_HEADER.pack(len(self.username), len(self.directory_name)))
+        body.extend(self.username)
+        body.extend(self.directory_name)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        username_length, directory_name_length = NAMES_HEADER.unpack_from(socket.read(NAMES_HEADER.size))
+        dynamic = socket.read(username_length + directory_name_length)
+        username = byte_utils.bytes_to_string(dynamic, username_length, 0)
+        directory_name = byte_utils.bytes_to_string(dynamic, directory_name_length, username_length)
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded stream login packet: ")
+            utils.log_message("DEBUG", "Username: " + str(username))
+            utils.log_message("DEBUG", "Directory name: " + str(directory_name))
+        return StreamLoginPacket(username, directory_name)
+
+
+class ManifestBlockPacket:
+    ID = 9
+    # Number of entries per block
+    BLOCK_SIZE = 1024
+
+    def __init__(self, files, is_last, encoding=manifest_codec.PLAIN):
+        """
+        Creates a manifest block packet, carrying the next entries of a streamed manifest.
+        @param files: The next entries, in the canonical order of reconciliation.sort_key.
+                      (From the files I need the relative path, last modified (epoch), and if it's a directory)
+        @type files: list of FileInfo
+        @param is_last: The boolean specifying if this block ends the manifest.
+        @type is_last: boolean
+        @param encoding: The encoding of the entries, one of manifest_codec.ENCODINGS.
+        @type encoding: str
+        """
+        self.files = files
+        self.is_last = is_last
+        self.encoding = encoding
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        payload = manifest_codec.encode(self.files, self.encoding)
+        body = bytearray(MANIFEST_BLOCK_HEADER.pack(self.is_last, manifest_codec.ENCODING_IDS[self.encoding],
+                                                    len(payload)))
+        body.extend(payload)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        fixed = socket.read(MANIFEST_BLOCK_HEADER.size)
+        is_last, encoding_id, payload_length = MANIFEST_BLOCK_HEADER.unpack_from(fixed)
+        encoding = manifest_codec.ENCODING_NAMES[encoding_id]
+        files = ManifestBlockPacket.receive_entries(socket, payload_length, encoding)
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded manifest block packet: ")
+            utils.log_message("DEBUG", "Is last: " + str(is_last))
+            utils.log_message("DEBUG", "Encoding: " + str(encoding))
+            utils.log_message("DEBUG", "Payload length: " + str(payload_length))
+            utils.log_message("DEBUG", "Files count: " + str(len(files)))
+        return ManifestBlockPacket(files, is_last, encoding)
+
+    @staticmethod
+    def receive_entries(socket, payload_length, encoding):
+        """Decodes the entries that follow, also those of login and tree listing packets when a manifest encoding
+        was negotiated"""
+        # Copied out of the input buffer, a large payload is received straight into its own buffer
+        payload = bytearray(payload_length)
+        socket.recv_into(payload)
+        return [FileInfo(path, is_directory, last_modified)
+                for path, is_directory, last_modified in manifest_codec.decode(payload, encoding)]
+
+
+class NegotiatePacket:
+    ID = 10
+
+    def __init__(self, features):
+        """
+        Creates a negotiate packet. The client sends the values it supports for each feature, most preferred
+        first, and the server replies with the single value it chose for each feature it supports too.
+        @param features: The values of each feature, by feature name.
+        @type features: dict of str to list of str
+        """
+        self.features = features
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(NEGOTIATE_LENGTH.pack(len(self.features)))
+        for name, values in self.features.items():
+            body.extend(NEGOTIATE_LENGTH.pack(len(name)))
+            body.extend(name)
+            body.extend(NEGOTIATE_LENGTH.pack(len(values)))
+            for value in values:
+                body.extend(NEGOTIATE_LENGTH.pack(len(value)))
+                body.extend(value)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+
+        def read_count():
+            """Reads a 1 byte length or count"""
+            return NEGOTIATE_LENGTH.unpack_from(socket.read(NEGOTIATE_LENGTH.size))[0]
+
+        def read_string():
+            """Reads a string preceded by its 1 byte length"""
+            return socket.read(read_count()).tobytes()
+
+        features_count = read_count()
+        features = {}
+        for _ in range(features_count):
+            name = read_string()
+            values_count = read_count()
+            features[name] = [read_string() for _ in range(values_count)]
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded negotiate packet: ")
+            utils.log_message("DEBUG", "Features: " + str(features))
+        return NegotiatePacket(features)
+
+class RequestSignaturePacket:
+    ID = 11
+
+    def __init__(self, path):
+        """
+        Creates a request signature packet, asking for the block signatures of the other side's version of a file,
+        so that the changes to it can be sent in a delta packet.
+        @param path: The relative path of the file.
+        @type path: str
+        """
+        self.path = path
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(PATH_HEADER.pack(len(self.path)))
+        body.extend(self.path)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        path_length = PATH_HEADER.unpack_from(socket.read(PATH_HEADER.size))[0]
+        path = socket.read(path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded request signature packet: ")
+            utils.log_message("DEBUG", "Path: " + str(path))
+        return RequestSignaturePacket(path)
+
+
+class SignaturePacket:
+    ID = 12
+
+    def __init__(self, path, block_size, blocks):
+        """
+        Creates a signature packet, asking for the changes to a file as a delta packet.
+        @param path: The relative path of the file.
+        @type path: str
+        @param block_size: The block size of the signatures.
+        @type block_size: int
+        @param blocks: The (weak checksum, strong hash) of every block of the file, empty if it does not exist.
+        @type blocks: list of tuple
+        """
+        self.path = path
+        self.block_size = block_size
+        self.blocks = blocks
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(SIGNATURE_HEADER.size + len(self.path) + SIGNATURE_BLOCK.size * len(self.blocks))
+        SIGNATURE_HEADER.pack_into(body, 0, len(self.path), self.block_size, len(self.blocks))
+        offset = SIGNATURE_HEADER.size
+        body[offset:offset + len(self.path)] = self.path
+        offset += len(self.path)
+        for weak, strong in self.blocks:
+            SIGNATURE_BLOCK.pack_into(body, offset, weak, strong)
+            offset += SIGNATURE_BLOCK.size
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        path_length, block_size, blocks_count = SIGNATURE_HEADER.unpack_from(socket.read(SIGNATURE_HEADER.size))
+        path = socket.read(path_length).tobytes()
+        blocks = []
+        for _ in range(blocks_count):
+            blocks.append(SIGNATURE_BLOCK.unpack_from(socket.read(SIGNATURE_BLOCK.size)))
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded signature packet: ")
+            utils.log_message("DEBUG", "Path: " + str(path))
+            utils.log_message("DEBUG", "Block size: " + str(block_size))
+            utils.log_message("DEBUG", "Blocks count: " + str(blocks_count))
+        return SignaturePacket(path, block_size, blocks)
+
+
+class DeltaPacket:
+    ID = 13
+
+    def __init__(self, file_info, block_size, blocks=None):
+        """
+        Creates a delta packet, sending a file as the instructions that rebuild it out of the blocks of the
+        other side's version.
+        @param file_info: The file to send.
+                             (I will need from it the path, file descriptor, last modified (epoch), size)
+        @type file_info: FileInfo
+        @param block_size: The block size of the other side's signatures.
+        @type block_size: int
+        @param blocks: The other side's signatures, only needed to send the packet.
+        @type blocks: list of tuple or None
+        """
+        self.file_info = file_info
+        self.block_size = block_size
+        self.blocks = blocks
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket, computing the instructions as they are sent.
+        Literals are compressed with the negotiated file compression, like the chunks of send file packets.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        file_path = self.file_info.path
+        body = bytearray(SEND_FILE_HEADER.pack(len(file_path), False, self.file_info.last_modified))
+        body.extend(DELTA_HEADER.pack(self.file_info.size, self.block_size))
+        body.extend(file_path)
+        socket.sendall(body)
+        source_path = self.file_info.file_wrapper.get_path()
+        for instruction in delta.compute(source_path, self.block_size, self.blocks):
+            if instruction[0] == delta.COPY:
+                socket.sendall(DELTA_INSTRUCTION.pack(delta.COPY) + DELTA_COPY.pack(instruction[1], instruction[2]))
+            else:
+                literal = instruction[1]
+                header = DELTA_INSTRUCTION.pack(delta.LITERAL) + DELTA_LITERAL.pack(len(literal))
+                if socket.file_compression != file_codec.NONE:
+                    is_compressed = False
+                    if len(literal) >= file_codec.MIN_SIZE:
+                        is_compressed, literal = file_codec.compress_chunk(literal)
+                    header += file_codec.CHUNK_HEADER.pack(is_compressed, len(literal))
+                socket.sendall(header)
+                socket.sendall(literal)
+        socket.sendall(DELTA_INSTRUCTION.pack(DELTA_END))
+
+    @staticmethod
+    def decode(socket):
+        fixed = socket.read(SEND_FILE_HEADER.size)
+        file_path_length, _, file_last_modified = SEND_FILE_HEADER.unpack_from(fixed)
+        file_size, block_size = DELTA_HEADER.unpack_from(socket.read(DELTA_HEADER.size))
+        file_path = socket.read(file_path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded delta packet: ")
+            utils.log_message("DEBUG", "File Path: " + str(file_path))
+            utils.log_message("DEBUG", "File size: " + str(file_size))
+            utils.log_message("DEBUG", "Block size: " + str(block_size))
+        # rebuild the file in the staging area, out of the local version and the literals that follow
+        try:
+            base = open(os.path.join(socket.staging.directory.get_path(), file_path), 'rb')
+        except IOError as error:
+            # Removed since its signatures were sent, the instructions are read to the end and thrown away,
+            # and the packet comes out without a file wrapper
+            utils.log_message("WARN", "Local version of the file is gone (" + str(error) + "), discarding its delta")
+            base = None
+        file_wrapper = socket.staging.new_file(file_size) if base is not None else None
+        target = file_wrapper.file if file_wrapper is not None else open(os.devnull, 'wb')
+        try:
+            while True:
+                instruction = DELTA_INSTRUCTION.unpack_from(socket.read(DELTA_INSTRUCTION.size))[0]
+                if instruction == DELTA_END:
+                    break
+                elif instruction == delta.COPY:
+                    first, count = DELTA_COPY.unpack_from(socket.read(DELTA_COPY.size))
+                    if base is not None:
+                        delta.copy_blocks(base, target, block_size, first, count)
+                else:
+                    literal_length = DELTA_LITERAL.unpack_from(socket.read(DELTA_LITERAL.size))[0]
+                    if socket.file_compression != file_codec.NONE:
+                        SendFilePacket.receive_chunks(socket, target, literal_length)
+                    else:
+                        socket.receive_file(target, literal_length)
+            if file_wrapper is not None:
+                # The file was preallocated with the size it had when the delta started
+                target.truncate()
+        finally:
+            if base is not None:
+                base.close()
+            target.close()
+        packet = DeltaPacket(FileInfo(file_path, False, file_last_modified, file_size, file_wrapper), block_size)
+        return packet
+
+class RequestHashPacket:
+    ID = 14
+
+    def __init__(self, path):
+        """
+        Creates a request hash packet, asking for the digest of a file's content before requesting the file,
+        so that content the server already stores is not sent again.
+        @param path: The relative path of the file.
+        @type path: str
+        """
+        self.path = path
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(PATH_HEADER.pack(len(self.path)))
+        body.extend(self.path)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        path_length = PATH_HEADER.unpack_from(socket.read(PATH_HEADER.size))[0]
+        path = socket.read(path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded request hash packet: ")
+            utils.log_message("DEBUG", "Path: " + str(path))
+        return RequestHashPacket(path)
+
+
+class HashPacket:
+    ID = 15
+
+    def __init__(self, file_info):
+        """
+        Creates a hash packet, the reply to a request hash packet.
+        @param file_info: The file, with its last modified (epoch), size and digest,
+                          or just its path if it does not exist.
+        @type file_info: FileInfo
+        """
+        self.file_info = file_info
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        file_path = self.file_info.path
+        exists = self.file_info.digest is not None
+        body = bytearray(FILE_HASH_HEADER.pack(len(file_path), exists, self.file_info.last_modified or 0,
+                                               self.file_info.size or 0))
+        body.extend(file_path)
+        if exists:
+            body.extend(self.file_info.digest)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        fixed = socket.read(FILE_HASH_HEADER.size)
+        file_path_length, exists, file_last_modified, file_size = FILE_HASH_HEADER.unpack_from(fixed)
+        file_path = socket.read(file_path_length).tobytes()
+        digest = None
+        if exists:
+            digest = socket.read(content_store.DIGEST_LENGTH).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded hash packet: ")
+            utils.log_message("DEBUG", "File Path: " + str(file_path))
+            utils.log_message("DEBUG", "Exists: " + str(exists))
+        return HashPacket(FileInfo(file_path, False, file_last_modified, file_size, digest=digest))
+
+class CopyFilePacket:
+    ID = 16
+
+    def __init__(self, file_info, source):
+        """
+        Creates a copy file packet, telling the other side to copy a file it already has instead of receiving it.
+        @param file_info: The file to create, with its last modified (epoch), size and digest.
+        @type file_info: FileInfo
+        @param source: The relative path of a file with the same contents on the other side.
+        @type source: str
+        """
+        self.file_info = file_info
+        self.source = source
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        file_path = self.file_info.path
+        body = bytearray(COPY_FILE_HEADER.pack(len(file_path), len(self.source), self.file_info.last_modified,
+                                               self.file_info.size))
+        body.extend(file_path)
+        body.extend(self.source)
+        body.extend(self.file_info.digest)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        fixed = socket.read(COPY_FILE_HEADER.size)
+        file_path_length, source_length, file_last_modified, file_size = COPY_FILE_HEADER.unpack_from(fixed)
+        file_path = socket.read(file_path_length).tobytes()
+        source = socket.read(source_length).tobytes()
+        digest = socket.read(content_store.DIGEST_LENGTH).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded copy file packet: ")
+            utils.log_message("DEBUG", "File Path: " + str(file_path))
+            utils.log_message("DEBUG", "Source: " + str(source))
+        return CopyFilePacket(FileInfo(file_path, False, file_last_modified, file_size, digest=digest), source)
+
+class BundlePacket:
+    ID = 17
+
+    def __init__(self, entries):
+        """
+        Creates a bundle packet, carrying many small files and directories at once.
+        @param entries: The (file info, contents) of each file or directory, in the order they are placed.
+                        The contents are None for directories.
+        @type entries: list of tuple
+        """
+        self.entries = entries
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        payload = bytearray()
+        for file_info, contents in self.entries:
+            payload.extend(BUNDLE_ENTRY.pack(len(file_info.path), file_info.is_directory,
+                                             file_info.last_modified, file_info.size or 0))
+            payload.extend(file_info.path)
+            if contents is not None:
+                payload.extend(contents)
+        # The entries are compressed together, small files do not compress well on their own
+        codec = file_codec.NONE
+        if socket.file_compression != file_codec.NONE and len(payload) >= file_codec.MIN_SIZE:
+            is_compressed, stored = file_codec.compress_chunk(bytes(payload))
+            if is_compressed:
+                codec = socket.file_compression
+                payload = stored
+        socket.sendall(BUNDLE_HEADER.pack(len(self.entries), file_codec.CODEC_IDS[codec], len(payload)))
+        socket.sendall(payload)
+
+    @staticmethod
+    def decode(socket):
+        fixed = socket.read(BUNDLE_HEADER.size)
+        entry_count, codec_id, stored_length = BUNDLE_HEADER.unpack_from(fixed)
+        payload = file_codec.decompress_chunk(codec_id != file_codec.CODEC_IDS[file_codec.NONE],
+                                              socket.read(stored_length))
+        # The view of the input buffer is only valid until the next read
+        payload = memoryview(payload.tobytes() if isinstance(payload, memoryview) else payload)
+        entries = []
+        offset = 0
+        for _ in range(entry_count):
+            path_length, is_directory, last_modified, size = BUNDLE_ENTRY.unpack_from(payload, offset)
+            offset += BUNDLE_ENTRY.size
+            path = payload[offset:offset + path_length].tobytes()
+            offset += path_length
+            contents = None
+            if not is_directory:
+                contents = payload[offset:offset + size]
+                offset += size
+            entries.append((FileInfo(path, is_directory, last_modified, None if is_directory else size), contents))
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded bundle packet: ")
+            utils.log_message("DEBUG", "Entries: " + str(entry_count))
+            utils.log_message("DEBUG", "Stored length: " + str(stored_length))
+        return BundlePacket(entries)
+
+class ResumePacket:
+    ID = 18
+
+    def __init__(self, path, resume_point):
+        """
+        Creates a resume packet, telling the other side a file was partially received in a previous session,
+        so it can send only the rest of it.
+        @param path: The relative path of the file.
+        @type path: str
+        @param resume_point: The last modified (epoch), size and number of bytes received of the partial file.
+        @type resume_point: (int, int, int)
+        """
+        self.path = path
+        self.resume_point = resume_point
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(PATH_HEADER.pack(len(self.path)))
+        body.extend(RESUME_POINT.pack(*self.resume_point))
+        body.extend(self.path)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        path_length = PATH_HEADER.unpack_from(socket.read(PATH_HEADER.size))[0]
+        resume_point = RESUME_POINT.unpack_from(socket.read(RESUME_POINT.size))
+        path = socket.read(path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded resume packet: ")
+            utils.log_message("DEBUG", "Path: " + str(path))
+            utils.log_message("DEBUG", "Resume point: " + str(resume_point))
+        return ResumePacket(path, resume_point)
+
+
+class AttachPacket:
+    ID = 19
+
+    def __init__(self, token):
+        """
+        Creates an attach packet. The server sends it after negotiating striping, with the token of the session,
+        and the client sends it first over every data connection it opens, with the same token.
+        @param token: The token of the session.
+        @type token: str
+        """
+        self.token = token
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(ATTACH_HEADER.pack(len(self.token)))
+        body.extend(self.token)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        token_length = ATTACH_HEADER.unpack_from(socket.read(ATTACH_HEADER.size))[0]
+        token = socket.read(token_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded attach packet")
+        return AttachPacket(token)
+
+
+class StripePacket:
+    ID = 20
+
+    def __init__(self, transfer_id, file_info):
+        """
+        Creates a stripe packet, announcing a file whose contents follow in range packets over the data connections.
+        @param transfer_id: The id the range packets refer to the file by.
+        @type transfer_id: int
+        @param file_info: The file. (I will need from it the path, last modified (epoch), size)
+        @type file_info: FileInfo
+        """
+        self.transfer_id = transfer_id
+        self.file_info = file_info
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        file_path = self.file_info.path
+        body = bytearray(STRIPE_HEADER.pack(self.transfer_id, len(file_path), self.file_info.last_modified,
+                                            self.file_info.size))
+        body.extend(file_path)
+        socket.sendall(body)
+
+    @staticmethod
+    def decode(socket):
+        fixed = socket.read(STRIPE_HEADER.size)
+        transfer_id, file_path_length, file_last_modified, file_size = STRIPE_HEADER.unpack_from(fixed)
+        file_path = socket.read(file_path_length).tobytes()
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded stripe packet: ")
+            utils.log_message("DEBUG", "Transfer id: " + str(transfer_id))
+            utils.log_message("DEBUG", "File path: " + str(file_path))
+            utils.log_message("DEBUG", "File size: " + str(file_size))
+        return StripePacket(transfer_id, FileInfo(file_path, False, file_last_modified, file_size))
+
+
+class RangePacket:
+    ID = 21
+
+    def __init__(self, transfer_id, file_info, offset, length):
+        """
+        Creates a range packet, with part of the contents of a file announced by a stripe packet.
+        @param transfer_id: The id of the file, as announced.
+        @type transfer_id: int
+        @param file_info: The file, None when decoded, the contents are written straight to the staged file.
+                             (I will need from it the file descriptor)
+        @type file_info: FileInfo or None
+        @param offset: The offset of the range.
+        @type offset: int
+        @param length: The length of the range.
+        @type length: int
+        """
+        self.transfer_id = transfer_id
+        self.file_info = file_info
+        self.offset = offset
+        self.length = length
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        body = bytearray(RANGE_HEADER.pack(self.transfer_id, self.offset, self.length))
+        source_path = self.file_info.file_wrapper.get_path()
+        end = self.offset + self.length
+        codec = file_codec.NONE
+        if socket.file_compression != file_codec.NONE:
+            codec = file_codec.choose_codec(source_path, self.length, socket.file_compression)
+            body.extend(FILE_CODEC.pack(file_codec.CODEC_IDS[codec]))
+        socket.sendall(body)
+        if codec == file_codec.NONE:
+            socket.send_file(source_path, end, self.offset)
+            return
+        for is_compressed, data in file_codec.compressed_chunks(source_path, end, socket.compression_workers,
+                                                                self.offset):
+            socket.sendall(file_codec.CHUNK_HEADER.pack(is_compressed, len(data)))
+            socket.sendall(data)
+
+    @staticmethod
+    def decode(socket):
+        transfer_id, offset, length = RANGE_HEADER.unpack_from(socket.read(RANGE_HEADER.size))
+        codec = file_codec.NONE
+        if socket.file_compression != file_codec.NONE:
+            codec = file_codec.CODEC_NAMES[FILE_CODEC.unpack_from(socket.read(FILE_CODEC.size))[0]]
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded range packet: ")
+            utils.log_message("DEBUG", "Transfer id: " + str(transfer_id))
+            utils.log_message("DEBUG", "Offset: " + str(offset))
+            utils.log_message("DEBUG", "Length: " + str(length))
+        # ranges of the same file arrive over several connections, each one writes its own
+        with open(socket.stripes.target(transfer_id), 'r+b') as target:
+            target.seek(offset)
+            if codec == file_codec.NONE:
+                socket.receive_file(target, length)
+            else:
+                SendFilePacket.receive_chunks(socket, target, length)
+        socket.stripes.received(transfer_id, length)
+        return RangePacket(transfer_id, None, offset, length)
+
+
+class WaitPacket:
+    ID = 22
+
+    def __init__(self, position, estimate):
+        """
+        Creates a wait packet. The server sends it after a login, when the directory is being synchronized by
+        another session and the login waits for it, if waiting was negotiated.
+        @param position: The place of the login in line, 1 for the next one.
+        @type position: int
+        @param estimate: The estimated seconds to wait.
+        @type estimate: int
+        """
+        self.position = position
+        self.estimate = estimate
+
+    def send(self, socket):
+        """
+        Sends the packet encoded over the socket.
+        @param socket: The socket to send the packet to.
+        @type socket: ObjectSocket
+        """
+        socket.sendall(WAIT_HEADER.pack(self.position, self.estimate))
+
+    @staticmethod
+    def decode(socket):
+        position, estimate = WAIT_HEADER.unpack_from(socket.read(WAIT_HEADER.size))
+        if utils.DEBUG_LEVEL >= 3:
+            utils.log_message("DEBUG", "Decoded wait packet")
+        return WaitPacket(position, estimate)
+
 # class FileChangedPacket:
 #     ID = 100
 #
@@ -0,0 +1,139 @@
+"""Prefork server, worker processes sharing the server's port and a supervisor restarting them"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import errno
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import utils
+
+# SO_REUSEPORT, which Python only defines on some versions, has this value on Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+# Workers exiting sooner than this after being started are restarted after RESTART_DELAY
+MIN_LIFETIME = 1.0
+RESTART_DELAY = 1.0
+
+
+def reuse_port(server_socket):
+    """
+    Lets other sockets bind to the same port as a socket, the kernel spreading the connections among them.
+    @param server_socket: The socket, not bound yet
+    @type server_socket: socket.socket
+    @return: Whether the platform allows it
+    @rtype: bool
+    """
+    if SO_REUSEPORT is None:
+        return False
+    try:
+        server_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except socket.error as _:
+        return False
+    return True
+
+
+class Supervisor(object):
+    """
+    Forks the worker processes of a prefork server and restarts the ones that exit, until it is terminated.
+    Each worker serves connections from a listening socket of its own, bound to the same port with
+    SO_REUSEPORT, so the kernel spreads the connections among them. Where SO_REUSEPORT is not available,
+    the workers share the listening socket created before forking them instead.
+    """
+
+    def __init__(self, processes, listen, serve):
+        """
+        Creates the supervisor of a prefork server.
+        @param processes: The number of worker processes
+        @type processes: int
+        @param listen: Creates a listening socket, bound with or without SO_REUSEPORT as asked
+        @type listen: (bool) -> socket.socket
+        @param serve: Serves the connections of a listening socket in a worker, never returns
+        @type serve: (socket.socket) -> None
+        """
+        super(Supervisor, self).__init__()
+        self.processes = processes
+        self.listen = listen
+        self.serve = serve
+        # Listening socket shared by the workers, None when each one has its own
+        self.shared_socket = None
+        # Start time of every worker, by process id
+        self.workers = {}
+        self.stopping = False
+        # Pipe only the supervisor writes to, the workers exit once it is closed, if the supervisor dies
+        self.alive_read = None
+        self.alive_write = None
+
+    def run(self):
+        """Starts the workers and restarts them as they exit, until the supervisor is terminated"""
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not reuse_port(probe):
+            self.shared_socket = self.listen(False)
+        probe.close()
+        self.alive_read, self.alive_write = os.pipe()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.processes):
+            self._start()
+        utils.log_message("INFO", "Started " + str(self.processes) + " worker processes")
+        while not self.stopping:
+            try:
+                pid, status = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            utils.log_message("ERROR", "Worker " + str(pid) + " exited with status " + str(status) + ", restarting it")
+            if time.time() - started < MIN_LIFETIME:
+                time.sleep(RESTART_DELAY)
+            self._start()
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as _:
+                pass
+
+    def _start(self):
+        """Forks a worker, which serves connections until it exits"""
+        pid = os.fork()
+        if pid != 0:
+            self.workers[pid] = time.time()
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.close(self.alive_write)
+        watcher = threading.Thread(target=Supervisor._watch, args=(self,))
+        watcher.daemon = True
+        watcher.start()
+        status = 1
+        try:
+            server_socket = self.shared_socket
+            if server_socket is None:
+                server_socket = self.listen(True)
+            self.serve(server_socket)
+            status = 0
+        except Exception as _:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _watch(self):
+        """Exits the worker once the supervisor is gone, which closes the pipe"""
+        while os.read(self.alive_read, 1):
+            pass
+        utils.log_message("ERROR", "Supervisor gone, stopping worker " + str(os.getpid()))
+        os._exit(1)
+
+    def _stop(self, signum, frame):
+        """Stops restarting workers, the supervisor terminates them and returns"""
+        self.stopping = True
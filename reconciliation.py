@@ -0,0 +1,160 @@
+"""Reconciles the client's manifest with the server's manifest"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import os
+
+
+def manifest_key(file_info):
+    """
+    Returns the key that identifies a manifest entry, matching the FileInfo equality.
+    @param file_info: The manifest entry
+    @type file_info: FileInfo
+    @return: The (path, is_directory) pair of the entry
+    @rtype: tuple
+    """
+    return (file_info.path, bool(file_info.is_directory))
+
+
+def index_manifest(files):
+    """
+    Indexes a manifest by its entries' keys. When a key is repeated, the first entry wins.
+    @param files: The manifest entries
+    @type files: list of FileInfo
+    @return: A dictionary mapping each key to its entry
+    @rtype: dict
+    """
+    index = {}
+    for file_info in files:
+        index.setdefault(manifest_key(file_info), file_info)
+    return index
+
+
+def reconcile(local_files, remote_files):
+    """
+    Compares the local manifest with the remote one in linear time.
+    Entries missing on the other side, or newer than their counterpart, have to be transferred.
+    @param local_files: The local manifest, in the order the transfers should happen
+    @type local_files: list of FileInfo
+    @param remote_files: The remote manifest, in the order the transfers should happen
+    @type remote_files: list of FileInfo
+    @return: The entries to request from the remote side and the entries to send to it
+    @rtype: (list of FileInfo, list of FileInfo)
+    """
+    local_index = index_manifest(local_files)
+    remote_index = index_manifest(remote_files)
+
+    request_files = []
+    for remote in remote_files:
+        local = local_index.get(manifest_key(remote))
+        if local is None or remote > local:
+            request_files.append(remote)
+
+    send_files = []
+    for local in local_files:
+        remote = remote_index.get(manifest_key(local))
+        if remote is None or local > remote:
+            send_files.append(local)
+
+    return request_files, send_files
+
+
+def sort_key(path):
+    """
+    Returns the key of the canonical manifest order used by streaming logins.
+    Separators sort before any other character, so every directory is directly followed by its contents.
+    @param path: The relative path of the entry
+    @type path: str
+    @rtype: str
+    """
+    return path.replace(os.sep, "\x00")
+
+
+class ManifestMerger(object):
+    """
+    Merge-joins the local manifest with a remote manifest arriving in blocks, both in the canonical order,
+    deciding each transfer as soon as both sides of it were seen. Transfers are decided like in reconcile,
+    and directories are transferred once the merge leaves them, after their contents.
+    """
+
+    def __init__(self, local_files, request_object, send_object):
+        """
+        Creates a merger.
+        @param local_files: The local manifest in the canonical order, read lazily
+        @type local_files: iterable of FileInfo
+        @param request_object: Called with each remote FileInfo to be requested
+        @type request_object: function
+        @param send_object: Called with each local FileInfo to be sent
+        @type send_object: function
+        """
+        super(ManifestMerger, self).__init__()
+        self.local_files = iter(local_files)
+        self.request_object = request_object
+        self.send_object = send_object
+        self.local = next(self.local_files, None)
+        # (directory path, action, argument) of the directories the merge is inside of, innermost last
+        self.directories = []
+
+    def feed(self, remote_files):
+        """
+        Merges the next block of the remote manifest.
+        @param remote_files: The next remote entries in the canonical order
+        @type remote_files: list of FileInfo
+        """
+        for remote in remote_files:
+            key = sort_key(remote.path)
+            while self.local is not None and sort_key(self.local.path) < key:
+                self._local_only()
+            if self.local is not None and self.local.path == remote.path:
+                local = self.local
+                self.local = next(self.local_files, None)
+                if local.is_directory != remote.is_directory:
+                    # A file on one side and a directory on the other, the directory goes last
+                    # so its contents can still follow it
+                    if local.is_directory:
+                        self._decide(remote, self.request_object, remote)
+                        self._decide(local, self.send_object, local)
+                    else:
+                        self._decide(local, self.send_object, local)
+                        self._decide(remote, self.request_object, remote)
+                elif remote > local:
+                    self._decide(remote, self.request_object, remote)
+                elif local > remote:
+                    self._decide(local, self.send_object, local)
+                else:
+                    self._decide(local, None, None)
+            else:
+                self._decide(remote, self.request_object, remote)
+
+    def finish(self):
+        """Merges what is left of the local manifest once the remote one ended"""
+        while self.local is not None:
+            self._local_only()
+        self._leave("")
+
+    def _local_only(self):
+        """Sends the next local entry, which the remote side does not have"""
+        local = self.local
+        self.local = next(self.local_files, None)
+        self._decide(local, self.send_object, local)
+
+    def _decide(self, file_info, action, argument):
+        """Runs the transfer of a file right away, or remembers the one of a directory until the merge
+        leaves it. Either way, the directories the merge left are transferred first"""
+        self._leave(file_info.path)
+        if file_info.is_directory:
+            self.directories.append((file_info.path, action, argument))
+        elif action is not None:
+            action(argument)
+
+    def _leave(self, path):
+        """Transfers the directories that do not contain the given path, the whole stack for an empty one"""
+        while self.directories:
+            directory, action, argument = self.directories[-1]
+            if path.startswith(directory + os.sep):
+                break
+            self.directories.pop()
+            if action is not None:
+                action(argument)
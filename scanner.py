@@ -0,0 +1,101 @@
+"""Scans directory trees into lightweight records instead of File and Directory wrappers"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+from files import list_directory
+from multiprocessing.pool import ThreadPool
+import os
+from packets import FileInfo
+import stat
+
+
+def walk(root, workers=0):
+    """
+    Walks a directory tree, stat'ing every entry once.
+    @param root: The absolute path of the tree
+    @type root: str
+    @param workers: Number of threads listing sibling subtrees in parallel, 0 to walk sequentially.
+                    Worth it on network filesystems, where every listing and stat is a round trip.
+    @type workers: int
+    @return: (relative path, stat result) pairs, with directories after their contents
+    @rtype: iterable of tuple
+    """
+    if workers > 1:
+        return _walk_parallel(root, workers)
+    return _walk(root, "")
+
+
+def scan(root, workers=0):
+    """
+    Walks a directory tree, see walk.
+    @return: The manifest entries of the tree, with directories after their contents
+    @rtype: iterable of FileInfo
+    """
+    for path, stat_result in walk(root, workers):
+        yield file_info(path, stat_result)
+
+
+def file_info(path, stat_result):
+    """
+    Builds a manifest entry from a stat result.
+    @param path: The relative path of the entry
+    @type path: str
+    @param stat_result: The stat result of the entry
+    @type stat_result: os.stat_result
+    @rtype: FileInfo
+    """
+    if stat.S_ISDIR(stat_result.st_mode):
+        return FileInfo(path, True, int(stat_result.st_mtime))
+    return FileInfo(path, False, int(stat_result.st_mtime), int(stat_result.st_size))
+
+
+def _walk(abs_path, path):
+    """Walks a subtree sequentially"""
+    for name, stat_result in list_directory(abs_path):
+        child_path = os.path.join(path, name)
+        if stat.S_ISDIR(stat_result.st_mode):
+            for record in _walk(os.path.join(abs_path, name), child_path):
+                yield record
+        yield child_path, stat_result
+
+
+def _walk_parallel(root, workers):
+    """Walks a tree level by level, listing the directories of each level in parallel"""
+
+    def list_relative(path):
+        """Lists a directory given its path relative to the root"""
+        try:
+            return list(list_directory(os.path.join(root, path)))
+        except OSError as _:
+            # Removed while scanning
+            return []
+
+    listings = {}
+    level = [""]
+    pool = ThreadPool(workers)
+    try:
+        while level:
+            next_level = []
+            for path, listing in zip(level, pool.map(list_relative, level)):
+                listings[path] = listing
+                next_level.extend(os.path.join(path, name) for name, stat_result in listing
+                                  if stat.S_ISDIR(stat_result.st_mode))
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+
+    records = []
+
+    def assemble(path):
+        """Appends the records of a subtree, directories after their contents"""
+        for name, stat_result in listings[path]:
+            child_path = os.path.join(path, name)
+            if stat.S_ISDIR(stat_result.st_mode):
+                assemble(child_path)
+            records.append((child_path, stat_result))
+
+    assemble("")
+    return records
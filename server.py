@@ -4,22 +4,139 @@
 # 81936 - Liliana Oliveira
 # 82047 - Andre Mendes
 
+import admission
+from content_store import ContentStore
+import event_loop
+import file_cache
+from file_cache import FileCache
+import leases
+from leases import LeaseTable
 from message_handler import MessageHandler
-from object_socket import ObjectSocket
+import negotiation
+from object_socket import ObjectSocket, add_transport_arguments, transport_options
+import argparse
+import prefork
 import socket
-import sys
+import threading
 
-def main():
-    '''Starts execution once everything is loaded'''
-    port = int(sys.argv[1])
+# Server engines, see README.TXT
+ENGINE_THREADS = "threads"
+ENGINE_EVENTS = "events"
+ENGINES = [ENGINE_THREADS, ENGINE_EVENTS]
+
+def parse_arguments():
+    '''Parses the command line arguments'''
+    parser = argparse.ArgumentParser(description="PyBox server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--store", metavar="PATH",
+                        help="deduplicate the contents of files in a content store at PATH, which has to be on the "
+                             "same filesystem as the synchronized directories")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINE_THREADS,
+                        help="serve each session from a thread of its own, or every session from an event loop")
+    parser.add_argument("--workers", type=int, default=event_loop.WORKERS,
+                        help="threads handling the packets of the sessions, with the events engine")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="fork N worker processes sharing the port, restarted if they crash (Unix only)")
+    parser.add_argument("--max-sessions", type=int,
+                        help="sessions handled at once by each process (default %d with the threads engine, %d with "
+                             "the events engine)" % (admission.MAX_SESSIONS, event_loop.MAX_SESSIONS))
+    parser.add_argument("--max-waiting", type=int, default=admission.MAX_WAITING,
+                        help="connections waiting for a session to end, past them they are told the server is busy")
+    parser.add_argument("--wait-timeout", type=float, default=admission.WAIT_TIMEOUT,
+                        help="seconds a connection waits for a session to end before it is told the server is busy")
+    parser.add_argument("--idle-timeout", type=float, default=admission.IDLE_TIMEOUT,
+                        help="seconds a session may neither receive nor send anything before it is closed, 0 to "
+                             "never close them")
+    parser.add_argument("--lease-timeout", type=float, default=leases.WAIT_TIMEOUT,
+                        help="seconds a login waits for another session of its directory to end before it is told "
+                             "the directory is busy")
+    parser.add_argument("--lease-ttl", type=float, default=leases.LEASE_TTL,
+                        help="seconds a session holds its directory while neither receiving nor sending anything")
+    parser.add_argument("--lease-queue", type=int, default=leases.MAX_WAITING,
+                        help="logins waiting for the same directory, past them they are told it is busy")
+    parser.add_argument("--file-cache", type=int, default=file_cache.MAX_SIZE // 1048576, metavar="MB",
+                        help="megabytes of small popular files kept in memory, shared by the sessions of each "
+                             "process, 0 to read them from disk every time")
+    parser.add_argument("--backlog", type=int, default=admission.BACKLOG,
+                        help="connections the kernel accepts before the server does")
+    add_transport_arguments(parser)
+    return parser.parse_args()
+
+def listen(arguments, reuse_port=False):
+    '''Creates the listening socket, letting the other workers of a prefork server bind to the port if asked'''
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(('', port))
-    server_socket.listen(5)
+    if reuse_port:
+        prefork.reuse_port(server_socket)
+    server_socket.bind(('', arguments.port))
+    server_socket.listen(arguments.backlog)
+    return server_socket
+
+def serve_session(connection, ticket, arguments, store, supported, slots, monitor):
+    '''Handles a connection once it is admitted, in a thread of its own'''
+    if not slots.wait(ticket):
+        admission.shed(connection)
+        return
+    handler = None
+    object_socket = None
+    try:
+        object_socket = ObjectSocket(connection, **transport_options(arguments))
+        handler = MessageHandler(object_socket, store=store, supported=supported)
+        if monitor is not None:
+            monitor.add(handler)
+        handler.process()
+    finally:
+        if object_socket is None:
+            connection.close()
+        elif object_socket.stripes is None:
+            # Data connections are closed by their striped session
+            object_socket.close()
+        if monitor is not None and handler is not None:
+            monitor.remove(handler)
+        slots.release()
+
+def serve(server_socket, arguments, store):
+    '''Serves the connections of the listening socket with the chosen engine, never returns'''
+    supported = negotiation.SUPPORTED
+    if arguments.processes > 0:
+        # Data connections may reach other workers than their session's
+        supported = negotiation.without(negotiation.FILE_STRIPING)
 
+    if arguments.engine == ENGINE_EVENTS:
+        event_loop.raise_file_limit()
+        slots = admission.Admission(arguments.max_sessions or event_loop.MAX_SESSIONS, arguments.max_waiting,
+                                    arguments.wait_timeout)
+        event_loop.EventLoop(server_socket, transport_options(arguments), store, arguments.workers, slots,
+                             arguments.idle_timeout).serve_forever()
+
+    slots = admission.Admission(arguments.max_sessions or admission.MAX_SESSIONS, arguments.max_waiting,
+                                arguments.wait_timeout)
+    monitor = admission.IdleMonitor(arguments.idle_timeout) if arguments.idle_timeout > 0 else None
     while True:
         connection_socket, _ = server_socket.accept()
-        object_socket = ObjectSocket(connection_socket)
-        MessageHandler(object_socket, thread=True)
+        ticket = slots.reserve()
+        if ticket is None:
+            admission.shed(connection_socket)
+            continue
+        thread = threading.Thread(target=serve_session,
+                                  args=(connection_socket, ticket, arguments, store, supported, slots, monitor))
+        thread.daemon = True
+        thread.start()
+
+def main():
+    '''Starts execution once everything is loaded'''
+    arguments = parse_arguments()
+    MessageHandler.lease_table = LeaseTable(arguments.lease_timeout, arguments.lease_ttl, arguments.lease_queue)
+    MessageHandler.file_cache = FileCache(arguments.file_cache * 1048576)
+    store = None
+    if arguments.store is not None:
+        store = ContentStore(arguments.store)
+        store.collect()
+
+    if arguments.processes > 0:
+        prefork.Supervisor(arguments.processes, lambda reuse_port: listen(arguments, reuse_port),
+                           lambda server_socket: serve(server_socket, arguments, store)).run()
+    else:
+        serve(listen(arguments), arguments, store)
 
 main()
@@ -0,0 +1,360 @@
+"""Receives files next to the synchronized directory and moves them into place"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import bundle
+import errno
+from files import File, Directory
+import hashlib
+import os
+import random
+import shutil
+import time
+import utils
+
+# Interrupted transfers of large files are resumed where they stopped, sizes and offsets take 64 bits
+RESUME = "resume"
+# Interrupted transfers start over, sizes take 32 bits
+NONE = "none"
+
+# Supported resume modes, most preferred first
+MODES = [RESUME, NONE]
+
+# Size of the chunks files are copied in
+COPY_SIZE = 1048576
+# Files smaller than this are not worth resuming, they are received like any other
+RESUME_MIN_SIZE = 1048576
+# Partial files not resumed for this long are discarded
+PARTIAL_LIFETIME = 7 * 24 * 3600
+
+
+class StagingArea(object):
+    """
+    Hidden directory next to a synchronized directory where received files are written before being renamed
+    into place. Being on the same filesystem, the rename is atomic and no data is copied again, unlike moving
+    them out of the system's temporary directory. Directories created along the way are remembered, so they
+    are not stat'ed again for every file received.
+
+    Large files being resumable are received into the "partial" subdirectory instead, under a name derived from
+    their path, next to a ".meta" file with the version being received. When a connection drops they are kept,
+    and the next session asks for the rest of them.
+    """
+
+    SUFFIX = ".staging"
+    PARTIAL = "partial"
+    META_SUFFIX = ".meta"
+
+    def __init__(self, directory):
+        """
+        Creates the staging area of a directory, discarding what a previous session left behind but the
+        partial files that can still be resumed.
+        @param directory: The synchronized directory
+        @type directory: Directory
+        """
+        super(StagingArea, self).__init__()
+        self.directory = directory
+        head, tail = os.path.split(directory.get_path())
+        self.path = os.path.join(head, "." + tail + self.SUFFIX)
+        self.partial_path = os.path.join(self.path, self.PARTIAL)
+        if os.path.isdir(self.path):
+            self.discard()
+            self._expire_partials()
+        # Absolute paths of the directories known to exist
+        self.created_directories = set()
+        # Absolute paths of the directories received, whose timestamps were set already
+        self.placed_directories = set()
+        # Number of bundled files staged, naming the next one
+        self.bundled_files = 0
+
+    def new_file(self, size):
+        """
+        Creates an open file in the staging area, preallocating its size when the platform allows it.
+        @param size: The size the file will have
+        @type size: int
+        @rtype: File
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        file_wrapper = File(directory=self.path)
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(file_wrapper.file.fileno(), 0, size)
+            except OSError as _:
+                # Not every filesystem supports it, the file just grows as it is written
+                pass
+        return file_wrapper
+
+    def new_link(self, source):
+        """
+        Creates a hard link to a file in the staging area, to be placed like a received file.
+        @param source: The path of the file
+        @type source: str
+        @rtype: File
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        while True:
+            path = os.path.join(self.path, "link" + str(random.getrandbits(32)))
+            try:
+                os.link(source, path)
+                return File(path)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    def new_copy(self, source):
+        """
+        Copies a file to the staging area, to be placed like a received file.
+        @param source: The path of the file
+        @type source: str
+        @rtype: File
+        """
+        file_wrapper = self.new_file(os.path.getsize(source))
+        with open(source, 'rb') as source_file:
+            shutil.copyfileobj(source_file, file_wrapper.file, COPY_SIZE)
+        file_wrapper.close()
+        return file_wrapper
+
+    def place_file(self, file_wrapper, destination):
+        """
+        Renames a staged file into place, replacing whatever is there.
+        Files usually arrive before their directory, but a file sent as a delta may arrive after it,
+        in which case the directory's timestamp is kept.
+        @param file_wrapper: The staged file, already closed
+        @type file_wrapper: File
+        @param destination: The absolute path it belongs to
+        @type destination: str
+        """
+        destination = os.path.normpath(destination)
+        if utils.DEBUG_LEVEL >= 1:
+            utils.log_message("DEBUG", "Moving file to path " + str(destination))
+        parent = os.path.dirname(destination)
+        self.ensure_directory(parent)
+        parent_stat = os.stat(parent) if parent in self.placed_directories else None
+        if destination in self.created_directories or os.path.isdir(destination):
+            # It used to be a directory
+            self.created_directories.discard(destination)
+            os.rmdir(destination)
+        try:
+            os.rename(file_wrapper.get_path(), destination)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            # The destination is a mount point of its own
+            shutil.move(file_wrapper.get_path(), destination)
+        if os.path.dirname(file_wrapper.get_path()) == self.partial_path:
+            # A partial file that was completed
+            self._remove(file_wrapper.get_path() + self.META_SUFFIX)
+        file_wrapper.path = destination
+        if parent_stat is not None:
+            os.utime(parent, (parent_stat.st_atime, parent_stat.st_mtime))
+
+    def place_bundle(self, entries):
+        """
+        Places the entries of a bundle. The directories they need are created first, each once, then the files
+        are written to the staging area with their timestamps and renamed into place, and the timestamps of the
+        directories are set last, once nothing else is placed in them.
+        @param entries: The (absolute path, file info, contents) of each entry, the contents are None for directories
+        @type entries: list of tuple
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        entries = [(os.path.normpath(destination), info, contents) for destination, info, contents in entries]
+        for parent in bundle.parent_directories([destination for destination, _, _ in entries]):
+            self.ensure_directory(parent)
+        bundled_directories = set(destination for destination, info, _ in entries if info.is_directory)
+        # Directories received before keep their timestamps
+        restored = {}
+        for destination, info, _ in entries:
+            parent = os.path.dirname(destination)
+            if parent in self.placed_directories and parent not in bundled_directories and parent not in restored:
+                restored[parent] = os.stat(parent)
+
+        for destination, info, contents in entries:
+            if info.is_directory:
+                self.place_directory(destination)
+                continue
+            staged = os.path.join(self.path, "bundle" + str(self.bundled_files))
+            self.bundled_files += 1
+            descriptor = os.open(staged, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+            try:
+                written = 0
+                while written < len(contents):
+                    written += os.write(descriptor, contents[written:])
+            finally:
+                os.close(descriptor)
+            os.utime(staged, (info.last_modified, info.last_modified))
+            try:
+                os.rename(staged, destination)
+            except OSError as error:
+                if error.errno == errno.EXDEV:
+                    # The destination is a mount point of its own
+                    shutil.move(staged, destination)
+                elif os.path.isdir(destination):
+                    # It used to be a directory
+                    self.created_directories.discard(destination)
+                    os.rmdir(destination)
+                    os.rename(staged, destination)
+                else:
+                    raise
+
+        for destination, info, _ in entries:
+            if info.is_directory:
+                os.utime(destination, (info.last_modified, info.last_modified))
+        for parent, parent_stat in restored.items():
+            os.utime(parent, (parent_stat.st_atime, parent_stat.st_mtime))
+
+    def place_directory(self, destination):
+        """
+        Creates a directory, replacing a file that is there.
+        @param destination: The absolute path of the directory
+        @type destination: str
+        @rtype: Directory
+        """
+        destination = os.path.normpath(destination)
+        if destination not in self.created_directories and os.path.lexists(destination) \
+                and not os.path.isdir(destination):
+            # It used to be a file
+            os.remove(destination)
+        self.ensure_directory(destination)
+        self.placed_directories.add(destination)
+        return Directory(destination, create=False)
+
+    def ensure_directory(self, path):
+        """
+        Creates a directory and its parents unless they are known to exist.
+        @param path: The absolute path of the directory
+        @type path: str
+        """
+        if path in self.created_directories:
+            return
+        try:
+            os.makedirs(path)
+        except OSError as _:
+            if not os.path.isdir(path):
+                raise
+        while path not in self.created_directories and path != os.path.dirname(path):
+            self.created_directories.add(path)
+            path = os.path.dirname(path)
+
+    def partial_file(self, path, last_modified, size, offset):
+        """
+        Opens the partial file of a file being received, to be written from an offset.
+        @param path: The relative path of the file
+        @type path: str
+        @param last_modified: The last modified (epoch) of the version being received
+        @type last_modified: int
+        @param size: The size of the version being received
+        @type size: int
+        @param offset: The number of bytes already received, anything after them is discarded
+        @type offset: int
+        @rtype: File
+        """
+        if not os.path.isdir(self.partial_path):
+            os.makedirs(self.partial_path)
+        data_path = self._partial_data_path(path)
+        with open(data_path + self.META_SUFFIX, 'wb') as meta:
+            meta.write(("%d %d\n" % (last_modified, size)).encode("ascii"))
+            meta.write(path)
+        file_wrapper = File(data_path)
+        file_wrapper.file = open(data_path, 'r+b' if offset > 0 and os.path.isfile(data_path) else 'w+b')
+        file_wrapper.file.truncate(offset)
+        file_wrapper.file.seek(offset)
+        return file_wrapper
+
+    def resume_point(self, path, last_modified):
+        """
+        Returns where to resume receiving a version of a file.
+        @param path: The relative path of the file
+        @type path: str
+        @param last_modified: The last modified (epoch) of the version to receive
+        @type last_modified: int
+        @return: The size of the version and the number of bytes of it already received, None if there are none
+        @rtype: (int, int) or None
+        """
+        data_path = self._partial_data_path(path)
+        meta = self._read_meta(data_path)
+        if meta is None or meta[0] != path or meta[1] != last_modified:
+            return None
+        offset = min(os.path.getsize(data_path), meta[2])
+        if offset == 0:
+            return None
+        return meta[2], offset
+
+    def partials(self):
+        """
+        Generator of the partial files that can be resumed.
+        @return: The relative path, last modified (epoch), size and number of bytes received of each one
+        @rtype: generator of tuple
+        """
+        if not os.path.isdir(self.partial_path):
+            return
+        for name in os.listdir(self.partial_path):
+            if name.endswith(self.META_SUFFIX):
+                continue
+            data_path = os.path.join(self.partial_path, name)
+            meta = self._read_meta(data_path)
+            if meta is not None and os.path.getsize(data_path) > 0:
+                path, last_modified, size = meta
+                yield path, last_modified, size, min(os.path.getsize(data_path), size)
+
+    def _partial_data_path(self, path):
+        """Returns the path of the partial file of a file"""
+        return os.path.join(self.partial_path, hashlib.sha1(path).hexdigest())
+
+    def _read_meta(self, data_path):
+        """Returns the (relative path, last modified, size) a partial file is of, None if it has no metadata"""
+        try:
+            with open(data_path + self.META_SUFFIX, 'rb') as meta:
+                header = meta.readline()
+                path = meta.read()
+            last_modified, size = [int(value) for value in header.split()]
+        except (IOError, OSError, ValueError) as _:
+            return None
+        if not os.path.isfile(data_path):
+            return None
+        return path, last_modified, size
+
+    def _expire_partials(self):
+        """Removes the partial files not written to for PARTIAL_LIFETIME, and metadata without a partial file"""
+        if not os.path.isdir(self.partial_path):
+            return
+        expired = time.time() - PARTIAL_LIFETIME
+        for name in os.listdir(self.partial_path):
+            path = os.path.join(self.partial_path, name)
+            if name.endswith(self.META_SUFFIX):
+                if not os.path.exists(path[:-len(self.META_SUFFIX)]):
+                    self._remove(path)
+            elif os.path.getmtime(path) < expired:
+                self._remove(path)
+                self._remove(path + self.META_SUFFIX)
+
+    @staticmethod
+    def _remove(path):
+        """Removes a file or a directory tree, if it is there"""
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError as _:
+                pass
+
+    def discard(self):
+        """Removes the files staged and not placed, e.g. by a session that ended in the middle of receiving them,
+        but the partial files that can still be resumed"""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            if name != self.PARTIAL:
+                self._remove(os.path.join(self.path, name))
+
+    def close(self):
+        """Removes the staging area if nothing was left in it"""
+        for path in (self.partial_path, self.path):
+            try:
+                os.rmdir(path)
+            except OSError as _:
+                pass
@@ -0,0 +1,188 @@
+"""Client-side cache of the synchronized directory's stat results, used to scan it incrementally"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import content_store
+from files import list_directory
+import os
+import scanner
+import sqlite3
+import stat
+import time
+import utils
+
+
+class StatCache(object):
+    """
+    SQLite table mapping every path of a directory to its (inode, mtime, size), kept in a hidden file
+    next to the directory. Directories whose inode and mtime did not change still have the same entries,
+    so their listing is reused instead of read again. Editing a file does not touch its directory's mtime,
+    so every entry is still stat'ed once per scan.
+    The digests of file contents are cached too, by (inode, size, mtime), so renamed and moved files
+    are not hashed again.
+    """
+
+    SUFFIX = ".statcache"
+    # Bump whenever the schema changes, forcing the cache to be dropped
+    VERSION = 3
+    # Directories modified this recently before the previous scan started are always listed again
+    RACY_SECONDS = 2
+
+    def __init__(self, directory, workers=0):
+        """
+        Opens the stat cache of a directory, creating it if needed.
+        @param directory: The directory to be scanned
+        @type directory: Directory
+        @param workers: Number of threads walking the directory in parallel when there is nothing cached
+        @type workers: int
+        """
+        super(StatCache, self).__init__()
+        self.directory = directory
+        self.workers = workers
+        head, tail = os.path.split(directory.get_path())
+        self.path = os.path.join(head, "." + tail + self.SUFFIX)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.text_factory = str
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS entries")
+            self.connection.execute("DROP TABLE IF EXISTS digests")
+            self.connection.execute("DROP TABLE IF EXISTS scans")
+            self.connection.execute("CREATE TABLE entries (path TEXT PRIMARY KEY, is_directory INTEGER NOT NULL, "
+                                    "inode INTEGER NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL)")
+            self.connection.execute("CREATE TABLE digests (inode INTEGER NOT NULL, size INTEGER NOT NULL, "
+                                    "mtime REAL NOT NULL, digest BLOB NOT NULL, PRIMARY KEY (inode, size, mtime))")
+            self.connection.execute("CREATE TABLE scans (started REAL NOT NULL)")
+            self.connection.execute("PRAGMA user_version = %d" % self.VERSION)
+            self.connection.commit()
+
+        # path -> (is_directory, inode, mtime, size), as of the previous scan
+        self.entries = {}
+        # directory path -> names of its entries, as of the previous scan
+        self.listings = {}
+        for path, is_directory, inode, mtime, size in self.connection.execute("SELECT * FROM entries"):
+            self.entries[path] = (bool(is_directory), inode, mtime, size)
+            if path:
+                parent, name = os.path.split(path)
+                self.listings.setdefault(parent, []).append(name)
+        # When the previous scan started, directories modified since may have changed after being listed
+        row = self.connection.execute("SELECT started FROM scans").fetchone()
+        self.previous_scan_started = row[0] if row is not None else 0
+        self.scanned = {}
+        self.reused_listings = 0
+        self.scan_started = 0
+
+    def scan(self):
+        """
+        Scans the directory, reusing the listings of unchanged directories, and saves the results.
+        @return: The directory's contents, with directories after their contents like in Directory.list
+        @rtype: list of FileInfo
+        """
+        self.scanned = {}
+        self.reused_listings = 0
+        self.scan_started = time.time()
+        files = []
+        root = self.directory.get_path()
+        if not self.entries and self.workers > 1:
+            # Nothing to reuse, so walk the whole tree in parallel
+            self._record("", os.stat(root))
+            for path, stat_result in scanner.walk(root, self.workers):
+                self._record(path, stat_result)
+                files.append(scanner.file_info(path, stat_result))
+        else:
+            self._scan_directory("", root, os.stat(root), files)
+        self._save()
+        if utils.DEBUG_LEVEL >= 1:
+            utils.log_message("DEBUG", "Scanned " + str(len(files)) + " entries, reused " +
+                              str(self.reused_listings) + " directory listings")
+        return files
+
+    def digest(self, path):
+        """
+        Returns the digest of the contents of a file, hashing it only if it changed since it was last hashed.
+        @param path: The file's path relative to the directory
+        @type path: str
+        @return: The SHA-256 digest
+        @rtype: str
+        """
+        abs_path = os.path.join(self.directory.get_path(), path)
+        stat_result = os.stat(abs_path)
+        key = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime)
+        row = self.connection.execute("SELECT digest FROM digests WHERE inode = ? AND size = ? AND mtime = ?",
+                                      key).fetchone()
+        if row is not None:
+            return bytes(row[0])
+        digest = content_store.file_digest(abs_path)
+        # A file modified right now may change again within the same mtime
+        if stat_result.st_mtime < time.time() - self.RACY_SECONDS:
+            self.connection.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                                    key + (sqlite3.Binary(digest),))
+        return digest
+
+    def _scan_directory(self, path, abs_path, stat_result, files):
+        """Scans a directory whose stat result is already known, appending its contents to files"""
+        self._record(path, stat_result)
+        entry = self.scanned[path]
+        # A directory modified right before or after the previous scan listed it may have changed again
+        # within the same mtime tick, after being listed
+        racy = stat_result.st_mtime >= self.previous_scan_started - self.RACY_SECONDS
+        if not racy and self.entries.get(path) == entry:
+            listing = self._stat_names(abs_path, self.listings.get(path, []))
+            self.reused_listings += 1
+        else:
+            listing = list_directory(abs_path)
+
+        for name, child_stat in listing:
+            child_path = os.path.join(path, name)
+            if stat.S_ISDIR(child_stat.st_mode):
+                self._scan_directory(child_path, os.path.join(abs_path, name), child_stat, files)
+            else:
+                self._record(child_path, child_stat)
+            files.append(scanner.file_info(child_path, child_stat))
+
+    def _record(self, path, stat_result):
+        """Records the stat result of an entry in the current scan"""
+        if stat.S_ISDIR(stat_result.st_mode):
+            self.scanned[path] = (True, stat_result.st_ino, stat_result.st_mtime, 0)
+        else:
+            self.scanned[path] = (False, stat_result.st_ino, stat_result.st_mtime, stat_result.st_size)
+
+    @staticmethod
+    def _stat_names(abs_path, names):
+        """Generator of (name, stat result) pairs for already known entries of a directory"""
+        for name in names:
+            try:
+                yield name, os.stat(os.path.join(abs_path, name))
+            except OSError as _:
+                # Removed since the previous scan
+                pass
+
+    def _save(self):
+        """Writes the differences between the previous scan and the current one"""
+        changed = [(path,) + (int(entry[0]),) + entry[1:] for path, entry in self.scanned.iteritems()
+                   if self.entries.get(path) != entry]
+        removed = [(path,) for path in self.entries if path not in self.scanned]
+        self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", changed)
+        self.connection.executemany("DELETE FROM entries WHERE path = ?", removed)
+        if changed or removed:
+            self.connection.execute("DELETE FROM digests WHERE NOT EXISTS (SELECT 1 FROM entries "
+                                    "WHERE entries.inode = digests.inode AND entries.size = digests.size "
+                                    "AND entries.mtime = digests.mtime)")
+        self.connection.execute("DELETE FROM scans")
+        self.connection.execute("INSERT INTO scans VALUES (?)", (self.scan_started,))
+        self.connection.commit()
+        self.previous_scan_started = self.scan_started
+
+        self.entries = self.scanned
+        self.listings = {}
+        for path in self.entries:
+            if path:
+                parent, name = os.path.split(path)
+                self.listings.setdefault(parent, []).append(name)
+
+    def close(self):
+        """Saves the digests computed since the scan and closes the cache"""
+        self.connection.commit()
+        self.connection.close()
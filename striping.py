@@ -0,0 +1,298 @@
+"""Transfer of large files striped across several data connections tied to the same session"""
+# Grupo 14:
+# 81900 - Nuno Anselmo
+# 81936 - Liliana Oliveira
+# 82047 - Andre Mendes
+
+import os
+import packets
+import Queue
+import socket
+import threading
+import utils
+
+# Large files are sent over the data connections of the session, split in ranges
+STRIPED = "striped"
+# Every file is sent over the connection of the session
+NONE = "none"
+
+# Supported striping modes, most preferred first
+MODES = [STRIPED, NONE]
+
+# Files smaller than this are sent over the control connection, like any other
+MIN_SIZE = 1048576
+# Files are only split in ranges of at least this size, smaller ones are sent whole over a single data connection
+MIN_RANGE_SIZE = 8388608
+# Most data connections a session accepts
+MAX_STREAMS = 16
+# Seconds to wait for the threads of the data connections when closing a session
+CLOSE_TIMEOUT = 5.0
+# Length of the tokens tying data connections to their session
+TOKEN_LENGTH = 16
+
+
+def new_token():
+    """Returns a random token for a new session"""
+    return os.urandom(TOKEN_LENGTH)
+
+
+def split_ranges(size, streams):
+    """
+    Splits a file in ranges to be sent in parallel, at most one per data connection and none smaller than
+    MIN_RANGE_SIZE but the last one.
+    @param size: The size of the file
+    @type size: int
+    @param streams: The number of data connections
+    @type streams: int
+    @return: The (offset, length) of each range
+    @rtype: list of tuple
+    """
+    count = max(1, min(streams, size // MIN_RANGE_SIZE))
+    length = -(-size // count)
+    return [(offset, min(length, size - offset)) for offset in range(0, size, length)]
+
+
+class StripedSession(object):
+    """
+    Data connections opened next to the control connection of a session, which keeps every decision and every
+    placed file in its MessageHandler. Files are announced over the control connection with a stripe packet and
+    their ranges follow over the data connections, each one with a thread sending the ranges queued for it and a
+    thread receiving ranges into the staged files announced by the other side. Received files are handed back
+    to the MessageHandler once all their ranges arrived.
+
+    A session being closed sends a logout packet over every data connection before shutting it down. A data
+    connection ending any other way breaks the session on both sides, since the ranges it carried are lost,
+    and the files still expected make the logout fail like a lost connection would.
+    """
+
+    def __init__(self, token, file_compression):
+        """
+        Creates a session without data connections.
+        @param token: The token data connections attach to the session with
+        @type token: str
+        @param file_compression: The negotiated compression of file contents, ranges are compressed alike
+        @type file_compression: str
+        """
+        super(StripedSession, self).__init__()
+        self.token = token
+        self.file_compression = file_compression
+        self.condition = threading.Condition()
+        # [object socket, queue of ranges to send, bytes queued, sending thread] of every data connection
+        self.streams = []
+        # Threads receiving over the data connections, waited for when the session is closed
+        self.threads = []
+        # Transfer id of the next file sent
+        self.next_transfer = 0
+        # Files announced by the other side, by transfer id, with the bytes received so far
+        self.expected = {}
+        # Files whose ranges all arrived, waiting to be placed
+        self.completed = []
+        # Whether sending a range failed, and whether a data connection was lost
+        self.failed = False
+        self.broken = False
+        self.closed = False
+
+    def attach(self, object_socket):
+        """
+        Adds a data connection, starting the thread that sends the ranges queued for it.
+        The ranges it receives are only read by serve.
+        @param object_socket: The data connection
+        @type object_socket: ObjectSocket
+        @return: Whether it was added, sessions take up to MAX_STREAMS
+        @rtype: bool
+        """
+        object_socket.file_compression = self.file_compression
+        object_socket.stripes = self
+        with self.condition:
+            if self.closed or len(self.streams) >= MAX_STREAMS:
+                return False
+            stream = [object_socket, Queue.Queue(), 0, None]
+            self.streams.append(stream)
+        stream[3] = threading.Thread(target=StripedSession._send_ranges, args=(self, stream))
+        stream[3].daemon = True
+        stream[3].start()
+        if utils.DEBUG_LEVEL >= 1:
+            utils.log_message("DEBUG", "Attached data connection " + str(len(self.streams)))
+        return True
+
+    def serve(self, object_socket):
+        """
+        Receives ranges from a data connection until the other side logs out of it, or until it is shut down.
+        @param object_socket: The data connection, attached before
+        @type object_socket: ObjectSocket
+        """
+        try:
+            while True:
+                packet = object_socket.receive_object()
+                if isinstance(packet, packets.LogoutPacket):
+                    return
+                if packet is None:
+                    break
+        except socket.error as error:
+            utils.log_message("ERROR", "Data connection lost: " + str(error))
+        with self.condition:
+            if self.closed:
+                return
+            self.broken = True
+            self.condition.notify_all()
+        utils.log_message("ERROR", "Data connection lost, the files striped across it are incomplete")
+        self._shutdown(self.streams)
+
+    def can_send(self):
+        """Returns whether there is any data connection to send files over"""
+        return bool(self.streams) and not self.failed and not self.broken
+
+    def send(self, file_info):
+        """
+        Queues the ranges of a file on the least busy data connections. The file has to be announced over the
+        control connection, with the transfer id returned, before the other side can receive them.
+        @param file_info: The file, with its file wrapper
+        @type file_info: FileInfo
+        @return: The transfer id of the file
+        @rtype: int
+        """
+        with self.condition:
+            transfer_id = self.next_transfer
+            self.next_transfer += 1
+            ranges = split_ranges(file_info.size, len(self.streams))
+            streams = sorted(self.streams, key=lambda queued: queued[2])[:len(ranges)]
+            for stream, (offset, length) in zip(streams, ranges):
+                stream[2] += length
+                stream[1].put((transfer_id, file_info, offset, length))
+        return transfer_id
+
+    def expect(self, transfer_id, file_info):
+        """
+        Registers a file announced by the other side, whose ranges are received into its staged file.
+        @param transfer_id: The transfer id of the file
+        @type transfer_id: int
+        @param file_info: The file, with the closed staged file as its file wrapper
+        @type file_info: FileInfo
+        """
+        with self.condition:
+            self.expected[transfer_id] = [file_info, 0]
+            if file_info.size == 0:
+                self._complete(transfer_id)
+            self.condition.notify_all()
+
+    def target(self, transfer_id):
+        """
+        Returns the path of the staged file of a transfer, waiting for it to be announced.
+        Only to be called by packets, while a data connection decodes a range.
+        @param transfer_id: The transfer id of the file
+        @type transfer_id: int
+        @rtype: str
+        @raise EOFError: If the session is closed before the file is announced.
+        """
+        with self.condition:
+            while transfer_id not in self.expected and not self.closed:
+                self.condition.wait()
+            if transfer_id not in self.expected:
+                raise EOFError()
+            return self.expected[transfer_id][0].file_wrapper.get_path()
+
+    def received(self, transfer_id, length):
+        """
+        Records that a range of a file was written to its staged file.
+        @param transfer_id: The transfer id of the file
+        @type transfer_id: int
+        @param length: The length of the range
+        @type length: int
+        """
+        with self.condition:
+            expected = self.expected[transfer_id]
+            expected[1] += length
+            if expected[1] >= expected[0].size:
+                self._complete(transfer_id)
+                self.condition.notify_all()
+
+    def take_completed(self, wait=False):
+        """
+        Returns the files whose ranges all arrived since the last call.
+        @param wait: Whether to wait until every file announced arrived
+        @type wait: bool
+        @rtype: list of FileInfo
+        @raise socket.error: If waiting and a data connection was lost before every file arrived.
+        """
+        with self.condition:
+            while wait and self.expected and not self.broken:
+                self.condition.wait()
+            if wait and self.expected:
+                raise socket.error("Data connection lost with " + str(len(self.expected)) + " files incomplete")
+            completed = self.completed
+            self.completed = []
+            return completed
+
+    def drain(self):
+        """
+        Waits until every range queued was sent.
+        @raise socket.error: If sending any of them failed.
+        """
+        for stream in list(self.streams):
+            stream[1].join()
+        if self.failed:
+            raise socket.error("Data connection lost while sending")
+
+    def close(self):
+        """Stops the threads sending ranges, shuts the data connections down, which ends serve, and closes them
+        once their threads are done"""
+        with self.condition:
+            self.closed = True
+            streams = self.streams
+            self.streams = []
+            self.condition.notify_all()
+        for stream in streams:
+            stream[1].put(None)
+        for stream in streams:
+            stream[3].join(CLOSE_TIMEOUT)
+        self._shutdown(streams)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(CLOSE_TIMEOUT)
+        for stream in streams:
+            stream[0].socket.close()
+
+    @staticmethod
+    def _shutdown(streams):
+        """Shuts data connections down, which ends serve on both sides"""
+        for stream in list(streams):
+            try:
+                stream[0].socket.shutdown(socket.SHUT_RDWR)
+            except socket.error as _:
+                pass
+
+    def _complete(self, transfer_id):
+        """Moves a file from the expected to the completed ones, with the condition held"""
+        self.completed.append(self.expected.pop(transfer_id)[0])
+
+    def _log_out(self, object_socket):
+        """Tells the other side nothing else will be sent over a data connection"""
+        if self.failed:
+            return
+        try:
+            object_socket.send_object(packets.LogoutPacket(True, False))
+            object_socket.flush()
+        except socket.error as _:
+            # The other side closed its end first
+            pass
+
+    def _send_ranges(self, stream):
+        """Sends the ranges queued for a data connection, until the session is closed"""
+        object_socket, queue = stream[:2]
+        while True:
+            queued = queue.get()
+            try:
+                if queued is None:
+                    self._log_out(object_socket)
+                    return
+                transfer_id, file_info, offset, length = queued
+                if not self.failed:
+                    object_socket.send_object(packets.RangePacket(transfer_id, file_info, offset, length))
+                    object_socket.flush()
+                with self.condition:
+                    stream[2] -= length
+            except socket.error as error:
+                utils.log_message("ERROR", "Could not send over data connection: " + str(error))
+                self.failed = True
+            finally:
+                queue.task_done()